@@ -0,0 +1,28 @@
+""" ArboTopo - benchmarks: adjustment
+
+This script times the AdjustmentAlgorithm on the synthetic cave of the propagation benchmark.
+
+Run from the project root with: python -m benchmarks.adjustment [shots [workers]]
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import sys
+from timeit import default_timer
+from benchmarks.propagation import create_cave
+from data.adjustment_algorithm import AdjustmentAlgorithm
+
+
+def main(shots=300000, workers=None):
+    """Print the timings of the creation of the dataset and of the adjustment."""
+    start = default_timer()
+    dataset = create_cave(shots)
+    created = default_timer()
+    algorithm = AdjustmentAlgorithm(dataset, workers=workers)
+    print('{shots} shots, {stations} stations: dataset {created:.2f} s, adjustment {adjusted:.2f} s'.format(
+        shots=shots, stations=algorithm.graph.station_count, created=created-start,
+        adjusted=default_timer()-created))
+
+
+if __name__ == '__main__':
+    main(*(int(argument) for argument in sys.argv[1:]))
@@ -0,0 +1,42 @@
+""" ArboTopo - benchmarks: GeoMag sweeps
+
+This script measures the effect of the incremental evaluation of GeoMag on latitude and longitude sweeps. A fresh
+evaluator per point reproduces the old behaviour where every intermediate result was recomputed.
+
+Run from the project root with: python -m benchmarks.geomag_sweep
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+from datetime import date
+from timeit import timeit
+from data.geomag import GeoMag
+
+
+def sweep(evaluate, points):
+    """Evaluate all points with the given function."""
+    for latitude, longitude, day in points:
+        evaluate(latitude, longitude, 0, day)
+
+
+def main(repeat=5):
+    """Print the timings of the sweeps with cold and incremental evaluation."""
+    gm = GeoMag()
+    day = date(2016, 1, 1)
+    sweeps = {
+        'longitude sweep': [(50.0, longitude/10.0, day) for longitude in range(-1800, 1800)],
+        'latitude sweep': [(latitude/10.0, 4.0, day) for latitude in range(-890, 890)],
+        'grid, row by row': [(latitude, longitude, day) for latitude in range(-80, 81, 5)
+                             for longitude in range(-180, 180, 5)],
+    }
+    for name, points in sweeps.items():
+        cold = timeit(lambda: sweep(lambda *args: gm.evaluator().GeoMag(*args), points), number=repeat)
+        incremental = timeit(lambda: sweep(gm.evaluator().GeoMag, points), number=repeat)
+        print('{name:20s} {n:6d} points: cold {cold:7.1f} us/pt, incremental {incremental:7.1f} us/pt, '
+              'speedup {speedup:.2f}x'.format(name=name, n=len(points), cold=cold/repeat/len(points)*1e6,
+                                              incremental=incremental/repeat/len(points)*1e6,
+                                              speedup=cold/incremental))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+""" ArboTopo - benchmarks: map exporter
+
+This script times the export of the map of the synthetic cave of the propagation benchmark and traces its peak memory.
+
+Run from the project root with: python -m benchmarks.map_exporter [shots]
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import os
+import sys
+import tempfile
+import tracemalloc
+from timeit import default_timer
+from benchmarks.propagation import create_cave
+from data.map_exporter import MapExporter
+from data.propagation_algorithm import PropagationAlgorithm
+from data.view import View
+
+
+def main(shots=100000):
+    """Print the timings, the peak memory (without the view itself) and the size of the SVG and PDF maps."""
+    view = View(PropagationAlgorithm(create_cave(shots)))
+    view.segments(tolerance=0.0)
+    exporter = MapExporter(view)
+    with tempfile.TemporaryDirectory() as directory:
+        for format in ('svg', 'pdf'):
+            filename = os.path.join(directory, 'map.'+format)
+            start = default_timer()
+            exporter.write(filename)
+            elapsed = default_timer()-start
+            # The memory is traced in a second run, tracing slows it down.
+            tracemalloc.start()
+            exporter.write(filename)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{shots} shots, {format}: {elapsed:.2f} s, peak {peak:.1f} MB, {size:.1f} MB'.format(
+                shots=shots, format=format, elapsed=elapsed, peak=peak/2**20, size=os.path.getsize(filename)/2**20))
+
+
+if __name__ == '__main__':
+    main(*(int(argument) for argument in sys.argv[1:]))
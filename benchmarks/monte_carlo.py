@@ -0,0 +1,28 @@
+""" ArboTopo - benchmarks: monte carlo
+
+This script times the MonteCarloAlgorithm on the synthetic cave of the propagation benchmark.
+
+Run from the project root with: python -m benchmarks.monte_carlo [shots [samples]]
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import sys
+from timeit import default_timer
+from benchmarks.propagation import create_cave
+from data.monte_carlo_algorithm import MonteCarloAlgorithm
+
+
+def main(shots=20000, samples=1000):
+    """Print the timings of the creation of the dataset and of the sampling."""
+    start = default_timer()
+    dataset = create_cave(shots)
+    created = default_timer()
+    algorithm = MonteCarloAlgorithm(dataset, samples=samples, seed=0)
+    print('{shots} shots, {stations} stations, {samples} samples: dataset {created:.2f} s, sampling {sampled:.2f} s'
+          .format(shots=shots, stations=algorithm.graph.station_count, samples=samples, created=created-start,
+                  sampled=default_timer()-created))
+
+
+if __name__ == '__main__':
+    main(*(int(argument) for argument in sys.argv[1:]))
@@ -0,0 +1,84 @@
+""" ArboTopo - benchmarks: point memory
+
+This script measures the memory footprint per object of a network of a million legs built with Point arithmetic. Every
+leg has a Point, a TopoPoint and a RelativeMeasurement. The slotted objects are compared with copies which store the
+same fields in a per-instance __dict__, the layout before the classes were slotted.
+
+Run from the project root with: python -m benchmarks.point_memory
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import gc
+import sys
+import tracemalloc
+from data.point import Point
+from data.topo_point import TopoPoint
+from data.measurement import RelativeMeasurement
+
+
+def slots(cls):
+    """Return the names of all slots of the given class."""
+    return [name for base in cls.__mro__ for name in base.__dict__.get('__slots__', ())]
+
+
+def unslotted_copy(obj, classes=None):
+    """Return a copy of obj which stores the fields in a __dict__ instead of slots.
+
+    -classes:   a dict mapping the slotted classes on their unslotted counterparts, shared between the copies
+    """
+    if classes is None:
+        classes = {}
+    cls = type(obj)
+    if cls not in classes:
+        classes[cls] = type(cls.__name__, (), {})
+    copy = classes[cls]()
+    for name in slots(cls):
+        try:
+            setattr(copy, name, getattr(obj, name))
+        except AttributeError:
+            pass
+    return copy
+
+
+def build_network(size):
+    """Return a list with the Point, TopoPoint and RelativeMeasurement objects of a traverse of size legs."""
+    leg = Point(1.0, 0.5, -0.2, 0.01, 0.01, 0.02)
+    position = Point(0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    network = []
+    for index in range(size):
+        position = position + leg
+        measurement = RelativeMeasurement(refpoint=index-1, dataset=None, name=index, point=index)
+        measurement._dx, measurement._dy, measurement._dz = leg.xyz()
+        network.extend((position, TopoPoint(name=index, p=position), measurement))
+    return network
+
+
+def footprint(obj):
+    """Return the memory of the object itself, including its __dict__ if it has one."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main(size=1000000):
+    """Print the memory per leg with slotted and unslotted objects."""
+    gc.collect()
+    tracemalloc.start()
+    network = build_network(size)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    classes = {}
+    copies = [unslotted_copy(obj, classes) for obj in network]
+    print('{size} legs, {memory:.0f} bytes per leg traced in total (objects and their values)'.format(
+        size=size, memory=memory/size))
+    print('  objects with __dict__ : {memory:6.0f} bytes per leg'.format(memory=sum(map(footprint, copies))/size))
+    print('  objects with __slots__: {memory:6.0f} bytes per leg'.format(memory=sum(map(footprint, network))/size))
+    for obj, copy in zip(network[:3], copies[:3]):
+        print('  {name:20s}: {slotted:4d} bytes slotted, {unslotted:4d} bytes with __dict__'.format(
+            name=type(obj).__name__, slotted=footprint(obj), unslotted=footprint(copy)))
+
+
+if __name__ == '__main__':
+    main()
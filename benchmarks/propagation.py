@@ -0,0 +1,60 @@
+""" ArboTopo - benchmarks: propagation
+
+This script times the PropagationAlgorithm on a synthetic cave: long passages (chains of shots) that branch off random
+earlier stations, with an extra shot closing a loop of at most 30 shots in the current passage every 50 shots.
+
+Run from the project root with: python -m benchmarks.propagation [shots]
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import random
+import sys
+from timeit import default_timer
+from data.dataset import Dataset
+from data.propagation_algorithm import PropagationAlgorithm
+
+
+def create_cave(shots, seed=0):
+    """Return a columnar dataset with a synthetic cave of the given number of shots and a GPS fix."""
+    generator = random.Random(seed)
+    dataset = Dataset({}, 'synthetic', columnar=True)
+    dataset.add_device('DCIDevice', 'disto')
+    dataset.add_device('GPS', 'gps')
+    dataset.add_measurement(None, 'fix', 'gps', point=0, x=0.0, y=0.0, z=0.0)
+    stations = 1
+    passage = 0
+    for index in range(shots):
+        if index % 50 == 49 and stations-passage > 3:
+            refpoint = stations-1
+            point = generator.randrange(max(passage, refpoint-30), refpoint-1)
+        else:
+            if generator.random() < 0.95:
+                refpoint = stations-1
+            else:
+                refpoint = generator.randrange(stations)
+                passage = stations
+            point = stations
+            stations += 1
+        dataset.add_measurement(None, index, 'disto', point=point, refpoint=refpoint,
+                                distance=generator.uniform(1.0, 20.0), compass=generator.uniform(0.0, 360.0),
+                                inclination=generator.uniform(-60.0, 60.0))
+    return dataset
+
+
+def main(shots=1000000):
+    """Print the timings of the creation of the dataset and of the algorithm."""
+    start = default_timer()
+    dataset = create_cave(shots)
+    created = default_timer()
+    algorithm = PropagationAlgorithm(dataset)
+    calculated = default_timer()
+    algorithm.get_topo_points()
+    print('{shots} shots, {stations} stations: dataset {created:.2f} s, propagation {calculated:.2f} s, '
+          'TopoPoints {topo_points:.2f} s'.format(shots=shots, stations=algorithm.graph.station_count,
+                                                  created=created-start, calculated=calculated-created,
+                                                  topo_points=default_timer()-calculated))
+
+
+if __name__ == '__main__':
+    main(*(int(argument) for argument in sys.argv[1:]))
@@ -0,0 +1,62 @@
+""" ArboTopo - benchmarks: shot reduction
+
+This script compares the per-measurement reduction of relative measurements with the batched reduction of a whole
+dataset, with the measurements stored as objects and in a columnar table.
+
+Run from the project root with: python -m benchmarks.shot_reduction
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import random
+import tracemalloc
+import numpy as np
+from timeit import default_timer
+from data.dataset import Dataset
+
+
+def create_dataset(shots, columnar=False):
+    """Return a dataset with the given number of random shots, made with two devices."""
+    dataset = Dataset({}, 'benchmark', columnar=columnar)
+    dataset.add_device('DCIDevice', 'compass', declination=1.5)
+    dataset.add_device('DistoX', 'disto', angleref='ver')
+    for index in range(shots):
+        dataset.add_measurement(None, str(index), ('compass', 'disto')[index % 2], point=str(index+1),
+                                refpoint=str(index), distance=random.uniform(0.5, 30.0),
+                                compass=random.uniform(0.0, 360.0), inclination=random.uniform(-90.0, 90.0))
+    return dataset
+
+
+def main(shots=100000):
+    """Print the timings of both reductions."""
+    dataset = create_dataset(shots)
+    start = default_timer()
+    measurements, differences = dataset.calculate_differences()
+    batched = default_timer()-start
+    start = default_timer()
+    for measurement in measurements:
+        measurement._calculate_position()
+    single = default_timer()-start
+    print('{shots} shots: per measurement {single:.3f} s, batched {batched:.3f} s, speedup {speedup:.1f}x'.format(
+        shots=shots, single=single, batched=batched, speedup=single/batched))
+    device = dataset.get_device('compass')
+    distance, compass, inclination = (np.array([measurement.data[field] for measurement in measurements])
+                                      for field in ('distance', 'compass', 'inclination'))
+    start = default_timer()
+    device.reduce(distance, compass, inclination)
+    print('{shots} shots: reduction of the arrays only {reduce:.3f} s'.format(shots=shots,
+                                                                           reduce=default_timer()-start))
+    for columnar in (False, True):
+        tracemalloc.start()
+        dataset = create_dataset(shots, columnar=columnar)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = default_timer()
+        dataset.calculate_differences()
+        print('{shots} shots, {storage}: {memory:.0f} bytes per shot, batched {batched:.3f} s'.format(
+            shots=shots, storage=('objects', 'columnar')[columnar], memory=memory/shots,
+            batched=default_timer()-start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+""" ArboTopo - benchmarks: view
+
+This script times the rendering of the tiles of a View of the synthetic cave of the propagation benchmark.
+
+Run from the project root with: python -m benchmarks.view [shots [max_zoom [workers]]]
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import sys
+import tempfile
+from timeit import default_timer
+from benchmarks.propagation import create_cave
+from data.propagation_algorithm import PropagationAlgorithm
+from data.view import View
+
+
+def main(shots=50000, max_zoom=5, workers=None):
+    """Print the timings of the simplification, the rendering and the rendering without changes."""
+    algorithm = PropagationAlgorithm(create_cave(shots))
+    start = default_timer()
+    view = View(algorithm, max_zoom=max_zoom)
+    view.importance
+    ranked = default_timer()
+    with tempfile.TemporaryDirectory() as directory:
+        tiles = len(view.render(directory, workers=workers))
+        rendered = default_timer()
+        view.render(directory, workers=workers)
+        print('{shots} shots, {tiles} tiles: simplification {ranked:.2f} s, rendering {rendered:.2f} s, '
+              'rendering again {again:.2f} s'.format(shots=shots, tiles=tiles, ranked=ranked-start,
+                                                     rendered=rendered-ranked, again=default_timer()-rendered))
+
+
+if __name__ == '__main__':
+    main(*(int(argument) for argument in sys.argv[1:]))
@@ -0,0 +1,836 @@
+""" ArboTopo - data: adjustment algorithm
+
+The AdjustmentAlgorithm of this module calculates the TopoPoints by a weighted least-squares adjustment of the network.
+
+Every shot is an observation of the difference between the positions of its stations, every fix an observation of the
+position of its station. The observations are weighted by the inverse of their variances: the variances of the shots
+follow from the errors of their devices (the diagonal of the covariance of the reduction), the variances of the fixes
+from the errors of their devices. Fixes of devices without errors are exact, the position of their station is then
+eliminated from the unknowns. Components without any fix get their root (the origin station or their first station)
+fixed at the origin position. The coordinates are adjusted independently, the normal equations of each coordinate are
+a sparse weighted graph Laplacian which is solved by a sparse LU factorization (SuperLU with a fill-reducing ordering).
+
+The std of the adjusted positions are the square roots of the diagonal of the inverse of the normal matrix. They are
+calculated exactly without inverting it: stations in trees hanging from the network (and behind a single articulation)
+add the variances of their shots to the variance of their attachment, traverses of stations with two neighbours are
+reduced to a single equivalent shot between their junctions and interpolated afterwards (a brownian bridge). Only the
+covariances of the junctions of the loops are calculated from a factorization, by selected inversion.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from scipy.sparse.csgraph import breadth_first_order, connected_components, depth_first_order
+from scipy.sparse.linalg import splu
+from data.algorithm import Algorithm
+from data.device import DCIDevice, calculate_differences
+from data.measurement import RelativeMeasurement
+from data.point import Point
+from data.survey_graph import SurveyGraph
+from data.topo_point import TopoPoint
+
+
+def _factorize(matrix, order=None):
+    """Return the SuperLU factorization of a symmetric positive definite sparse matrix.
+
+    A symmetric fill-reducing ordering is used and pivots are taken from the diagonal, so the rows and the columns are
+    permuted alike and the factorization is L D L^T (U is D L^T). If the order of the rows and columns of an earlier
+    factorization (its perm_c) is given, the matrix is factorized in that order instead.
+    """
+    options = {'SymmetricMode': True}
+    if order is None:
+        return splu(matrix.tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0, options=options)
+    inverse = np.argsort(order)
+    matrix = matrix.tocsr()[inverse][:, inverse]
+    return splu(matrix.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0.0, options=options)
+
+
+def _lower_factor(factorization):
+    """Return the indptr, indices and values of the entries below the diagonal of L (CSC, sorted) and the pivots D."""
+    lower = factorization.L.tocsc()
+    lower.sort_indices()
+    columns = np.repeat(np.arange(lower.shape[1]), np.diff(lower.indptr))
+    below = lower.indices > columns
+    indptr = np.zeros(lower.shape[1]+1, dtype=np.int64)
+    np.cumsum(np.bincount(columns[below], minlength=lower.shape[1]), out=indptr[1:])
+    return indptr, lower.indices[below].astype(np.int64), lower.data[below], factorization.U.diagonal()
+
+
+def _selected_inverse(indptr, indices, factors, pivots):
+    """Return the entries of the inverses of factorized symmetric matrices in the sparsity pattern of their factor.
+
+    The K matrices are factorized as L D L^T in the same order with the same pattern: the entries of L below the
+    diagonal are given by indptr and (sorted) indices in CSC and by their values, one column of factors per matrix, the
+    pivots D by the columns of pivots. The entries are calculated with the Takahashi recurrences, which only need the
+    entries of the inverse among the rows of a column, all ancestors of the column in the elimination tree. The columns
+    are calculated per level of the tree from its roots, all columns of a level and all matrices at once. The diagonal
+    (N x K) and the entries below it (in the order of the indices) are returned in the permuted order of the
+    factorization.
+    """
+    size = len(indptr)-1
+    counts = np.diff(indptr)
+    # The parent of a column in the elimination tree is its first row below the diagonal, depths by pointer jumping.
+    parents = np.arange(size)
+    children = np.flatnonzero(counts)
+    parents[children] = indices[indptr[children]]
+    depths = (counts > 0).astype(np.int64)
+    ancestors = parents
+    while True:
+        next_ancestors = ancestors[ancestors]
+        if np.array_equal(next_ancestors, ancestors):
+            break
+        depths += depths[ancestors]
+        ancestors = next_ancestors
+    keys = np.repeat(np.arange(size), counts)*size+indices
+    diagonal = np.empty(pivots.shape)
+    inverse = np.empty(factors.shape)
+    levels = np.argsort(depths, kind='stable')
+    for columns in np.split(levels, np.cumsum(np.bincount(depths))[:-1]):
+        lengths = counts[columns]
+        total = lengths.sum()
+        column_starts = np.cumsum(lengths)-lengths
+        local_columns = np.repeat(np.arange(len(columns)), lengths)
+        positions = np.arange(total)-column_starts[local_columns]
+        entries = indptr[columns][local_columns]+positions
+        rows = indices[entries]
+        values = factors[entries]
+        # The entries of the inverse among the rows of every column: the diagonal and the pairs of rows above it.
+        pair_counts = lengths[local_columns]-positions-1
+        first = np.repeat(np.arange(total), pair_counts)
+        second = first+1+np.arange(len(first))-np.repeat(np.cumsum(pair_counts)-pair_counts, pair_counts)
+        covariances = inverse[np.searchsorted(keys, rows[first]*size+rows[second])]
+        sums = diagonal[rows]*values
+        for matrix in range(factors.shape[1]):
+            sums[:, matrix] += (np.bincount(first, covariances[:, matrix]*values[second, matrix], total) +
+                                np.bincount(second, covariances[:, matrix]*values[first, matrix], total))
+            diagonal[columns, matrix] = 1.0/pivots[columns, matrix]+np.bincount(
+                local_columns, values[:, matrix]*sums[:, matrix], len(columns))
+        inverse[entries] = -sums
+    return diagonal, inverse
+
+
+def _adjust_group(arrays, stations, shots, fixed, soft_fixes):
+    """Adjust a group of components of the arrays of AdjustmentAlgorithm._adjust_groups, given as (start, end) slices.
+
+    The stations of the shots and fixes are numbered from the start of the group, the positions and variances are
+    written to the arrays.
+    """
+    station_count = stations[1]-stations[0]
+    shot_from, shot_to = arrays['shot_from'][slice(*shots)], arrays['shot_to'][slice(*shots)]
+    shot_variances = arrays['shot_variances'][slice(*shots)]
+    fixed_stations = arrays['fixed'][slice(*fixed)]
+    soft_fixes = tuple(arrays[name][slice(*soft_fixes)] for name in ('soft_stations', 'soft_positions',
+                                                                      'soft_variances'))
+    arrays['positions'][slice(*stations)] = AdjustmentAlgorithm._solve(
+        shot_from, shot_to, arrays['differences'][slice(*shots)], shot_variances, station_count, fixed_stations,
+        arrays['fixed_positions'][slice(*fixed)], soft_fixes)[0]
+    arrays['variances'][slice(*stations)] = AdjustmentAlgorithm._variances(shot_from, shot_to, shot_variances,
+                                                                           station_count, fixed_stations, soft_fixes)
+
+
+class AdjustmentAlgorithm(Algorithm):
+    """An algorithm which adjusts the positions of all stations to all shots and fixes by weighted least squares."""
+
+    DEFAULT_ERRORS = (0.025, 1.0, 1.0)
+    """The std of the distance (meter), compass and inclination (degrees) readings of devices which have no errors."""
+
+    MIN_VARIANCE = 1e-8
+    """The smallest variance (square meter) of an observation, to keep the normal equations well conditioned."""
+
+    MAX_UPDATES = 32
+    """The number of observations added to or removed from the factorized normal equations before they are rebuilt."""
+
+    CACHE_PARAMETERS = ('origin', 'origin_position', 'relative_error')
+    """The names of the attributes the results depend on besides the dataset, part of the keys of a ResultCache."""
+
+    def __init__(self, dataset, origin=None, origin_position=(0.0, 0.0, 0.0), relative_error=0.01, incremental=False,
+                 workers=None, cache=None):
+        """Create the algorithm and calculate the TopoPoints.
+
+        -origin:            the name of the station used as root of its component if that component has no fix
+        -origin_position:   the (x, y, z) of the roots without a fix
+        -relative_error:    the std per coordinate of shots of devices other than DCIDevices, relative to their length
+        -incremental:       update the TopoPoints when measurements are added or edited
+        -workers:           the number of processes adjusting groups of components, none to adjust them in this process
+        -cache:             a ResultCache to restore the TopoPoints from if the dataset did not change
+        """
+        self.origin = origin
+        self.origin_position = origin_position
+        self.relative_error = relative_error
+        Algorithm.__init__(self, dataset, incremental, workers, cache)
+
+    def _recalculate(self):
+        """Recalculate the TopoPoints.
+
+        The incremental updates need the factorization of the normal equations of the whole network, so then the
+        network is adjusted at once. Otherwise it is adjusted per group of components.
+        """
+        graph = self._graph = SurveyGraph.from_dataset(self.dataset)
+        self.shot_variances = self._shot_variances(graph.measurements, graph.differences)
+        self.fixed, self.fixed_positions, self.soft_fixes = self._anchors()
+        if not self.incremental:
+            self.positions, self.variances = self._adjust_groups()
+            self._update_residuals()
+            return
+        self.positions, self._columns, self._factorizations = self._solve(
+            graph.shot_from, graph.shot_to, graph.differences, self.shot_variances, graph.station_count, self.fixed,
+            self.fixed_positions, self.soft_fixes)
+        self.variances = self._variances(graph.shot_from, graph.shot_to, self.shot_variances, graph.station_count,
+                                         self.fixed, self.soft_fixes)
+        self._update_residuals()
+        # The state of the incremental updates: the stations added as pendants (station, parent, shot, sign) and the
+        # rank one updates of the inverse of the normal matrix, one contiguous row per update allocated with the first.
+        self.pendants = []
+        self._update_vectors = None
+        self._update_scales = np.empty((3, self.MAX_UPDATES))
+        self._update_count = 0
+
+    def _adjust_groups(self):
+        """Return the N x 3 positions and variances of the stations, adjusted per group of components.
+
+        The stations, shots and fixes are sorted by group, so every group is a slice of the arrays, and the stations
+        are numbered from the start of their group.
+        """
+        graph = self.graph
+        groups = self._component_groups(self.labels)
+        count = groups.max()+1 if len(groups) else 0
+
+        def sort(stations):
+            order = np.argsort(groups[stations], kind='stable')
+            bounds = np.searchsorted(groups[stations][order], np.arange(count+1))
+            return order, [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+        station_order, station_slices = sort(np.arange(graph.station_count))
+        local = np.empty(graph.station_count, dtype=np.int64)
+        local[station_order] = np.arange(graph.station_count)-np.repeat([start for start, end in station_slices],
+                                                                         [end-start for start, end in station_slices])
+        shot_order, shot_slices = sort(graph.shot_from)
+        fixed_order, fixed_slices = sort(self.fixed)
+        soft_stations, soft_positions, soft_variances = self.soft_fixes
+        soft_order, soft_slices = sort(soft_stations)
+        arrays = {'shot_from': local[graph.shot_from[shot_order]], 'shot_to': local[graph.shot_to[shot_order]],
+                  'differences': graph.differences[shot_order], 'shot_variances': self.shot_variances[shot_order],
+                  'fixed': local[self.fixed[fixed_order]], 'fixed_positions': self.fixed_positions[fixed_order],
+                  'soft_stations': local[soft_stations[soft_order]], 'soft_positions': soft_positions[soft_order],
+                  'soft_variances': soft_variances[soft_order], 'positions': np.zeros((graph.station_count, 3)),
+                  'variances': np.zeros((graph.station_count, 3))}
+        arrays = self._run_groups(_adjust_group, arrays, list(zip(station_slices, shot_slices, fixed_slices,
+                                                                  soft_slices)))
+        positions, variances = np.empty((graph.station_count, 3)), np.empty((graph.station_count, 3))
+        positions[station_order] = arrays['positions']
+        variances[station_order] = arrays['variances']
+        return positions, variances
+
+    def _update_residuals(self):
+        """Calculate the residuals of the shots and invalidate the TopoPoints."""
+        self.residuals = (self.positions[self.graph.shot_to]-self.positions[self.graph.shot_from] -
+                          self.graph.differences)
+        self._topo_points = None
+
+    def _shot_variances(self, measurements, differences):
+        """Return the N x 3 array of the variances of the x, y and z of the shots of the given measurements."""
+        variances = np.empty((len(measurements), 3))
+        devices = {}
+        codes = np.fromiter((devices.setdefault(measurement.device, len(devices))
+                             for measurement in measurements), dtype=int, count=len(measurements))
+        for device, code in devices.items():
+            indices = np.flatnonzero(codes == code)
+            selected = differences[indices]
+            if isinstance(device, DCIDevice):
+                errors = [default if error is None else error for error, default in
+                          zip((device.distance_error, device.compass_error, device.inclination_error),
+                              self.DEFAULT_ERRORS)]
+                covariance = device.reduce_covariance(*device.readings(selected), *errors)
+                variances[indices] = np.diagonal(covariance, axis1=1, axis2=2)
+            else:
+                length = np.sqrt(np.einsum('ij,ij->i', selected, selected))
+                variances[indices] = ((self.relative_error*length)**2)[:, np.newaxis]
+        return np.maximum(variances, self.MIN_VARIANCE)
+
+    def _anchors(self):
+        """Return the exactly fixed stations, their positions and the other fixes.
+
+        The other fixes are returned as a tuple of their stations, their positions and the variances of those. When a
+        station has several exact fixes, the first one is used.
+        """
+        graph = self.graph
+        fixed = {}
+        soft_stations, soft_positions, soft_variances = [], [], []
+        for station, fix in zip(graph.fix_stations.tolist(), graph.fixes):
+            error = fix.device.position_error()
+            if error is None:
+                fixed.setdefault(station, (fix.x, fix.y, fix.z))
+            else:
+                soft_stations.append(station)
+                soft_positions.append((fix.x, fix.y, fix.z))
+                soft_variances.append(np.maximum(np.square(error), self.MIN_VARIANCE))
+        count, labels = graph.connected_components()
+        self.labels = labels
+        anchored = np.zeros(count, dtype=bool)
+        anchored[labels[np.asarray(list(fixed) + soft_stations, dtype=np.int64)]] = True
+        roots = np.unique(labels, return_index=True)[1]
+        if self.origin is not None and self.origin in graph.station_ids:
+            roots[labels[graph.station_ids[self.origin]]] = graph.station_ids[self.origin]
+        # Components anchored at the origin position, a fix with an error there replaces that anchor.
+        self.origin_anchored = ~anchored
+        for component in np.flatnonzero(~anchored).tolist():
+            fixed[int(roots[component])] = tuple(self.origin_position)
+        soft_fixes = (np.asarray(soft_stations, dtype=np.int64), np.asarray(soft_positions, dtype=float).reshape(-1, 3),
+                      np.asarray(soft_variances, dtype=float).reshape(-1, 3))
+        return (np.fromiter(fixed, dtype=np.int64, count=len(fixed)),
+                np.asarray(list(fixed.values()), dtype=float).reshape(-1, 3), soft_fixes)
+
+    @staticmethod
+    def _solve(shot_from, shot_to, differences, shot_variances, station_count, fixed, fixed_positions, soft_fixes):
+        """Return the N x 3 adjusted positions of the stations, the columns of the unknowns and their factorizations."""
+        positions = np.zeros((station_count, 3))
+        positions[fixed] = fixed_positions
+        unknown = np.ones(station_count, dtype=bool)
+        unknown[fixed] = False
+        columns = np.full(station_count, -1, dtype=np.int64)
+        columns[unknown] = np.arange(np.count_nonzero(unknown))
+        factorizations = []
+        if not unknown.any():
+            return positions, columns, factorizations
+        soft_stations, soft_positions, soft_variances = soft_fixes
+        shot_count = len(shot_from)
+        # The design matrix has a row per shot (-1 for its reference point, +1 for its point) and per fix, the known
+        # positions are moved to the observations.
+        shots = np.arange(shot_count)
+        fixes = shot_count+np.arange(len(soft_stations))
+        rows = np.concatenate((shots, shots, fixes))
+        stations = np.concatenate((shot_to, shot_from, soft_stations))
+        values = np.concatenate((np.ones(shot_count), -np.ones(shot_count), np.ones(len(soft_stations))))
+        selection = unknown[stations]
+        design = csr_matrix((values[selection], (rows[selection], columns[stations[selection]])),
+                            shape=(len(shots)+len(fixes), np.count_nonzero(unknown)))
+        observations = np.concatenate((differences-positions[shot_to]+positions[shot_from],
+                                       soft_positions-positions[soft_stations]))
+        variances = np.concatenate((shot_variances, soft_variances))
+        for axis in range(3):
+            weights = 1.0/variances[:, axis]
+            normal = (design.T @ diags(weights) @ design).tocsc()
+            factorizations.append(_factorize(normal))
+            positions[unknown, axis] = factorizations[axis].solve(design.T @ (weights*observations[:, axis]))
+        return positions, columns, factorizations
+
+    @classmethod
+    def _variances(cls, shot_from, shot_to, shot_variances, station_count, fixed, soft_fixes, shot_resistances=False):
+        """Return the N x 3 variances of the adjusted positions, the diagonal of the inverse of the normal matrix.
+
+        The network is treated as a resistor network with the variances of the observations as resistances, in which
+        the exactly fixed stations are merged into one ground node. The variance of a station is then its effective
+        resistance to the ground. With shot_resistances, the M x 3 effective resistances across the shots (the
+        variances of the adjusted differences of their stations) are returned as well.
+        """
+        ground = station_count
+        nodes = np.arange(ground+1)
+        nodes[fixed] = ground
+        soft_stations, soft_positions, soft_variances = soft_fixes
+        first = np.concatenate((nodes[shot_from], nodes[soft_stations]))
+        second = np.concatenate((nodes[shot_to], np.full(len(soft_stations), ground)))
+        conductances = 1.0/np.concatenate((shot_variances, soft_variances))
+        # Parallel observations are combined by summing their conductances, loops of a single shot are dropped.
+        selection = first != second
+        low = np.minimum(first, second)[selection]
+        high = np.maximum(first, second)[selection]
+        keys, inverse = np.unique(low*(ground+1)+high, return_inverse=True)
+        resistances = np.empty((len(keys), 3))
+        for axis in range(3):
+            resistances[:, axis] = 1.0/np.bincount(inverse, weights=conductances[selection, axis], minlength=len(keys))
+        edges = np.stack((keys // (ground+1), keys % (ground+1)), axis=1)
+        parents, parent_edges, chains = cls._reduce(edges, ground)
+        variances = np.zeros((ground+1, 3))
+        # The edges of the pruned trees are bridges, the effective resistance across them is their own resistance.
+        across = resistances.copy() if shot_resistances else None
+        cls._chain_variances(chains, resistances, variances, ground, across)
+        # Stations of the pruned trees add the resistances of their edges up to their attachment by pointer jumping.
+        offsets = np.zeros((ground+1, 3))
+        pruned = np.flatnonzero(parent_edges >= 0)
+        offsets[pruned] = resistances[parent_edges[pruned]]
+        ancestors = parents
+        while True:
+            next_ancestors = ancestors[ancestors]
+            if np.array_equal(next_ancestors, ancestors):
+                break
+            offsets += offsets[ancestors]
+            ancestors = next_ancestors
+        variances = (offsets+variances[ancestors])[:ground]
+        if not shot_resistances:
+            return variances
+        shot_across = np.zeros((len(first), 3))
+        shot_across[selection] = across[inverse]
+        return variances, shot_across[:len(shot_from)]
+
+    @staticmethod
+    def _reduce(edges, ground):
+        """Return the pruned trees and the traverses of the network with the given (unique, undirected, sorted) edges.
+
+        The trees are returned as the parent node and the edge to it of every node (the node itself and -1 for nodes
+        which are not pruned). The traverses (chains) are returned as the arrays of their first and last junctions,
+        their numbers of edges, their concatenated edges and their concatenated interior nodes, all in order.
+
+        A node is pruned if its subtree in a breadth first spanning tree from the ground has no other edges than those
+        of the tree, counted by pointer jumping. The interior nodes are ordered along their traverses by a depth first
+        search (scipy) from one end of every traverse.
+        """
+        size = ground+1
+        keys = edges[:, 0]*size+edges[:, 1]
+        matrix = csr_matrix((np.ones(2*len(edges), dtype=np.int8), (np.concatenate((edges[:, 0], edges[:, 1])),
+                                                                     np.concatenate((edges[:, 1], edges[:, 0])))),
+                            shape=(size, size))
+        predecessors = breadth_first_order(matrix, ground, directed=False, return_predecessors=True)[1]
+        children = np.flatnonzero(predecessors >= 0)
+        tree_edges = np.full(size, -1, dtype=np.int64)
+        tree_edges[children] = np.searchsorted(keys, np.minimum(children, predecessors[children])*size +
+                                               np.maximum(children, predecessors[children]))
+        other = np.ones(len(edges), dtype=bool)
+        other[tree_edges[children]] = False
+        # The numbers of ends of other edges in the subtrees: after k steps those of the descendants up to 2^k levels
+        # below, the ancestors beyond the roots are a sentinel.
+        counts = np.bincount(edges[other].ravel(), minlength=size+1).astype(np.int64)
+        ancestors = np.full(size+1, size, dtype=np.int64)
+        ancestors[children] = predecessors[children]
+        while np.any(ancestors[:size] != size):
+            counts += np.bincount(ancestors, counts, size+1).astype(np.int64)
+            counts[size] = 0
+            ancestors = ancestors[ancestors]
+        # Nodes which are not reached (the merged fixed stations) and the ground are not pruned.
+        pruned = (counts[:size] == 0) & (predecessors >= 0)
+        parents = np.arange(size)
+        parents[pruned] = predecessors[pruned]
+        parent_edges = np.where(pruned, tree_edges, -1)
+        # The junctions and the two edges and neighbours of every interior node of the remaining network.
+        kept = np.flatnonzero(~pruned[edges[:, 0]] & ~pruned[edges[:, 1]])
+        junction = ~pruned & (np.bincount(edges[kept].ravel(), minlength=size) != 2)
+        junction[ground] = True
+        direct = kept[junction[edges[kept, 0]] & junction[edges[kept, 1]]]
+        nodes = np.concatenate((edges[kept, 0], edges[kept, 1]))
+        neighbours = np.concatenate((edges[kept, 1], edges[kept, 0]))
+        node_edges = np.concatenate((kept, kept))
+        order = np.flatnonzero(~junction[nodes])
+        order = order[np.argsort(nodes[order], kind='stable')]
+        interior = nodes[order[::2]]
+        neighbours, node_edges = neighbours[order].reshape(-1, 2), node_edges[order].reshape(-1, 2)
+        count = len(interior)
+        if count == 0:
+            return (parents, parent_edges, (edges[direct, 0], edges[direct, 1], np.ones(len(direct), dtype=np.int64),
+                                            direct, interior))
+        index = np.full(size, -1, dtype=np.int64)
+        index[interior] = np.arange(count)
+        inner = ~junction[neighbours]
+        rows = np.repeat(np.arange(count), 2)[inner.ravel()]
+        columns = index[neighbours[inner]]
+        # A virtual node (count) is connected to one end of every traverse, its interior nodes are a path.
+        labels = connected_components(csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)),
+                                                 shape=(count, count)), directed=False)[1]
+        ends = np.flatnonzero(~inner.all(axis=1))
+        starts = ends[np.unique(labels[ends], return_index=True)[1]]
+        rows = np.concatenate((rows, np.full(len(starts), count)))
+        columns = np.concatenate((columns, starts))
+        path, predecessors = depth_first_order(
+            csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(count+1, count+1)), count,
+            directed=False, return_predecessors=True)
+        path = path[1:]
+        predecessors = predecessors[path]
+        first = predecessors == count
+        # The edge into every interior node: from a junction at the start, else from the previous interior node.
+        slots = np.where(first, np.argmax(~inner[path], axis=1), np.argmax(
+            neighbours[path] == interior[np.where(first, 0, predecessors)][:, np.newaxis], axis=1))
+        chains = np.cumsum(first)-1
+        last = np.append(first[1:], True)
+        lengths = np.bincount(chains)+1
+        chain_edges = np.empty(count+len(starts), dtype=np.int64)
+        chain_edges[np.arange(count)+chains] = node_edges[path, slots]
+        chain_edges[np.flatnonzero(last)+chains[last]+1] = node_edges[path[last], 1-slots[last]]
+        return parents, parent_edges, (
+            np.concatenate((neighbours[path[first], slots[first]], edges[direct, 0])),
+            np.concatenate((neighbours[path[last], 1-slots[last]], edges[direct, 1])),
+            np.concatenate((lengths, np.ones(len(direct), dtype=np.int64))),
+            np.concatenate((chain_edges, direct)), interior[path])
+
+    @classmethod
+    def _chain_variances(cls, chains, resistances, variances, ground, across=None):
+        """Fill in the variances of the junctions and the interior nodes of the traverses.
+
+        If given, the effective resistances across the edges of the traverses are filled in the array across: an edge
+        is in parallel with the rest of its traverse in series with the rest of the network between its junctions.
+        """
+        first, last, lengths, chain_edges, interior = chains
+        if not len(first):
+            return
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        interior_chains = np.repeat(np.arange(len(first)), lengths-1)
+        # The interior node after the k-th edge of a chain is preceded by k+1 edges.
+        interior_edges = np.arange(len(interior))+interior_chains
+        junctions = np.unique(np.concatenate((first, last)))
+        junctions = junctions[junctions != ground]
+        core = np.full(ground+1, -1, dtype=np.int64)
+        core[junctions] = np.arange(len(junctions))
+        # Only the covariances of the ends of traverses with interior nodes are needed besides the diagonal (and those
+        # of the ends of all traverses for the resistances across their edges).
+        pairs = np.flatnonzero((first != last) & (first != ground) & (last != ground) &
+                               ((lengths > 1) | (across is not None)))
+        all_totals = np.add.reduceat(resistances[chain_edges], starts, axis=0)
+        junction_variances, pair_covariances = cls._junction_covariances(first, last, all_totals, core,
+                                                                         len(junctions), pairs)
+        for axis in range(3):
+            edge_resistances = resistances[chain_edges, axis]
+            cumulative = np.cumsum(edge_resistances)
+            totals = all_totals[:, axis]
+            variances[junctions, axis] = junction_variances[:, axis]
+            position = cumulative[interior_edges]-(cumulative[starts]-edge_resistances[starts])[interior_chains]
+            total = totals[interior_chains]
+            fraction = position/total
+            first_variance = variances[first, axis][interior_chains]
+            last_variance = variances[last, axis][interior_chains]
+            pair_covariance = np.where(first == last, variances[first, axis], 0.0)
+            pair_covariance[pairs] = pair_covariances[:, axis]
+            variances[interior, axis] = ((1-fraction)**2*first_variance+fraction**2*last_variance +
+                                         2*fraction*(1-fraction)*pair_covariance[interior_chains] +
+                                         position*(total-position)/total)
+            if across is not None:
+                # The effective resistance between the junctions without the traverse: zero for traverses which loop
+                # back to their junction and infinite for bridges.
+                network = variances[first, axis]+variances[last, axis]-2*pair_covariance
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    rest = np.where(first == last, 0.0, 1.0/np.maximum(1.0/network-1.0/totals, 0.0))
+                    rest, total = np.repeat(rest, lengths), np.repeat(totals, lengths)
+                    across[chain_edges, axis] = np.where(np.isinf(rest), edge_resistances, edge_resistances *
+                                                         (total-edge_resistances+rest)/(total+rest))
+
+    @staticmethod
+    def _junction_covariances(first, last, totals, core, size, pairs):
+        """Return the N x 3 variances of the junctions and the covariances of the ends of the given traverses.
+
+        The traverses are equivalent to single edges with their total resistances, the covariance of the junctions is
+        the inverse of the Laplacian of these edges grounded at the ground node. The Laplacians of the three axes have
+        the same pattern, they are factorized in the same order and inverted in one selected inversion.
+        """
+        if size == 0:
+            return np.zeros((0, 3)), np.zeros((len(pairs), 3))
+        selection = first != last
+        conductances = 1.0/totals[selection]
+        ends = np.stack((core[first[selection]], core[last[selection]]), axis=1)
+        inner = (ends >= 0).all(axis=1)
+        rows = np.concatenate((ends[inner, 0], ends[inner, 1], ends[ends[:, 0] >= 0, 0], ends[ends[:, 1] >= 0, 1]))
+        columns = np.concatenate((ends[inner, 1], ends[inner, 0], ends[ends[:, 0] >= 0, 0], ends[ends[:, 1] >= 0, 1]))
+        values = np.concatenate((-conductances[inner], -conductances[inner], conductances[ends[:, 0] >= 0],
+                                 conductances[ends[:, 1] >= 0]))
+        factorizations = [_factorize(coo_matrix((values[:, 0], (rows, columns)), shape=(size, size)))]
+        order = factorizations[0].perm_c
+        for axis in (1, 2):
+            factorizations.append(_factorize(coo_matrix((values[:, axis], (rows, columns)), shape=(size, size)), order))
+        factors = [_lower_factor(factorization) for factorization in factorizations]
+        orders = [order]+[factorization.perm_c[order] for factorization in factorizations[1:]]
+        shared = all(np.array_equal(orders[0], other_order) and np.array_equal(factors[0][0], factor[0]) and
+                     np.array_equal(factors[0][1], factor[1]) for other_order, factor in zip(orders[1:], factors[1:]))
+        diagonal = np.empty((size, 3))
+        pair_covariances = np.empty((len(pairs), 3))
+        for axes in ([0, 1, 2],) if shared else ([0], [1], [2]):
+            indptr, indices = factors[axes[0]][:2]
+            axis_diagonal, inverse = _selected_inverse(indptr, indices,
+                                                       np.stack([factors[axis][2] for axis in axes], axis=1),
+                                                       np.stack([factors[axis][3] for axis in axes], axis=1))
+            order = orders[axes[0]]
+            diagonal[:, axes] = axis_diagonal[order]
+            pair_first, pair_last = order[core[first[pairs]]], order[core[last[pairs]]]
+            keys = np.repeat(np.arange(size), np.diff(indptr))*size+indices
+            pair_covariances[:, axes] = inverse[np.searchsorted(keys, np.minimum(pair_first, pair_last)*size +
+                                                                np.maximum(pair_first, pair_last))]
+        return diagonal, pair_covariances
+
+    def measurement_changed(self, event, measurement, old=None):
+        """Update the TopoPoints after a measurement is added or edited.
+
+        A shot to a new station makes it a pendant: its position is that of the other station plus the shot and its
+        variance that of the other station plus the variance of the shot. Shots between stations of the same
+        component, fixes with errors and edits of shots are added to (or removed from) the normal equations as
+        observations with a positive (or negative) weight, which are solved with the previous factorization, edits
+        which only change the remarks or the group change nothing. Other changes, changes involving pendants, fixes in
+        components anchored at the origin position and more than MAX_UPDATES observations are recalculated.
+        """
+        graph = self.graph
+        size = len(self._columns)
+        if isinstance(measurement, RelativeMeasurement):
+            ends = [graph.station_ids.get(name) for name in (measurement.refpoint, measurement.point)]
+            difference = calculate_differences([measurement])[0]
+            variance = self._shot_variances([measurement], difference[np.newaxis])[0]
+            if event == 'add' and ends.count(None) == 1:
+                shot = graph.add_shot(measurement, difference)
+                self.shot_variances = np.concatenate((self.shot_variances, [variance]))
+                parent = ends[1] if ends[0] is None else ends[0]
+                self.pendants.append((graph.station_count-1, parent, shot, 1 if ends[0] == parent else -1))
+                self.labels = np.append(self.labels, self.labels[parent])
+                self.positions = np.concatenate((self.positions, np.zeros((1, 3))))
+                self.variances = np.concatenate((self.variances, np.zeros((1, 3))))
+                self._update_pendants()
+                return
+            if event == 'add' and None not in ends and max(ends) < size and self.labels[ends[0]] == self.labels[ends[1]]:
+                graph.add_shot(measurement, difference)
+                self.shot_variances = np.concatenate((self.shot_variances, [variance]))
+                self._update(((ends[1], ends[0], difference, 1.0/variance),))
+                return
+            if (event == 'edit' and [graph.station_ids.get(old.refpoint), graph.station_ids.get(old.point)] == ends and
+                    None not in ends):
+                shot = graph.shot_index(measurement)
+                old_difference, old_variance = graph.differences[shot].copy(), self.shot_variances[shot].copy()
+                graph.set_shot(shot, measurement, difference)
+                self.shot_variances[shot] = variance
+                if np.array_equal(old_difference, difference) and np.array_equal(old_variance, variance):
+                    # Only the remarks or the group changed.
+                    return
+                if max(ends) >= size:
+                    self._update_pendants()
+                else:
+                    # The new shot is added before the old one is removed, so the normal matrix stays regular.
+                    self._update(((ends[1], ends[0], difference, 1.0/variance),
+                                  (ends[1], ends[0], old_difference, -1.0/old_variance)))
+                return
+        elif event == 'add' and measurement.device.position_error() is not None:
+            station = graph.station_ids.get(measurement.point)
+            if station is not None and station < size and not self.origin_anchored[self.labels[station]]:
+                graph.add_fix(measurement)
+                variance = np.maximum(np.square(measurement.device.position_error()), self.MIN_VARIANCE)
+                self.soft_fixes = tuple(np.concatenate((array, [value])) for array, value in
+                                        zip(self.soft_fixes, (station, (measurement.x, measurement.y, measurement.z),
+                                                              variance)))
+                self._update(((station, -1, np.array((measurement.x, measurement.y, measurement.z)), 1.0/variance),))
+                return
+        self._recalculate()
+
+    def _update(self, observations):
+        """Add observations, given as (station, other station or -1, observation, weights), to the normal equations.
+
+        Every observation is a rank one update of the inverse of the normal matrix (the Sherman-Morrison formula): with
+        r its row of the design matrix, w its weight and u = N^-1 r, the new inverse is N^-1 - u u^T / (1/w + r^T u).
+        The vectors u of earlier updates are kept, so u is calculated with the previous factorization.
+        """
+        if self._update_count+len(observations) > self.MAX_UPDATES:
+            self._recalculate()
+            return
+        unknowns = np.flatnonzero(self._columns >= 0)
+        if self._update_vectors is None:
+            self._update_vectors = np.empty((3, self.MAX_UPDATES, len(unknowns)))
+        for station, other, observation, weights in observations:
+            columns = (self._columns[station], -1 if other < 0 else self._columns[other])
+            if columns[0] == columns[1]:
+                continue
+            row = np.zeros(len(unknowns))
+            # The known positions of exactly fixed stations are moved to the observation.
+            observation = observation-self.positions[station]*(columns[0] < 0)
+            for column, sign in zip(columns, (1.0, -1.0)):
+                if column >= 0:
+                    row[column] += sign
+            if other >= 0:
+                observation = observation+self.positions[other]*(columns[1] < 0)
+            vectors = self._update_vectors[:, :self._update_count]
+            for axis in range(3):
+                vector = self._factorizations[axis].solve(row)
+                if self._update_count:
+                    vector -= (self._update_scales[axis, :self._update_count] *
+                               vectors[axis].dot(row)).dot(vectors[axis])
+                scale = 1.0/(1.0/weights[axis]+row.dot(vector))
+                solution = self.positions[unknowns, axis]
+                self.positions[unknowns, axis] = solution+vector*scale*(observation[axis]-row.dot(solution))
+                self.variances[unknowns, axis] -= scale*vector**2
+                self._update_vectors[axis, self._update_count] = vector
+                self._update_scales[axis, self._update_count] = scale
+            self._update_count += 1
+        self._update_pendants()
+
+    def _update_pendants(self):
+        """Calculate the positions and variances of the pendants from their parents and the residuals."""
+        for station, parent, shot, sign in self.pendants:
+            self.positions[station] = self.positions[parent]+sign*self.graph.differences[shot]
+            self.variances[station] = self.variances[parent]+self.shot_variances[shot]
+        self._update_residuals()
+
+    def shot_redundancies(self):
+        """Return the N x 3 redundancy numbers of the x, y and z of the shots.
+
+        The redundancy number of an observation is the part of its variance which is not explained by the other
+        observations, 1 minus the variance of its adjusted value (the effective resistance across the shot) relative
+        to its own variance. It is 0 for shots which are not checked by any other observation.
+        """
+        graph = self.graph
+        across = self._variances(graph.shot_from, graph.shot_to, self.shot_variances, graph.station_count, self.fixed,
+                                 self.soft_fixes, shot_resistances=True)[1]
+        return np.clip(1.0-across/self.shot_variances, 0.0, 1.0)
+
+    def get_topo_points(self):
+        """Return a dict mapping the station names on the adjusted topo points, with the std of their positions."""
+        if self._topo_points is None:
+            errors = np.sqrt(self.variances).tolist()
+            self._topo_points = {name: TopoPoint(name, Point(x, y, z, *error))
+                                 for name, (x, y, z), error in zip(self.graph.stations, self.positions.tolist(), errors)}
+        return self._topo_points
+
+
+class AdjustmentAlgorithmTest(unittest.TestCase):
+
+    def create_network(self):
+        from data.dataset import Dataset
+        datasets = {}
+        cave = Dataset(datasets, 'cave')
+        cave.add_device('DCIDevice', 'compass', distance_error=0.02, compass_error=1.5, inclination_error=1.0)
+        cave.add_device('GPS', 'exact')
+        cave.add_device('GPS', 'gps', error=0.5, vertical_error=2.0)
+        cave.add_measurement(None, 'entrance', 'exact', point='a', x=0.0, y=0.0, z=0.0)
+        cave.add_measurement(None, 'sink', 'gps', point='k', x=31.0, y=-9.0, z=-12.0)
+        branch = Dataset(datasets, 'branch', parent='cave', columnar=True)
+        generator = np.random.RandomState(1)
+        # A loop with a traverse, a pendant tree, a second loop hanging from a single junction, a traverse to a soft
+        # fix, parallel shots and a separate component without fixes.
+        shots = ['ab', 'bc', 'cd', 'da', 'ce', 'ef', 'eg', 'bh', 'hi', 'ij', 'jh', 'dk', 'kl', 'lk', 'ck', 'xy', 'yz',
+                 'zx', 'zw', 'bc']
+        for index, (refpoint, point) in enumerate(shots):
+            dataset = (cave, branch)[index % 2]
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint,
+                                    distance=generator.uniform(2.0, 20.0), compass=generator.uniform(0.0, 360.0),
+                                    inclination=generator.uniform(-45.0, 45.0))
+        return cave
+
+    def test_adjustment(self):
+        algorithm = AdjustmentAlgorithm(self.create_network(), origin='y', origin_position=(5.0, 6.0, 7.0))
+        graph = algorithm.graph
+        # The dense reference: the inverse of the normal matrix over all unknown stations.
+        unknown = np.ones(graph.station_count, dtype=bool)
+        unknown[algorithm.fixed] = False
+        columns = np.cumsum(unknown)-1
+        soft_stations, soft_positions, soft_variances = algorithm.soft_fixes
+        rows = len(graph.shot_from)+len(soft_stations)
+        design = np.zeros((rows, graph.station_count))
+        design[np.arange(graph.shot_count), graph.shot_to] += 1
+        design[np.arange(graph.shot_count), graph.shot_from] -= 1
+        design[graph.shot_count+np.arange(len(soft_stations)), soft_stations] = 1
+        known = np.zeros((graph.station_count, 3))
+        known[algorithm.fixed] = algorithm.fixed_positions
+        observations = np.concatenate((graph.differences, soft_positions))-design.dot(known)
+        variances = np.concatenate((algorithm.shot_variances, soft_variances))
+        for axis in range(3):
+            weighted = design[:, unknown]/variances[:, axis, np.newaxis]
+            inverse = np.linalg.inv(design[:, unknown].T.dot(weighted))
+            expected = inverse.dot(weighted.T.dot(observations[:, axis]))
+            self.assertTrue(np.allclose(expected, algorithm.positions[unknown, axis], rtol=0, atol=1e-8))
+            self.assertTrue(np.allclose(np.diag(inverse), algorithm.variances[unknown, axis], rtol=1e-9, atol=1e-12))
+        self.assertTrue(np.all(algorithm.variances[algorithm.fixed] == 0))
+        self.assertEqual((5.0, 6.0, 7.0), algorithm.get_topo_points()['y'].p.xyz())
+        self.assertAlmostEqual(np.sqrt(algorithm.variances[graph.station_ids['f'], 2]),
+                               algorithm.get_topo_points()['f'].p.error_z, 12)
+        self.assertTrue(np.allclose(algorithm.positions[graph.shot_to]-algorithm.positions[graph.shot_from],
+                                    graph.differences+algorithm.residuals, rtol=0, atol=1e-12))
+
+    def test_incremental(self):
+        cave = self.create_network()
+        branch = cave.children['branch']
+        algorithm = AdjustmentAlgorithm(cave, origin='y', incremental=True)
+        graph = algorithm.graph
+        changes = (
+            lambda: branch.add_measurement(None, 'leaf', 'compass', point='m', refpoint='f', distance=4.0,
+                                           compass=10.0, inclination=5.0),
+            lambda: cave.add_measurement(None, 'leaf 2', 'compass', point='m', refpoint='n', distance=3.0,
+                                         compass=100.0, inclination=-5.0),
+            lambda: cave.add_measurement(None, 'loop', 'compass', point='j', refpoint='g', distance=12.0,
+                                         compass=200.0, inclination=3.0),
+            lambda: cave.add_measurement(None, 'gps 2', 'gps', point='d', x=10.0, y=20.0, z=-5.0),
+            lambda: cave.edit_measurement('2', compass=123.0),
+            lambda: branch.edit_measurement('leaf', distance=5.0),
+            lambda: branch.edit_measurement('17', compass=17.0),
+        )
+        for change in changes:
+            change()
+            self.assertIs(graph, algorithm.graph)
+            expected = AdjustmentAlgorithm(cave, origin='y')
+            order = [algorithm.graph.station_ids[name] for name in expected.graph.stations]
+            self.assertTrue(np.allclose(expected.positions, algorithm.positions[order], rtol=0, atol=1e-8))
+            self.assertTrue(np.allclose(expected.variances, algorithm.variances[order], rtol=1e-8, atol=1e-12))
+        self.assertEqual(2, len(algorithm.pendants))
+        cave.add_measurement(None, 'loop 2', 'compass', point='m', refpoint='a', distance=1.0, compass=0.0,
+                             inclination=0.0)
+        self.assertIsNot(graph, algorithm.graph)
+        self.assertEqual([], algorithm.pendants)
+        # A fix with an error in the component anchored at the origin position replaces that anchor.
+        cave.add_measurement(None, 'gps 3', 'gps', point='x', x=100.0, y=100.0, z=100.0)
+        expected = AdjustmentAlgorithm(cave, origin='y')
+        order = [algorithm.graph.station_ids[name] for name in expected.graph.stations]
+        self.assertTrue(np.allclose(expected.positions, algorithm.positions[order], rtol=0, atol=1e-8))
+        self.assertTrue(np.allclose(expected.variances, algorithm.variances[order], rtol=1e-8, atol=1e-12))
+        self.assertGreater(np.linalg.norm(algorithm.positions[algorithm.graph.station_ids['y']]), 50.0)
+
+    def test_workers(self):
+        class GroupedAlgorithm(AdjustmentAlgorithm):
+            GROUP_SIZE = 4
+
+        cave = self.create_network()
+        serial = GroupedAlgorithm(cave, origin='y')
+        parallel = GroupedAlgorithm(cave, origin='y', workers=2)
+        single = AdjustmentAlgorithm(cave, origin='y')
+        self.assertEqual(2, len(np.unique(serial._component_groups(serial.labels))))
+        self.assertTrue(np.array_equal(serial.positions, parallel.positions))
+        self.assertTrue(np.array_equal(serial.variances, parallel.variances))
+        self.assertTrue(np.allclose(single.positions, parallel.positions, rtol=0, atol=1e-8))
+        self.assertTrue(np.allclose(single.variances, parallel.variances, rtol=1e-9, atol=1e-12))
+
+    def test_loop_closure(self):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'loop', columnar=True)
+        dataset.add_device('DCIDevice', 'compass', distance_error=0.01, compass_error=0.0, inclination_error=0.0)
+        dataset.add_device('GPS', 'gps')
+        dataset.add_measurement(None, 'fix', 'gps', point=0, x=0.0, y=0.0, z=0.0)
+        # A square of 10 meter with 0.2 meter misclosure in y, spread equally over the two north-south shots (up to the
+        # minimum variance of the y of the east-west shots).
+        for index, (compass, distance) in enumerate(((0.0, 10.2), (90.0, 10.0), (180.0, 10.0), (270.0, 10.0))):
+            dataset.add_measurement(None, str(index), 'compass', point=(index+1) % 4, refpoint=index,
+                                    distance=distance, compass=compass, inclination=0.0)
+        algorithm = AdjustmentAlgorithm(dataset)
+        expected = {0: (0.0, 0.0), 1: (0.0, 10.1), 2: (10.0, 10.1), 3: (10.0, 0.0)}
+        for station, position in expected.items():
+            self.assertTrue(np.allclose(position, algorithm.positions[algorithm.graph.station_ids[station], :2],
+                                        rtol=0, atol=1e-4))
+
+    def test_grid(self):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'grid', columnar=True)
+        dataset.add_device('DCIDevice', 'compass', distance_error=0.02, compass_error=1.5, inclination_error=1.0)
+        dataset.add_device('GPS', 'gps')
+        dataset.add_measurement(None, 'fix', 'gps', point=(0, 0), x=0.0, y=0.0, z=0.0)
+        generator = np.random.RandomState(2)
+        # A grid of junctions, every other leg of it a traverse of two shots, and a dead end from its far corner.
+        for row in range(8):
+            for column in range(8):
+                for index, end in enumerate(((row, column+1), (row+1, column))):
+                    if max(end) == 8:
+                        continue
+                    legs = [((row, column), end)]
+                    if (row+column) % 2:
+                        legs = [((row, column), (row, column, index)), ((row, column, index), end)]
+                    for refpoint, point in legs:
+                        dataset.add_measurement(None, str((refpoint, point)), 'compass', point=point,
+                                                refpoint=refpoint, distance=generator.uniform(2.0, 20.0),
+                                                compass=generator.uniform(0.0, 360.0),
+                                                inclination=generator.uniform(-45.0, 45.0))
+        dataset.add_measurement(None, 'dead end', 'compass', point='end', refpoint=(7, 7), distance=5.0,
+                                compass=0.0, inclination=0.0)
+        algorithm = AdjustmentAlgorithm(dataset)
+        graph = algorithm.graph
+        unknown = np.ones(graph.station_count, dtype=bool)
+        unknown[algorithm.fixed] = False
+        design = np.zeros((graph.shot_count, graph.station_count))
+        design[np.arange(graph.shot_count), graph.shot_to] += 1
+        design[np.arange(graph.shot_count), graph.shot_from] -= 1
+        design = design[:, unknown]
+        redundancies = algorithm.shot_redundancies()
+        for axis in range(3):
+            inverse = np.linalg.inv(design.T.dot(design/algorithm.shot_variances[:, axis, np.newaxis]))
+            self.assertTrue(np.allclose(np.diag(inverse), algorithm.variances[unknown, axis], rtol=1e-9, atol=1e-12))
+            across = np.einsum('ij,jk,ik->i', design, inverse, design)
+            self.assertTrue(np.allclose(1.0-across/algorithm.shot_variances[:, axis], redundancies[:, axis],
+                                        rtol=0, atol=1e-9))
+        self.assertAlmostEqual(0.0, redundancies[graph.shot_index(dataset.get_measurement('dead end'))].max(), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
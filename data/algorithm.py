@@ -5,19 +5,127 @@ The Algorithm class of this module is an abstract implementation of a class used
 copyright (C) 2016 Bram Rooseleer
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from data.survey_graph import SurveyGraph
+
+
+def _share(arrays):
+    """Return a block of shared memory holding copies of the given dict of arrays and the spec to attach to it."""
+    spec, size = [], 0
+    for name, array in arrays.items():
+        spec.append((name, array.dtype.str, array.shape, size))
+        # Every array starts at a multiple of 8 bytes.
+        size += -(-array.nbytes // 8)*8
+    memory = SharedMemory(create=True, size=max(size, 1))
+    for view, array in zip(_views(memory, spec).values(), arrays.values()):
+        view[...] = array
+    return memory, (memory.name, spec)
+
+
+def _views(memory, spec):
+    """Return a dict of views of the arrays of the given spec in a block of shared memory."""
+    return {name: np.ndarray(shape, dtype, memory.buf, offset) for name, dtype, shape, offset in spec}
+
+
+def _run_group(function, spec, group):
+    """Run the function of a group of components on the shared arrays of the given spec, in a worker process."""
+    name, arrays = spec
+    memory = SharedMemory(name)
+    try:
+        function(_views(memory, arrays), *group)
+    finally:
+        memory.close()
+
 
 class Algorithm:
     """An abstract algorithm to interprete measurement data and create the resulting TopoPoints."""
 
-    def __init__(self, dataset):
-        """Create an algorithm with the dataset of which it should be executed."""
+    GROUP_SIZE = 10000
+    """The number of stations from which consecutive components are solved as a separate group."""
+
+    CACHE_PARAMETERS = ()
+    """The names of the attributes the results depend on besides the dataset, part of the keys of a ResultCache."""
+
+    def __init__(self, dataset, incremental=False, workers=None, cache=None):
+        """Create an algorithm with the dataset of which it should be executed.
+
+        With incremental, the algorithm listens to changes of the measurements of the dataset (and its descendants) and
+        updates the TopoPoints after every change. With workers, independent groups of components are calculated by
+        that number of processes. With a ResultCache, the positions and TopoPoints of a dataset of which the content
+        was calculated before with the same parameters are restored instead of recalculated (the other results of the
+        algorithm are then not available). Incremental algorithms need all their results and are not cached.
+        """
+        key = None if cache is None or incremental else cache.key(self, dataset)
         self.dataset = dataset
+        self.incremental = incremental
+        self.workers = workers
+        if key is None or not cache.load(key, self):
+            self._recalculate()
+            if key is not None:
+                cache.store(key, self)
+        if incremental:
+            dataset.add_listener(self.measurement_changed)
+
+    def detach(self):
+        """Stop listening to changes of the dataset."""
+        self.dataset.remove_listener(self.measurement_changed)
+
+    def measurement_changed(self, event, measurement, old=None):
+        """Update the TopoPoints after a measurement is added or edited.
+
+        Implementations override this to update only what is affected, by default everything is recalculated.
+        """
         self._recalculate()
 
+    @property
+    def graph(self):
+        """Return the SurveyGraph of the dataset (and its descendants), build it if needed."""
+        try:
+            return self._graph
+        except AttributeError:
+            self._graph = SurveyGraph.from_dataset(self.dataset)
+            return self._graph
+
+    def _component_groups(self, labels):
+        """Return the group of every station, consecutive components are grouped until they have GROUP_SIZE stations.
+
+        The groups only depend on the components, not on the number of workers, so every number of workers gives the
+        same result.
+        """
+        sizes = np.bincount(labels)
+        # A component starts a new group when the stations before it pass a multiple of GROUP_SIZE.
+        before = np.cumsum(sizes)-sizes
+        groups = np.unique(before // self.GROUP_SIZE, return_inverse=True)[1]
+        return groups[labels]
+
+    def _run_groups(self, function, arrays, groups):
+        """Call function(arrays, *group) for every group and return the arrays.
+
+        Without workers (or with a single group) the function is called in this process. Otherwise the arrays are
+        copied to shared memory once, the groups are divided over a pool of worker processes which write their results
+        to the shared arrays, and the results are copied back. Only the name of the shared memory and the groups are
+        pickled, so the groups should be given as slices of the arrays.
+        """
+        if not self.workers or self.workers == 1 or len(groups) < 2:
+            for group in groups:
+                function(arrays, *group)
+            return arrays
+        memory, spec = _share(arrays)
+        try:
+            with ProcessPoolExecutor(self.workers) as executor:
+                for future in [executor.submit(_run_group, function, spec, group) for group in groups]:
+                    future.result()
+            return {name: array.copy() for name, array in _views(memory, spec[1]).items()}
+        finally:
+            memory.close()
+            memory.unlink()
+
     def _recalculate(self):
         """Recalculate the TopoPoints."""
         raise NotImplementedError()
 
     def get_topo_points(self):
         """Return the calculated topo points."""
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
@@ -0,0 +1,148 @@
+""" ArboTopo - data: blunder report
+
+The BlunderReport of this module tests every shot of an AdjustmentAlgorithm for blunders (data snooping).
+
+The residual of a shot is only a part of its error: the other observations absorb the rest. That part is the
+redundancy number r of the shot, 1 minus the variance of its adjusted value relative to its own variance. The
+redundancy numbers follow from the effective resistances across the shots in the same reduction of the network as
+the variances of the stations, so the statistics of all shots take about one adjustment, without solving the network
+again without every shot.
+
+Per coordinate, with v the residual and s the std of a shot:
+-the standardized residual is v / (s sqrt(r)), which is normally distributed if the shot has no blunder
+-the misclosure without the shot, the adjusted difference of its stations without it minus the shot, is v / r
+-the influence of the shot, the change of the adjusted difference of its stations by including it, is -v (1-r) / r
+
+Shots with a redundancy number of (almost) 0 are not checked by other observations, blunders in them can not be
+detected.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+
+
+class BlunderReport:
+    """The statistics of the shots of an AdjustmentAlgorithm to detect blunders.
+
+    The shots are indexed as in the survey graph of the algorithm. For every shot the report has the N x 3 residuals,
+    redundancies, standardized residuals, misclosures and influences (see above), the statistics (the largest absolute
+    standardized residual of the shot) and whether it is detectable.
+    """
+
+    CRITICAL_VALUE = 3.29
+    """The critical value of the standardized residuals, for a significance of 0.1% (Baarda's data snooping)."""
+
+    MIN_REDUNDANCY = 1e-9
+    """The redundancy number below which the errors of a shot are not detectable."""
+
+    def __init__(self, algorithm):
+        """Create the report of the shots of the given AdjustmentAlgorithm."""
+        self.algorithm = algorithm
+        self.residuals = algorithm.residuals
+        self.redundancies = algorithm.shot_redundancies()
+        checked = self.redundancies > self.MIN_REDUNDANCY
+        redundancies = np.where(checked, self.redundancies, 1.0)
+        self.standardized = np.where(checked, self.residuals/np.sqrt(algorithm.shot_variances*redundancies), 0.0)
+        self.misclosures = np.where(checked, self.residuals/redundancies, 0.0)
+        self.influences = np.where(checked, -self.residuals*(1-redundancies)/redundancies, 0.0)
+        self.statistics = np.abs(self.standardized).max(axis=1) if len(self.standardized) else np.zeros(0)
+        self.detectable = checked.any(axis=1)
+
+    def __len__(self):
+        """Return the number of shots."""
+        return len(self.residuals)
+
+    def order(self, descending=True):
+        """Return the indices of the shots sorted by their statistics."""
+        order = np.argsort(self.statistics, kind='stable')
+        return order[::-1] if descending else order
+
+    def suspects(self, critical=CRITICAL_VALUE):
+        """Return the indices of the shots of which the statistic exceeds the critical value, the largest first."""
+        order = self.order()
+        return order[self.statistics[order] > critical]
+
+    def rows(self, order=None):
+        """Return a list of (measurement, statistic, misclosure, redundancies) for the shots in the given order."""
+        if order is None:
+            order = self.order()
+        measurements = self.algorithm.graph.measurements
+        return [(measurements[shot], statistic, tuple(misclosure), tuple(redundancy)) for shot, statistic, misclosure,
+                redundancy in zip(order.tolist(), self.statistics[order].tolist(), self.misclosures[order].tolist(),
+                                  self.redundancies[order].tolist())]
+
+    def flag(self, critical=CRITICAL_VALUE, remark='suspected blunder'):
+        """Add a remark to the measurements of the suspected shots and return those measurements.
+
+        The remarks are changed through their datasets, so listeners are notified of the edits. The measurements of the
+        survey graph may be outdated by earlier edits, so the remarks are read from the datasets.
+        """
+        measurements = [self.algorithm.graph.measurements[shot] for shot in self.suspects(critical).tolist()]
+        flagged = []
+        for measurement in measurements:
+            current = measurement.dataset.get_measurement(measurement.name).remarks
+            remarks = remark if not current else '{0}; {1}'.format(current, remark)
+            measurement.dataset.edit_measurement(measurement.name, remarks=remarks)
+            flagged.append(measurement.dataset.get_measurement(measurement.name))
+        return flagged
+
+
+class BlunderReportTest(unittest.TestCase):
+
+    def create_grid(self, blunder, columnar=True):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'grid', columnar=columnar)
+        dataset.add_device('DCIDevice', 'compass', distance_error=0.02, compass_error=1.0, inclination_error=1.0)
+        dataset.add_device('GPS', 'gps')
+        dataset.add_measurement(None, 'fix', 'gps', point=(0, 0), x=0.0, y=0.0, z=0.0)
+        # A grid of 4 x 4 stations 10 meter apart, a pendant and a blunder in the compass of one shot.
+        shots = [((row, column), (row, column+1), 90.0) for row in range(4) for column in range(3)] + \
+            [((row, column), (row+1, column), 0.0) for row in range(3) for column in range(4)] + \
+            [((3, 3), 'pendant', 90.0)]
+        for index, (refpoint, point, compass) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=10.0,
+                                    compass=compass+(blunder if index == 17 else 0.0), inclination=0.0)
+        return dataset
+
+    def test_report(self):
+        from data.adjustment_algorithm import AdjustmentAlgorithm
+        algorithm = AdjustmentAlgorithm(self.create_grid(6.0))
+        report = BlunderReport(algorithm)
+        graph = algorithm.graph
+        shot = graph.shot_index(graph.measurements[17])
+        self.assertEqual([shot], report.suspects().tolist())
+        self.assertFalse(report.detectable[graph.shot_index(graph.measurements[24])])
+        # Compare the misclosure and the influence with an adjustment without the shot.
+        unknown = np.ones(graph.station_count, dtype=bool)
+        unknown[algorithm.fixed] = False
+        design = np.zeros((graph.shot_count, graph.station_count))
+        design[np.arange(graph.shot_count), graph.shot_to] += 1
+        design[np.arange(graph.shot_count), graph.shot_from] -= 1
+        others = np.arange(graph.shot_count) != shot
+        for axis in range(3):
+            weighted = design[others][:, unknown]/algorithm.shot_variances[others, axis, np.newaxis]
+            solution = np.linalg.solve(design[others][:, unknown].T.dot(weighted),
+                                       weighted.T.dot(graph.differences[others, axis]))
+            adjusted = design[shot, unknown].dot(solution)
+            self.assertAlmostEqual(adjusted-graph.differences[shot, axis], report.misclosures[shot, axis], 9)
+            self.assertAlmostEqual(algorithm.positions[graph.shot_to[shot], axis] -
+                                   algorithm.positions[graph.shot_from[shot], axis]-adjusted,
+                                   report.influences[shot, axis], 9)
+        self.assertAlmostEqual(report.statistics[shot], report.rows()[0][1])
+        flagged = report.flag()
+        self.assertEqual(['suspected blunder'], [measurement.remarks for measurement in flagged])
+        self.assertEqual(0, len(BlunderReport(AdjustmentAlgorithm(self.create_grid(0.0))).suspects()))
+
+    def test_flag_twice(self):
+        from data.adjustment_algorithm import AdjustmentAlgorithm
+        for columnar in (True, False):
+            report = BlunderReport(AdjustmentAlgorithm(self.create_grid(6.0, columnar)))
+            report.flag()
+            flagged = report.flag(remark='checked')
+            self.assertEqual(['suspected blunder; checked'], [measurement.remarks for measurement in flagged])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,21 +5,27 @@ This class represents a set of measurements and associated data.
 copyright (C) 2016 Bram Rooseleer
 """
 
+import numpy as np
 from data.storable import Storable
 from data.exceptions import NoSuchDeviceException, NoSuchMeasurementException
-from data.device import Device
-from data.measurement import Measurement
+from data.device import Device, calculate_differences
+from data.measurement import Measurement, RelativeMeasurement
+from data.measurement_table import MeasurementTable
 
 class Dataset(Storable):
     """A set of measurements."""
 
-    def __init__(self, datasets, name, parent=None, remarks=None):
-        """Create a dataset."""
+    def __init__(self, datasets, name, parent=None, remarks=None, columnar=False):
+        """Create a dataset.
+
+        With columnar, the measurements are stored in a MeasurementTable instead of a dict of Measurement objects.
+        """
         self.name = name
         self.remarks = remarks
         self.children = {}
         self.devices = {}
-        self.measurements = {}
+        self.measurements = MeasurementTable(self) if columnar else {}
+        self.listeners = []
         if name not in datasets:
             datasets[name] = self
         else:
@@ -55,31 +61,100 @@ class Dataset(Storable):
         if name in self.measurements:
             raise Exception("Measurement with name '{name}' already exists in dataset '{dataset}'.".format(name=name, dataset=self.name))
         device = self.get_device(device)
-        self.measurements[name] = Measurement.create_measurement(type, name=name, device=device, **kwargs)
+        if isinstance(self.measurements, MeasurementTable):
+            self.measurements.add(device, name=name, **kwargs)
+        else:
+            self.measurements[name] = Measurement.create_measurement(device=device, dataset=self, name=name, **kwargs)
+        self._notify('add', name)
+
+    def edit_measurement(self, name, device=None, **kwargs):
+        """Change the given fields of the measurement with the given name, the other fields are kept."""
+        old = self.get_measurement(name)
+        fields = {'point': old.point}
+        if isinstance(old, RelativeMeasurement):
+            fields['refpoint'] = old.refpoint
+        for field in ('group', 'remarks'):
+            if getattr(old, field) is not None:
+                fields[field] = getattr(old, field)
+        fields.update(old.data)
+        if isinstance(self.measurements, MeasurementTable):
+            # The view would show the new fields, so the listeners get a copy of the old measurement.
+            old = Measurement.create_measurement(device=old.device, dataset=self, name=name, **fields)
+        new_fields = dict(fields, **kwargs)
+        device = old.device if device is None else self.get_device(device)
+        if isinstance(self.measurements, MeasurementTable):
+            self.measurements.set(device, name=name, **new_fields)
+        else:
+            self.measurements[name] = Measurement.create_measurement(device=device, dataset=self, name=name,
+                                                                     **new_fields)
+        self._notify('edit', name, old)
+
+    def add_listener(self, listener):
+        """Register a function which is called on changes of the measurements of this dataset and its descendants.
+
+        The listener is called with the event ('add' or 'edit'), the new measurement and, for edits, the old one.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a listener."""
+        self.listeners.remove(listener)
+
+    def _notify(self, event, name, old=None):
+        """Call the listeners of this dataset and its ancestors."""
+        dataset = self
+        while dataset is not None:
+            if dataset.listeners:
+                measurement = self.get_measurement(name)
+                for listener in list(dataset.listeners):
+                    listener(event, measurement, old)
+            dataset = getattr(dataset, 'parent', None)
 
     def get_device(self, name):
         """Return the device with the given name. If is does not exist in self, look in parents."""
         if name in self.devices:
             return self.devices[name]
         elif self.parent is not None:
-            return self.parent.get_device(name)
-        else:
-            raise Exception("No device '{name}' found in dataset {'dataset'}.".format(name=name, dataset=self.name))
+            try:
+                return self.parent.get_device(name)
+            except NoSuchDeviceException:
+                pass
+        raise NoSuchDeviceException(device=name, dataset=self.name)
 
-    def get_device(self, name):
-        """Return the device with the given name, if it exists."""
-        try:
-            return self.devices[name]
-        except KeyError:
-            raise NoSuchDeviceException(device=name, dataset=self.name)
-
-     def get_measurement(self, name):
+    def get_measurement(self, name):
         """Return the measurement with the given name, if it exists."""
         try:
-            return self.measurement[name]
+            return self.measurements[name]
         except KeyError:
             raise NoSuchMeasurementException(measurement=name, dataset=self.name)
 
+    def iter_datasets(self):
+        """Iterate over this dataset and all its descendants (depth first)."""
+        stack = [self]
+        while stack:
+            dataset = stack.pop()
+            yield dataset
+            stack.extend(reversed(list(dataset.children.values())))
+
+    def calculate_differences(self, recursive=True):
+        """Reduce all relative measurements at once.
+
+        Return a list of the RelativeMeasurements and a contiguous N x 3 array with their (dx, dy, dz). With recursive,
+        the measurements of all descendant datasets are included.
+        """
+        measurements = []
+        differences = []
+        for dataset in (self.iter_datasets() if recursive else [self]):
+            if isinstance(dataset.measurements, MeasurementTable):
+                views, dataset_differences = dataset.measurements.calculate_differences()
+            else:
+                views = [measurement for measurement in dataset.measurements.values()
+                         if isinstance(measurement, RelativeMeasurement)]
+                dataset_differences = calculate_differences(views)
+            measurements.extend(views)
+            differences.append(dataset_differences)
+        return measurements, np.concatenate(differences)
+
     @property
     def substorables(self):
-        return self.devices.values() + self.measurements.values()
+        return list(self.devices.values()) + list(self.measurements.values())
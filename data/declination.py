@@ -2,18 +2,324 @@
 
 This file contains code to calculate the magnetic declination. Thanks to Christopher Weiss for the code.
 
+Declinations are memoized in two layers:
+-an exact-key LRU cache keyed on the quantized latitude, longitude, altitude and the year and month of the date
+-optional precomputed regional grids which answer by bilinear interpolation
+
+Dates are resolved to the first day of their month, which changes the declination by at most a few hundredths of a
+degree and is far below the precision of a compass.
+
+The magnetic model used for a date is chosen from a registry of coefficient files. By default all WMM coefficient files
+(*.COF) in the data directory are registered, each valid for five years from its epoch. A model is only loaded when a
+date in its range is first used. Dates outside the ranges of all models use the nearest model, which is extrapolated
+in time like the model itself does, with a warning.
+
 copyright (C) 2016 Bram Rooseleer
 """
 
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import warnings
+from collections import OrderedDict
+from datetime import date
+import numpy as np
 import data.geomag
+from data.exceptions import NoMagneticModelException
+
+
+class ModelRegistry:
+    """A registry of magnetic models, each valid for a range of dates and loaded on first use."""
+
+    def __init__(self):
+        """Create an empty registry."""
+        self._models = []
+        self._lock = threading.Lock()
+
+    def register(self, filename, start=None, end=None):
+        """Register a WMM coefficient file, valid from start up to (not including) end (decimal years).
+
+        By default the model is valid for five years starting at the epoch in the header of the file.
+        """
+        if start is None:
+            with open(filename) as wmm_file:
+                start = float(wmm_file.readline().split()[0])
+        if end is None:
+            end = start+5.0
+        self._models.append({'filename': filename, 'start': start, 'end': end, 'model': None})
+        self._models.sort(key=lambda model: model['start'])
+
+    def discover(self, directory):
+        """Register all coefficient files (*.COF) in the given directory."""
+        for filename in sorted(glob.glob(os.path.join(directory, '*.COF'))):
+            self.register(filename)
+
+    def get_model(self, date):
+        """Return the GeoMag object for the given date, load it if needed.
+
+        When the ranges of several models contain the date, the one with the latest start is used. When none does,
+        the nearest model is used with a warning. Without models a NoMagneticModelException is raised.
+        """
+        if not self._models:
+            raise NoMagneticModelException(date=date)
+        year = date.year+((date-date.replace(month=1, day=1)).days/365.0)
+        for model in reversed(self._models):
+            if model['start'] <= year < model['end']:
+                break
+        else:
+            model = min(reversed(self._models), key=lambda model: max(model['start']-year, year-model['end']))
+            warnings.warn("No magnetic model for date '{date}', the model valid from {start} to {end} is "
+                          "extrapolated.".format(date=date, start=model['start'], end=model['end']), stacklevel=2)
+        if model['model'] is None:
+            with self._lock:
+                if model['model'] is None:
+                    model['model'] = data.geomag.GeoMag(model['filename'])
+        return model['model']
+
+    @property
+    def loaded(self):
+        """Return the filenames of the models that have been loaded."""
+        return [model['filename'] for model in self._models if model['model'] is not None]
+
+
+registry = ModelRegistry()
+"""The registry of magnetic models used by get_declination."""
+registry.discover(os.path.dirname(data.geomag.__file__))
+
+
+def _calculate_declination(latitude, longitude, altitude, date):
+    """Return the declination for a latitude, longitude, altitude (meter) and date, with the evaluator of the thread.
+
+    The evaluator reuses the terms of its previous evaluation which do not change, as for neighbouring stations.
+    """
+    return registry.get_model(date).GeoMag(latitude, longitude, altitude/0.3048, date).dec
+
+
+def _calculate_declinations(latitudes, longitudes, altitude, date):
+    """Return the declinations for arrays of latitudes and longitudes at a single altitude (meter) and date."""
+    return registry.get_model(date).GeoMagBatch(latitudes, longitudes, altitude/0.3048, date)['dec']
+
+
+class DeclinationGrid:
+    """A precomputed regular latitude/longitude grid of declinations for a single altitude and month.
+
+    Declinations inside the grid are bilinearly interpolated. The maximum interpolation error is estimated at build
+    time by comparing the interpolation to the model in the centre of every cell, where the error of bilinear
+    interpolation of a smooth field is largest. The grid also answers for other altitudes within the tolerance, the
+    error of that is estimated by the largest change of the model in those centres at the limits of the tolerance.
+    The sum of both is available as max_error (degrees). For the WMM the field is smooth enough that a grid step of 0.5
+    degrees keeps the interpolation error below 0.01 degrees outside the polar regions.
+    """
+
+    def __init__(self, min_latitude, max_latitude, min_longitude, max_longitude, year, month, altitude=0, step=0.5,
+                 altitude_tolerance=2000):
+        """Create a grid covering the given area (decimal degr.) for the given altitude (meter) and month.
 
-gm = None
-"""The data object to calculate the declination."""
+        The grid answers for altitudes within altitude_tolerance (meter) of its own altitude. The declination changes
+        with roughly 0.005 degrees per kilometre of altitude difference, which is included in max_error.
+        """
+        self.year = year
+        self.month = month
+        self.altitude = altitude
+        self.altitude_tolerance = altitude_tolerance
+        self.step = step
+        self.latitudes = np.arange(min_latitude, max_latitude+step, step)
+        self.longitudes = np.arange(min_longitude, max_longitude+step, step)
+        lat, lon = np.meshgrid(self.latitudes, self.longitudes, indexing='ij')
+        self.values = _calculate_declinations(lat, lon, altitude, date(year, month, 1))
+        self.max_error = self._estimate_max_error()
+
+    def _estimate_max_error(self):
+        """Return the largest interpolation error plus the largest change within the altitude tolerance.
+
+        Both are taken at the cell centres, or at the points of the grid if it has a single row or column.
+        """
+        moment = date(self.year, self.month, 1)
+        if len(self.latitudes) < 2 or len(self.longitudes) < 2:
+            lat, lon = np.meshgrid(self.latitudes, self.longitudes, indexing='ij')
+            exact = self.values
+            interpolation_error = 0.0
+        else:
+            lat, lon = np.meshgrid(self.latitudes[:-1]+self.step/2, self.longitudes[:-1]+self.step/2, indexing='ij')
+            exact = _calculate_declinations(lat, lon, self.altitude, moment)
+            interpolation_error = float(np.max(np.abs(self.interpolate(lat, lon)-exact)))
+        altitude_error = 0.0
+        for altitude in (self.altitude-self.altitude_tolerance, self.altitude+self.altitude_tolerance):
+            changes = (_calculate_declinations(lat, lon, altitude, moment)-exact+180.0) % 360.0-180.0
+            altitude_error = max(altitude_error, float(np.max(np.abs(changes))))
+        return interpolation_error+altitude_error
+
+    def contains(self, latitude, longitude, altitude, date):
+        """Return whether the grid can answer for the given position and date."""
+        return (date.year == self.year and date.month == self.month and
+                abs(altitude-self.altitude) <= self.altitude_tolerance and
+                self.latitudes[0] <= latitude <= self.latitudes[-1] and
+                self.longitudes[0] <= longitude <= self.longitudes[-1])
+
+    def interpolate(self, latitude, longitude):
+        """Return the bilinearly interpolated declination(s) for the given latitude(s) and longitude(s)."""
+        fi = (np.asarray(latitude, dtype=float)-self.latitudes[0])/self.step
+        fj = (np.asarray(longitude, dtype=float)-self.longitudes[0])/self.step
+        i = np.clip(np.floor(fi).astype(int), 0, max(len(self.latitudes)-2, 0))
+        j = np.clip(np.floor(fj).astype(int), 0, max(len(self.longitudes)-2, 0))
+        i1 = np.minimum(i+1, len(self.latitudes)-1)
+        j1 = np.minimum(j+1, len(self.longitudes)-1)
+        u = fi-i
+        v = fj-j
+        # Interpolate the angle differences to avoid wrapping problems around +-180 degrees.
+        v00 = self.values[i, j]
+        d10 = (self.values[i1, j]-v00+180.0) % 360.0-180.0
+        d01 = (self.values[i, j1]-v00+180.0) % 360.0-180.0
+        d11 = (self.values[i1, j1]-v00+180.0) % 360.0-180.0
+        result = v00+u*(1-v)*d10+(1-u)*v*d01+u*v*d11
+        return (result+180.0) % 360.0-180.0
+
+
+class DeclinationCache:
+    """A memoizing layer for declination calculations with hit and miss counters."""
+
+    def __init__(self, maxsize=4096, precision=4):
+        """Create a cache holding at most maxsize exact keys, with positions rounded to the given number of decimals."""
+        self.maxsize = maxsize
+        self.precision = precision
+        self.grids = []
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.grid_hits = 0
+        self.misses = 0
+
+    def key(self, latitude, longitude, altitude, date):
+        """Return the quantized cache key for the given position and date."""
+        return (round(latitude, self.precision), round(longitude, self.precision), round(altitude),
+                date.year, date.month)
+
+    def add_grid(self, grid):
+        """Add a precomputed DeclinationGrid, it is consulted before the model is evaluated."""
+        self.grids.append(grid)
+
+    def get_declination(self, latitude, longitude, altitude, date):
+        """Return the declination for the position and date, from the cache if possible."""
+        key = self.key(latitude, longitude, altitude, date)
+        with self._lock:
+            try:
+                declination = self._entries[key]
+            except KeyError:
+                pass
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return declination
+        # The model is evaluated outside the lock, only the bookkeeping of the cache is serialized.
+        for grid in self.grids:
+            if grid.contains(latitude, longitude, altitude, date):
+                declination = float(grid.interpolate(latitude, longitude))
+                grid_hit = True
+                break
+        else:
+            declination = float(_calculate_declination(key[0], key[1], key[2], date.replace(day=1)))
+            grid_hit = False
+        with self._lock:
+            if grid_hit:
+                self.grid_hits += 1
+            else:
+                self.misses += 1
+            self._entries[key] = declination
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return declination
+
+    def clear(self):
+        """Remove all cached entries and grids and reset the counters."""
+        with self._lock:
+            self.grids = []
+            self._entries.clear()
+            self.hits = self.grid_hits = self.misses = 0
+
+    def info(self):
+        """Return a dict with the hits, grid hits, misses and current size of the cache."""
+        return {'hits': self.hits, 'grid_hits': self.grid_hits, 'misses': self.misses, 'size': len(self._entries),
+                'maxsize': self.maxsize}
+
+
+cache = DeclinationCache()
+"""The cache used by get_declination."""
 
 
 def get_declination(latitude, longitude, altitude, date):
     """Return the magnetic declination for the latitude, longitude (both decimal degr.), altitude (meter) and date."""
-    global gm
-    if gm is None:
-        gm = data.geomag.GeoMag()
-    return gm.GeoMag(latitude, longitude, altitude/0.3048, date).dec
+    return cache.get_declination(latitude, longitude, altitude, date)
+
+
+def add_declination_grid(min_latitude, max_latitude, min_longitude, max_longitude, year, month, **kwargs):
+    """Precompute a regional declination grid used by get_declination and return it."""
+    grid = DeclinationGrid(min_latitude, max_latitude, min_longitude, max_longitude, year, month, **kwargs)
+    cache.add_grid(grid)
+    return grid
+
+
+class DeclinationTest(unittest.TestCase):
+
+    def test_cache(self):
+        test_cache = DeclinationCache(maxsize=2)
+        first = test_cache.get_declination(50.5, 4.5, 100, date(2016, 1, 1))
+        self.assertEqual(first, test_cache.get_declination(50.50001, 4.5, 100.2, date(2016, 1, 20)))
+        self.assertEqual((1, 1), (test_cache.hits, test_cache.misses))
+        # Misses are evaluated by the evaluator of the thread, as single points.
+        model = registry.get_model(date(2016, 1, 1))
+        self.assertEqual(model.evaluator().GeoMag(50.5, 4.5, 100/0.3048, date(2016, 1, 1)).dec, first)
+        self.assertEqual((50.5, 4.5), (model._local.evaluator.olat, model._local.evaluator.olon))
+        test_cache.get_declination(51, 4.5, 100, date(2016, 1, 1))
+        test_cache.get_declination(52, 4.5, 100, date(2016, 1, 1))
+        test_cache.get_declination(50.5, 4.5, 100, date(2016, 1, 1))
+        self.assertEqual((1, 4, 2), (test_cache.hits, test_cache.misses, test_cache.info()['size']))
+
+    def test_registry(self):
+        test_registry = ModelRegistry()
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('WMM2010.COF', 'WMM2015.COF'):
+                shutil.copy(os.path.join(os.path.dirname(data.geomag.__file__), 'WMM.COF'),
+                            os.path.join(directory, name))
+            test_registry.register(os.path.join(directory, 'WMM2010.COF'), start=2010.0)
+            test_registry.register(os.path.join(directory, 'WMM2015.COF'))
+            self.assertEqual([], test_registry.loaded)
+            self.assertEqual(2015.0, test_registry.get_model(date(2019, 12, 31)).epoch)
+            self.assertEqual([os.path.join(directory, 'WMM2015.COF')], test_registry.loaded)
+            test_registry.get_model(date(2012, 6, 1))
+            self.assertEqual(2, len(test_registry.loaded))
+            self.assertIs(test_registry.get_model(date(2016, 1, 1)), test_registry.get_model(date(2017, 1, 1)))
+            # Dates outside all ranges use the nearest model with a warning.
+            with self.assertWarns(UserWarning):
+                self.assertEqual(2015.0, test_registry.get_model(date(2026, 10, 1)).epoch)
+            with self.assertWarns(UserWarning):
+                self.assertIs(test_registry.get_model(date(2012, 6, 1)), test_registry.get_model(date(2001, 1, 1)))
+        with self.assertRaises(NoMagneticModelException):
+            ModelRegistry().get_model(date(2016, 1, 1))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertTrue(np.isfinite(get_declination(50.5, 4.5, 100, date(2026, 10, 17))))
+
+    def test_grid(self):
+        grid = DeclinationGrid(49, 52, 2, 7, 2016, 1, altitude=100)
+        self.assertLess(grid.max_error, 0.01)
+        test_cache = DeclinationCache()
+        test_cache.add_grid(grid)
+        value = test_cache.get_declination(50.3, 4.1, 300, date(2016, 1, 1))
+        expected = data.geomag.GeoMag().GeoMag(50.3, 4.1, 300/0.3048, date(2016, 1, 1)).dec
+        self.assertAlmostEqual(expected, value, delta=grid.max_error)
+        self.assertEqual((1, 0), (test_cache.grid_hits, test_cache.misses))
+        # The error of answering for other altitudes is part of max_error, it vanishes without a tolerance.
+        for altitude in (-1900, 2100):
+            expected = data.geomag.GeoMag().GeoMag(50.25, 4.25, altitude/0.3048, date(2016, 1, 1)).dec
+            self.assertAlmostEqual(expected, grid.interpolate(50.25, 4.25), delta=grid.max_error)
+        exact = DeclinationGrid(49, 52, 2, 7, 2016, 1, altitude=100, altitude_tolerance=0)
+        self.assertLess(exact.max_error, grid.max_error)
+        self.assertGreater(grid.max_error-exact.max_error, 0.001)
+
+
+if __name__ == '__main__':
+    unittest.main()
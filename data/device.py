@@ -5,21 +5,45 @@ These classes represent measurement devices.
 copyright (C) 2016 Bram Rooseleer
 """
 
+import unittest
 from datetime import date
-from math import sin, cos
+from math import sin, cos, radians
+import numpy as np
 from data.measurement import AbsoluteMeasurement, RelativeMeasurement
 from data.declination import get_declination
 
 
+def calculate_differences(measurements):
+    """Return a contiguous N x 3 array with the (dx, dy, dz) of the given relative measurements.
+
+    The measurements are grouped per device and every group is reduced at once by its device.
+    """
+    result = np.empty((len(measurements), 3))
+    devices = {}
+    codes = np.fromiter((devices.setdefault(measurement.device, len(devices)) for measurement in measurements),
+                        dtype=int, count=len(measurements))
+    data = [measurement.data for measurement in measurements]
+    for device, code in devices.items():
+        if len(devices) == 1:
+            result[:] = device.calculate_differences(data)
+        else:
+            indices = np.flatnonzero(codes == code)
+            result[indices] = device.calculate_differences([data[index] for index in indices])
+    return result
+
+
 class Device:
     """An abstract measurement device."""
 
     @staticmethod
     def create_device(type, **kwargs):
         """A factory function to create a device of the correct type with the given arguments."""
-        for cls in Device.__subclasses__():
+        classes = Device.__subclasses__()
+        while classes:
+            cls = classes.pop()
             if cls.get_type() == type:
                 break
+            classes.extend(cls.__subclasses__())
         else:
             raise Exception("Device of type '{type}' unknown.".format(type=type))
         return cls(**kwargs)
@@ -49,6 +73,10 @@ class AbsoluteDevice(Device):
     def calculate_position(self, data):
         """Calculates the absolute position (abstract)."""
 
+    def position_error(self):
+        """Return the (std of the) errors on x, y and z, None if the positions are exact."""
+        return None
+
     @classmethod
     def get_measurement_cls(cls):
         """Return the measurement class."""
@@ -58,16 +86,32 @@ class AbsoluteDevice(Device):
 class GPS(AbsoluteDevice):
     """A GPS device."""
 
-    def __init__(self, **kwargs):
-        """Create a GPS device."""
+    def __init__(self, error=None, vertical_error=None, **kwargs):
+        """Create a GPS device.
+
+        The errors are the std (meter) of the horizontal and vertical coordinates, the vertical error defaults to the
+        horizontal one. Without errors the positions are considered exact.
+        """
         AbsoluteDevice.__init__(self, **kwargs)
+        self.error = error
+        self.vertical_error = error if vertical_error is None else vertical_error
+
+    def position_error(self):
+        """Return the (std of the) errors on x, y and z, None if the positions are exact."""
+        if self.error is None:
+            return None
+        return (self.error, self.error, self.vertical_error)
 
     def calculate_position(self, data):
         """Calculates the absolute position.
 
-        data needs to be a dict with x, y, z and maptype fields.
+        data needs to be a dict with x, y, z and maptype fields. Only the 'local' map type (coordinates in the map frame
+        of the survey, the default) is supported yet.
         """
-        raise NotImplementedError()
+        maptype = data.get('maptype', 'local')
+        if maptype != 'local':
+            raise NotImplementedError("Map type '{maptype}' is not supported.".format(maptype=maptype))
+        return (data['x'], data['y'], data['z'])
 
 
 class RelativeDevice(Device):
@@ -77,6 +121,25 @@ class RelativeDevice(Device):
         """Calculates the relative position (abstract)."""
         raise NotImplementedError()
 
+    def calculate_differences(self, data):
+        """Calculates the relative positions for a list of data dicts and return them as an N x 3 array.
+
+        Subclasses can override this with a vectorized implementation.
+        """
+        return np.array([self.calculate_difference(item) for item in data], dtype=float).reshape(-1, 3)
+
+    def reduce(self, distance, compass, inclination, out=None):
+        """Return the N x 3 array of relative positions for arrays of distances, compass and inclination angles.
+
+        Subclasses can override this with a vectorized implementation.
+        """
+        data = [{'distance': values[0], 'compass': values[1], 'inclination': values[2]}
+                for values in zip(distance.tolist(), compass.tolist(), inclination.tolist())]
+        if out is None:
+            return self.calculate_differences(data)
+        out[:] = self.calculate_differences(data)
+        return out
+
     @classmethod
     def get_measurement_cls(cls):
         """Return the measurement class."""
@@ -86,10 +149,17 @@ class RelativeDevice(Device):
 class DCIDevice(RelativeDevice):
     """A relative device that measures distance, compass and inclination."""
 
-    def __init__(self, angleref='hor', year=2016, month=1, latitude=None, longitude=None, height=0, declination=None, **kwargs):
-        """Create a classic device."""
+    def __init__(self, angleref='hor', year=2016, month=1, latitude=None, longitude=None, height=0, declination=None,
+                 distance_error=None, compass_error=None, inclination_error=None, **kwargs):
+        """Create a classic device.
+
+        The errors are the std of the distance (meter), compass and inclination (degrees) readings of the device.
+        """
         RelativeDevice.__init__(self, **kwargs)
         self.angleref = angleref
+        self.distance_error = distance_error
+        self.compass_error = compass_error
+        self.inclination_error = inclination_error
         if declination is None:
             if latitude is not None and longitude is not None:
                 declination = get_declination(latitude, longitude, height, date(year, month, 1))
@@ -103,24 +173,91 @@ class DCIDevice(RelativeDevice):
         data needs to be a dict with distance, inclination and compass fields.
         """
         distance = data['distance']
-        if self.angleref == 'hor':
-            slope = data['inclination']
-        elif self.angleref == 'ver':
-            slope = 90 - data['inclination']
-        compass = data['compass'] + self.declination
+        slope = radians(self._slope(data['inclination']))
+        compass = radians(data['compass'] + self.declination)
         z  = sin(slope)*distance
         xy = cos(slope)*distance
         y  = cos(compass)*xy
         x  = sin(compass)*xy
         return (x, y, z)
 
+    def calculate_differences(self, data):
+        """Calculates the relative positions for a list of data dicts and return them as an N x 3 array."""
+        distance = np.fromiter((item['distance'] for item in data), dtype=float, count=len(data))
+        compass = np.fromiter((item['compass'] for item in data), dtype=float, count=len(data))
+        inclination = np.fromiter((item['inclination'] for item in data), dtype=float, count=len(data))
+        return self.reduce(distance, compass, inclination)
+
+    def reduce(self, distance, compass, inclination, out=None):
+        """Return the N x 3 array of relative positions for arrays of distances, compass and inclination angles."""
+        if out is None:
+            out = np.empty((len(distance), 3))
+        slope = np.radians(self._slope(np.asarray(inclination, dtype=float)))
+        compass = np.radians(np.asarray(compass, dtype=float) + self.declination)
+        xy = np.cos(slope)*distance
+        np.multiply(np.sin(compass), xy, out=out[:, 0])
+        np.multiply(np.cos(compass), xy, out=out[:, 1])
+        np.multiply(np.sin(slope), distance, out=out[:, 2])
+        return out
+
+    def reduce_covariance(self, distance, compass, inclination, distance_error=None, compass_error=None,
+                          inclination_error=None):
+        """Return the N x 3 x 3 array of covariance matrices of the relative positions.
+
+        The std of the readings (arrays or numericals) are propagated to x, y and z through the Jacobian of the
+        reduction, so the correlation introduced by the angles is kept. Missing errors default to those of the device.
+        """
+        distance = np.asarray(distance, dtype=float)
+        errors = []
+        for error, default in ((distance_error, self.distance_error), (compass_error, self.compass_error),
+                               (inclination_error, self.inclination_error)):
+            error = default if error is None else error
+            errors.append(np.broadcast_to(np.asarray(0.0 if error is None else error, dtype=float), distance.shape))
+        slope = np.radians(self._slope(np.asarray(inclination, dtype=float)))
+        compass = np.radians(np.asarray(compass, dtype=float) + self.declination)
+        sin_slope, cos_slope = np.sin(slope), np.cos(slope)
+        sin_compass, cos_compass = np.sin(compass), np.cos(compass)
+        # The rows of the Jacobian, with its columns (derivatives to the distance, the compass angle and the slope)
+        # scaled by the std of the readings (in radians for the angles).
+        distance_error, compass_error, slope_error = errors[0], np.radians(errors[1]), np.radians(errors[2])
+        jacobian = (
+            (cos_slope*sin_compass*distance_error, distance*cos_slope*cos_compass*compass_error,
+             -distance*sin_slope*sin_compass*slope_error),
+            (cos_slope*cos_compass*distance_error, -distance*cos_slope*sin_compass*compass_error,
+             -distance*sin_slope*cos_compass*slope_error),
+            (sin_slope*distance_error, np.zeros(distance.shape), distance*cos_slope*slope_error),
+        )
+        covariance = np.empty(distance.shape+(3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                covariance[..., i, j] = covariance[..., j, i] = sum(a*b for a, b in zip(jacobian[i], jacobian[j]))
+        return covariance
+
+    def readings(self, differences):
+        """Return the distance, compass and inclination arrays which reduce to the N x 3 array of differences."""
+        differences = np.asarray(differences, dtype=float).reshape(-1, 3)
+        distance = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+        horizontal = np.hypot(differences[:, 0], differences[:, 1])
+        compass = (np.degrees(np.arctan2(differences[:, 0], differences[:, 1])) - self.declination) % 360.0
+        slope = np.degrees(np.arctan2(differences[:, 2], horizontal))
+        # The conversion between slope and inclination is its own inverse for both angle references.
+        return distance, compass, self._slope(slope)
+
+    def _slope(self, inclination):
+        """Return the slope (degrees above the horizontal) for the inclination according to the angle reference."""
+        if self.angleref == 'hor':
+            return inclination
+        elif self.angleref == 'ver':
+            return 90 - inclination
+        raise ValueError("Unknown angle reference '{angleref}'.".format(angleref=self.angleref))
+
 
 class DistoX(DCIDevice):
     """A disto-X device."""
 
     def __init__(self, calibration_date=None, **kwargs):
         """Create a disto-X device."""
-        RelativeDevice.__init__(self, **kwargs)
+        DCIDevice.__init__(self, **kwargs)
         self.calibration_date = calibration_date
 
 
@@ -129,4 +266,52 @@ class Classic(RelativeDevice):
 
     def __init__(self, **kwargs):
         """Create a classic device."""
-        RelativeDevice.__init__(self,  **kwargs)
\ No newline at end of file
+        RelativeDevice.__init__(self,  **kwargs)
+
+
+class DeviceTest(unittest.TestCase):
+
+    def test_calculate_differences(self):
+        from data.dataset import Dataset
+        datasets = {}
+        cave = Dataset(datasets, 'cave')
+        cave.add_device('DCIDevice', 'compass', declination=2.0)
+        cave.add_device('DistoX', 'disto', angleref='ver')
+        branch = Dataset(datasets, 'branch', parent='cave')
+        shots = ((cave, 'compass', 10.0, 90.0, 0.0), (cave, 'disto', 5.0, 180.0, 90.0),
+                 (branch, 'compass', 7.5, 33.0, -20.0), (branch, 'disto', 3.0, 270.0, 0.0))
+        for index, (dataset, device, distance, compass, inclination) in enumerate(shots):
+            dataset.add_measurement(None, str(index), device, point=str(index+1), refpoint=str(index),
+                                    distance=distance, compass=compass, inclination=inclination)
+        measurements, differences = cave.calculate_differences()
+        self.assertEqual((4, 3), differences.shape)
+        self.assertTrue(differences.flags['C_CONTIGUOUS'])
+        for measurement, difference in zip(measurements, differences):
+            for value, expected in zip(difference, (measurement.dx, measurement.dy, measurement.dz)):
+                self.assertAlmostEqual(expected, value, 12)
+        self.assertAlmostEqual(10.0*sin(radians(92.0)), differences[0][0], 12)
+        self.assertAlmostEqual(3.0, differences[3][2], 12)
+        self.assertEqual(2, len(branch.calculate_differences(recursive=False)[0]))
+
+    def test_reduce_covariance(self):
+        device = DCIDevice(name='disto', angleref='ver', declination=3.0, distance_error=0.01, compass_error=0.5,
+                           inclination_error=0.5)
+        readings = np.array([[12.0, 40.0, 70.0], [3.0, 300.0, 120.0], [25.0, 181.0, 89.0]])
+        covariance = device.reduce_covariance(*readings.T)
+        self.assertEqual((3, 3, 3), covariance.shape)
+        self.assertTrue(np.allclose(readings, np.transpose(device.readings(device.reduce(*readings.T))), rtol=0,
+                                    atol=1e-9))
+        step = 1e-6
+        for reading, result in zip(readings, covariance):
+            jacobian = np.empty((3, 3))
+            for index in range(3):
+                delta = np.zeros(3)
+                delta[index] = step
+                jacobian[:, index] = (device.reduce(*((reading+delta)[:, np.newaxis]))[0] -
+                                      device.reduce(*((reading-delta)[:, np.newaxis]))[0])/(2*step)
+            variance = np.diag([0.01**2, 0.5**2, 0.5**2])
+            self.assertTrue(np.allclose(jacobian.dot(variance).dot(jacobian.T), result, rtol=1e-6, atol=1e-12))
+
+
+if __name__ == '__main__':
+    unittest.main()
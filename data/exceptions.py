@@ -34,3 +34,11 @@ class NoSuchMeasurementException(DataException):
     @classmethod
     def message_template(cls):
         return "No measurement with name '{measurement}' in dataset '{dataset}'."
+
+
+class NoMagneticModelException(DataException):
+    """An exception raised when no magnetic model is available for a date."""
+
+    @classmethod
+    def message_template(cls):
+        return "No magnetic model available for date '{date}'."
@@ -0,0 +1,186 @@
+""" ArboTopo - data: extended elevation
+
+The ExtendedElevation of this module unfolds the stations of an Algorithm in an extended elevation (developed profile):
+the horizontal coordinate follows the passages, the vertical coordinate is the altitude.
+
+The survey graph is unrolled over a depth first spanning tree (scipy) from one root per component: its first fixed
+station, the origin station if it is in the component, or else its first station. Every leg of the tree extends to
+the right or to the left by the horizontal distance between the calculated positions of its stations, so the
+horizontal distances along the tree are kept and loops are cut open. A leg extends in the direction given for the
+station at its end, or else in the direction of its parent leg, the legs from the roots extend to the right. The
+direction 'reverse' turns the direction of the parent leg around.
+
+Both the directions (the parity of the reversals up to the nearest leg with a fixed direction) and the horizontal
+coordinates (a sum of the legs up to the root) are accumulated along the tree in a single linear pass: in depth first
+order every station comes after its parent, so the incidence matrix of the tree is lower triangular and one sparse
+triangular solve (scipy) gives all sums in O(stations).
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import depth_first_order
+from scipy.sparse.linalg import spsolve_triangular
+
+
+class ExtendedElevation:
+    """The extended elevation of the stations of an Algorithm.
+
+    The stations are indexed as in the survey graph of the algorithm. The elevation has the N x 2 coordinates (the
+    unrolled horizontal distance and the altitude), the parent station in the tree and the direction (1 to the right,
+    -1 to the left) of the leg to every station (1 for roots, which are their own parent), and the L x 2 legs (parent,
+    station) of the tree.
+    """
+
+    DIRECTIONS = {'right': 1, 'left': -1, 1: 1, -1: -1}
+    """The fixed directions by name or value."""
+
+    def __init__(self, algorithm, directions=None, origin=None):
+        """Unfold the stations of an Algorithm.
+
+        -directions:    a dict mapping station names on the direction ('right', 'left', 'reverse', 1 or -1) of the leg
+                        to them and the legs beyond, which follow the direction of their parent leg by default
+        -origin:        the name of the station used as root of its component if that component has no fix, the
+                        origin of the algorithm if None
+        """
+        self.algorithm = algorithm
+        self.directions = {} if directions is None else directions
+        self.origin = getattr(algorithm, 'origin', None) if origin is None else origin
+        graph = algorithm.graph
+        self.roots = self._find_roots()
+        self.order, self.parents = self._spanning_tree()
+        children = np.flatnonzero(self.parents != np.arange(graph.station_count))
+        self.legs = np.stack((self.parents[children], children), axis=1)
+        self.leg_directions = self._accumulate_directions()
+        horizontal = np.zeros(graph.station_count)
+        horizontal[children] = self.leg_directions[children]*np.hypot(
+            *(algorithm.positions[children, :2]-algorithm.positions[self.parents[children], :2]).T)
+        self.coordinates = np.stack((self._accumulate(horizontal), algorithm.positions[:, 2]), axis=1)
+
+    def _find_roots(self):
+        """Return the root station of every component."""
+        graph = self.algorithm.graph
+        labels = graph.connected_components()[1]
+        roots = np.unique(labels, return_index=True)[1]
+        if self.origin is not None and self.origin in graph.station_ids:
+            roots[labels[graph.station_ids[self.origin]]] = graph.station_ids[self.origin]
+        for station in graph.fix_stations[::-1].tolist():
+            roots[labels[station]] = station
+        return roots
+
+    def _spanning_tree(self):
+        """Return the stations in depth first order and the parent station of every station in the depth first spanning
+        tree, roots are their own parent."""
+        graph = self.algorithm.graph
+        size = graph.station_count
+        # A virtual station connected to all roots makes a single search cover all components.
+        matrix = graph.matrix().tocoo()
+        rows = np.concatenate((matrix.row, np.full(len(self.roots), size), self.roots))
+        columns = np.concatenate((matrix.col, self.roots, np.full(len(self.roots), size)))
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(size+1, size+1))
+        stations, predecessors = depth_first_order(matrix, size, directed=False, return_predecessors=True)
+        predecessors = predecessors[:size]
+        parents = np.arange(size)
+        children = np.flatnonzero(predecessors != size)
+        parents[children] = predecessors[children]
+        return stations[1:], parents
+
+    def _accumulate_directions(self):
+        """Return the direction of the leg to every station, resolving the reversals up to the nearest fixed one."""
+        graph = self.algorithm.graph
+        size = graph.station_count
+        reversals = np.zeros(size)
+        fixed = np.zeros(size, dtype=bool)
+        fixed[self.roots] = True
+        for name, direction in self.directions.items():
+            station = graph.station_ids.get(name)
+            if station is None:
+                continue
+            if direction == 'reverse':
+                reversals[station] = 1.0
+            elif direction in self.DIRECTIONS:
+                reversals[station] = self.DIRECTIONS[direction] == -1
+                fixed[station] = True
+            else:
+                raise ValueError("Unknown direction '{direction}'.".format(direction=direction))
+        # The direction is reversed by an odd number of reversals up to (and with) the nearest fixed station.
+        counts = self._accumulate(reversals, cut=fixed)
+        return np.where(np.rint(counts) % 2 == 1, -1, 1).astype(np.int8)
+
+    def _accumulate(self, offsets, cut=None):
+        """Return the sums of the offsets of every station up to its root, solving the lower triangular incidence
+        matrix of the tree (+1 at the station, -1 at its parent) in depth first order.
+
+        -cut:   a boolean array of the stations at which the sums stop instead of at the roots
+        """
+        size = len(offsets)
+        ranks = np.empty(size, dtype=np.int64)
+        ranks[self.order] = np.arange(size)
+        children = np.flatnonzero(self.parents != np.arange(size))
+        if cut is not None:
+            children = children[~cut[children]]
+        rows = np.concatenate((np.arange(size), ranks[children]))
+        columns = np.concatenate((np.arange(size), ranks[self.parents[children]]))
+        matrix = csr_matrix((np.concatenate((np.ones(size), -np.ones(len(children)))), (rows, columns)),
+                            shape=(size, size))
+        return spsolve_triangular(matrix, offsets[self.order], lower=True)[ranks]
+
+
+class ExtendedElevationTest(unittest.TestCase):
+
+    def test_elevation(self):
+        from data.dataset import Dataset
+        from data.propagation_algorithm import PropagationAlgorithm
+        dataset = Dataset({}, 'cave', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        dataset.add_device('GPS', 'gps')
+        dataset.add_measurement(None, 'entrance', 'gps', point=0, x=0.0, y=0.0, z=100.0)
+        # A passage going east and down, a branch at 2 going north which turns back south at 'b2' and a separate shot.
+        shots = [(0, 1, 90.0, -30.0), (1, 2, 90.0, 0.0), (2, 3, 90.0, 0.0), (2, 'b1', 0.0, 0.0),
+                 ('b1', 'b2', 0.0, 10.0), ('b2', 'b3', 180.0, 0.0), ('x', 'y', 0.0, 0.0)]
+        for index, (refpoint, point, compass, inclination) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=10.0,
+                                    compass=compass, inclination=inclination)
+        algorithm = PropagationAlgorithm(dataset)
+        graph = algorithm.graph
+        elevation = ExtendedElevation(algorithm, directions={'b1': 'left', 'b3': 'reverse'})
+        coordinates = {name: tuple(elevation.coordinates[graph.station_ids[name]]) for name in graph.stations}
+        self.assertEqual((0.0, 100.0), coordinates[0])
+        self.assertTrue(np.allclose(algorithm.positions[:, 2], elevation.coordinates[:, 1]))
+        # The legs of the tree keep their horizontal lengths, directions are inherited and reversed.
+        self.assertEqual(graph.station_count-2, len(elevation.legs))
+        direction = dict(zip(graph.stations, elevation.leg_directions.tolist()))
+        self.assertEqual(1, direction[3])
+        self.assertEqual(-1, direction['b1'])
+        self.assertEqual(-1, direction['b2'])
+        for parent, station in elevation.legs.tolist():
+            horizontal = np.hypot(*(algorithm.positions[station, :2]-algorithm.positions[parent, :2]))
+            self.assertAlmostEqual(elevation.leg_directions[station]*horizontal,
+                                   elevation.coordinates[station, 0]-elevation.coordinates[parent, 0], 9)
+        self.assertAlmostEqual(10*np.cos(np.radians(30))+10, coordinates[2][0], 9)
+        self.assertAlmostEqual(coordinates[2][0]-10-10*np.cos(np.radians(10)), coordinates['b2'][0], 9)
+        self.assertAlmostEqual(coordinates['b2'][0]+10, coordinates['b3'][0], 9)
+        # The root of the other component is at 0 as well.
+        self.assertEqual([0.0, 10.0], sorted((coordinates['x'][0], coordinates['y'][0])))
+        self.assertRaises(ValueError, ExtendedElevation, algorithm, {'b1': 'up'})
+
+    def test_long_passage(self):
+        from data.dataset import Dataset
+        from data.propagation_algorithm import PropagationAlgorithm
+        dataset = Dataset({}, 'cave', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        for index in range(5000):
+            dataset.add_measurement(None, str(index), 'compass', point=index+1, refpoint=index, distance=2.0,
+                                    compass=(37.0*index) % 360, inclination=0.0)
+        algorithm = PropagationAlgorithm(dataset, origin=0)
+        elevation = ExtendedElevation(algorithm, directions={2500: 'reverse'})
+        station_ids = algorithm.graph.station_ids
+        # The leg to 2500 and all legs after it go back.
+        self.assertAlmostEqual(4996.0, elevation.coordinates[station_ids[2500], 0], 6)
+        self.assertAlmostEqual(-4.0, elevation.coordinates[station_ids[5000], 0], 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,92 +15,75 @@
 # -6.1335150785195536
 # >>>
 
-import math, os, unittest
+import hashlib, math, mmap, os, struct, sys, tempfile, threading, unittest
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-
-class GeoMag:
+import numpy as np
+
+
+def _decimal_years(time):
+    # Convert a date, an array of dates, an array of numpy datetime64 or decimal years to decimal years.
+    time = np.asarray(time)
+    if np.issubdtype(time.dtype, np.datetime64):
+        days = time.astype('datetime64[D]')
+        years = days.astype('datetime64[Y]')
+        return years.astype(float)+1970.0+(days-years).astype(float)/365.0
+    if time.dtype == object:
+        return np.vectorize(lambda t: t.year+((t - date(t.year,1,1)).days/365.0), otypes=[float])(time)
+    return time.astype(float)
+
+class GeoMagEvaluator:
+    # Evaluates the model of a GeoMag object. The scratch state of an evaluation (p, dp, tc, sp, cp, pp) lives on
+    # the evaluator, the normalized coefficients are shared read-only with the GeoMag object. An evaluator must not be
+    # shared between threads, create one per thread with GeoMag.evaluator() or use GeoMag.GeoMag.
+    #
+    # The evaluator remembers the time, altitude, latitude and longitude of the previous evaluation. The spherical
+    # coordinates and Legendre terms are only recomputed when the altitude or latitude changed, the longitude series
+    # when the longitude changed and the time adjusted Gauss coefficients when the time changed.
+
+    def __init__(self, geomag):
+        self.geomag = geomag
+        z = [0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0]
+        self.tc = [z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13]]
+        self.sp = z[0:14]
+        self.cp = z[0:14]
+        self.cp[0] = 1.0
+        self.pp = z[0:13]
+        self.pp[0] = 1.0
+        self.p = [z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14]]
+        self.p[0][0] = 1.0
+        self.dp = [z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13]]
+        self.otime = self.oalt = self.olat = self.olon = -1000.0
+        self.ct = self.st = self.r = self.ca = self.sa = 0.0
 
     def GeoMag(self, dlat, dlon, h=0, time=date.today()): # latitude (decimal degrees), longitude (decimal degrees), altitude (feet), date
+        gm = self.geomag
         #time = date('Y') + date('z')/365
         time = time.year+((time - date(time.year,1,1)).days/365.0)
         alt = h/3280.8399
 
-        otime = oalt = olat = olon = -1000.0
-
-        dt = time - self.epoch
         glat = dlat
         glon = dlon
-        rlat = math.radians(glat)
-        rlon = math.radians(glon)
-        srlon = math.sin(rlon)
-        srlat = math.sin(rlat)
-        crlon = math.cos(rlon)
-        crlat = math.cos(rlat)
-        srlat2 = srlat*srlat
-        crlat2 = crlat*crlat
-        self.sp[1] = srlon
-        self.cp[1] = crlon
-
-        #/* CONVERT FROM GEODETIC COORDS. TO SPHERICAL COORDS. */
-        if (alt != oalt or glat != olat):
-            q = math.sqrt(self.a2-self.c2*srlat2)
-            q1 = alt*q
-            q2 = ((q1+self.a2)/(q1+self.b2))*((q1+self.a2)/(q1+self.b2))
-            ct = srlat/math.sqrt(q2*crlat2+srlat2)
-            st = math.sqrt(1.0-(ct*ct))
-            r2 = (alt*alt)+2.0*q1+(self.a4-self.c4*srlat2)/(q*q)
-            r = math.sqrt(r2)
-            d = math.sqrt(self.a2*crlat2+self.b2*srlat2)
-            ca = (alt+d)/r
-            sa = self.c2*crlat*srlat/(r*d)
-
-        if (glon != olon):
-            for m in range(2,self.maxord+1):
-                self.sp[m] = self.sp[1]*self.cp[m-1]+self.cp[1]*self.sp[m-1]
-                self.cp[m] = self.cp[1]*self.cp[m-1]-self.sp[1]*self.sp[m-1]
 
-        aor = self.re/r
+        if (alt != self.oalt or glat != self.olat):
+            self._spherical(glat, alt)
+        if (glon != self.olon):
+            self._longitude_series(glon)
+        if (time != self.otime):
+            self._time_adjust(time)
+        ct = self.ct
+        st = self.st
+        r = self.r
+        ca = self.ca
+        sa = self.sa
+
+        aor = gm.re/r
         ar = aor*aor
         br = bt = bp = bpp = 0.0
-        for n in range(1,self.maxord+1):
+        for n in range(1,gm.maxord+1):
             ar = ar*aor
-
-            #for (m=0,D3=1,D4=(n+m+D3)/D3;D4>0;D4--,m+=D3):
-            m=0
-            D3=1
-            #D4=(n+m+D3)/D3
-            D4=(n+m+1)
-            while D4>0:
-
-        # /*
-                # COMPUTE UNNORMALIZED ASSOCIATED LEGENDRE POLYNOMIALS
-                # AND DERIVATIVES VIA RECURSION RELATIONS
-        # */
-                if (alt != oalt or glat != olat):
-                    if (n == m):
-                        self.p[m][n] = st * self.p[m-1][n-1]
-                        self.dp[m][n] = st*self.dp[m-1][n-1]+ct*self.p[m-1][n-1]
-
-                    elif (n == 1 and m == 0):
-                        self.p[m][n] = ct*self.p[m][n-1]
-                        self.dp[m][n] = ct*self.dp[m][n-1]-st*self.p[m][n-1]
-
-                    elif (n > 1 and n != m):
-                        if (m > n-2):
-                            self.p[m][n-2] = 0
-                        if (m > n-2):
-                            self.dp[m][n-2] = 0.0
-                        self.p[m][n] = ct*self.p[m][n-1]-self.k[m][n]*self.p[m][n-2]
-                        self.dp[m][n] = ct*self.dp[m][n-1] - st*self.p[m][n-1]-self.k[m][n]*self.dp[m][n-2]
-
-        # /*
-                # TIME ADJUST THE GAUSS COEFFICIENTS
-        # */
-                if (time != otime):
-                    self.tc[m][n] = self.c[m][n]+dt*self.cd[m][n]
-                    if (m != 0):
-                        self.tc[n][m-1] = self.c[n][m-1]+dt*self.cd[n][m-1]
-
+            for m in range(n+1):
         # /*
                 # ACCUMULATE TERMS OF THE SPHERICAL HARMONIC EXPANSIONS
         # */
@@ -114,8 +97,8 @@ class GeoMag:
                     temp2 = self.tc[m][n]*self.sp[m]-self.tc[n][m-1]*self.cp[m]
 
                 bt = bt-ar*temp1*self.dp[m][n]
-                bp = bp + (self.fm[m] * temp2 * par)
-                br = br + (self.fn[n] * temp1 * par)
+                bp = bp + (gm.fm[m] * temp2 * par)
+                br = br + (gm.fn[n] * temp1 * par)
         # /*
                     # SPECIAL CASE:  NORTH/SOUTH GEOGRAPHIC POLES
         # */
@@ -123,12 +106,9 @@ class GeoMag:
                     if (n == 1):
                         self.pp[n] = self.pp[n-1]
                     else:
-                        self.pp[n] = ct*self.pp[n-1]-self.k[m][n]*self.pp[n-2]
+                        self.pp[n] = ct*self.pp[n-1]-gm.k[m][n]*self.pp[n-2]
                     parp = ar*self.pp[n]
-                    bpp = bpp + (self.fm[m]*temp2*parp)
-
-                D4=D4-1
-                m=m+1
+                    bpp = bpp + (gm.fm[m]*temp2*parp)
 
         if (st == 0.0):
             bp = bpp
@@ -171,11 +151,6 @@ class GeoMag:
             if (gv < -180.0):
                 gv = gv + 360.0
 
-        otime = time
-        oalt = alt
-        olat = glat
-        olon = glon
-
         class RetObj:
             pass
         retobj = RetObj()
@@ -193,37 +168,212 @@ class GeoMag:
 
         return retobj
 
-    def __init__(self, wmm_filename=None):
+    def _spherical(self, glat, alt):
+        gm = self.geomag
+        rlat = math.radians(glat)
+        srlat = math.sin(rlat)
+        crlat = math.cos(rlat)
+        srlat2 = srlat*srlat
+        crlat2 = crlat*crlat
+
+        #/* CONVERT FROM GEODETIC COORDS. TO SPHERICAL COORDS. */
+        q = math.sqrt(gm.a2-gm.c2*srlat2)
+        q1 = alt*q
+        q2 = ((q1+gm.a2)/(q1+gm.b2))*((q1+gm.a2)/(q1+gm.b2))
+        ct = srlat/math.sqrt(q2*crlat2+srlat2)
+        st = math.sqrt(1.0-(ct*ct))
+        r2 = (alt*alt)+2.0*q1+(gm.a4-gm.c4*srlat2)/(q*q)
+        r = math.sqrt(r2)
+        d = math.sqrt(gm.a2*crlat2+gm.b2*srlat2)
+        self.ct = ct
+        self.st = st
+        self.r = r
+        self.ca = (alt+d)/r
+        self.sa = gm.c2*crlat*srlat/(r*d)
+
+        # /*
+                # COMPUTE UNNORMALIZED ASSOCIATED LEGENDRE POLYNOMIALS
+                # AND DERIVATIVES VIA RECURSION RELATIONS
+        # */
+        for n in range(1,gm.maxord+1):
+            for m in range(n+1):
+                if (n == m):
+                    self.p[m][n] = st * self.p[m-1][n-1]
+                    self.dp[m][n] = st*self.dp[m-1][n-1]+ct*self.p[m-1][n-1]
+
+                elif (n == 1 and m == 0):
+                    self.p[m][n] = ct*self.p[m][n-1]
+                    self.dp[m][n] = ct*self.dp[m][n-1]-st*self.p[m][n-1]
+
+                elif (n > 1 and n != m):
+                    if (m > n-2):
+                        self.p[m][n-2] = 0
+                    if (m > n-2):
+                        self.dp[m][n-2] = 0.0
+                    self.p[m][n] = ct*self.p[m][n-1]-gm.k[m][n]*self.p[m][n-2]
+                    self.dp[m][n] = ct*self.dp[m][n-1] - st*self.p[m][n-1]-gm.k[m][n]*self.dp[m][n-2]
+        self.oalt = alt
+        self.olat = glat
+
+    def _longitude_series(self, glon):
+        rlon = math.radians(glon)
+        self.sp[1] = math.sin(rlon)
+        self.cp[1] = math.cos(rlon)
+        for m in range(2,self.geomag.maxord+1):
+            self.sp[m] = self.sp[1]*self.cp[m-1]+self.cp[1]*self.sp[m-1]
+            self.cp[m] = self.cp[1]*self.cp[m-1]-self.sp[1]*self.sp[m-1]
+        self.olon = glon
+
+    def _time_adjust(self, time):
+        gm = self.geomag
+        dt = time - gm.epoch
+        # /*
+                # TIME ADJUST THE GAUSS COEFFICIENTS
+        # */
+        for n in range(1,gm.maxord+1):
+            for m in range(n+1):
+                self.tc[m][n] = gm.c[m][n]+dt*gm.cd[m][n]
+                if (m != 0):
+                    self.tc[n][m-1] = gm.c[n][m-1]+dt*gm.cd[n][m-1]
+        self.otime = time
+
+
+class GeoMag:
+
+    def GeoMag(self, dlat, dlon, h=0, time=date.today()): # latitude (decimal degrees), longitude (decimal degrees), altitude (feet), date
+        # Evaluate with the evaluator of the calling thread, so concurrent callers never share scratch state.
+        try:
+            evaluator = self._local.evaluator
+        except AttributeError:
+            evaluator = self._local.evaluator = self.evaluator()
+        return evaluator.GeoMag(dlat, dlon, h, time)
+
+    def evaluator(self):
+        # Return a new evaluator with its own workspace for this model.
+        return GeoMagEvaluator(self)
+
+    BATCH_DTYPE = [('dec', float), ('dip', float), ('ti', float), ('bh', float), ('bx', float), ('by', float), ('bz', float)]
+
+    def GeoMagBatch(self, dlat, dlon, h=0, time=None): # arrays of latitude, longitude (decimal degrees), altitude (feet), date
+        # Same expansion as GeoMag, but every term is evaluated for all points at once.
+        # Returns a structured array with the fields of BATCH_DTYPE and the broadcast shape of the inputs.
+        if time is None:
+            time = date.today()
+        dlat, dlon, h, time = np.broadcast_arrays(np.asarray(dlat, dtype=float), np.asarray(dlon, dtype=float),
+                                                  np.asarray(h, dtype=float), _decimal_years(time))
+        shape = dlat.shape
+        glat = dlat.ravel()
+        glon = dlon.ravel()
+        alt = h.ravel()/3280.8399
+        dt = time.ravel() - self.epoch
+        size = glat.size
+
+        rlat = np.radians(glat)
+        rlon = np.radians(glon)
+        srlat = np.sin(rlat)
+        crlat = np.cos(rlat)
+        srlat2 = srlat*srlat
+        crlat2 = crlat*crlat
+
+        #/* CONVERT FROM GEODETIC COORDS. TO SPHERICAL COORDS. */
+        q = np.sqrt(self.a2-self.c2*srlat2)
+        q1 = alt*q
+        q2 = ((q1+self.a2)/(q1+self.b2))*((q1+self.a2)/(q1+self.b2))
+        ct = srlat/np.sqrt(q2*crlat2+srlat2)
+        st = np.sqrt(1.0-(ct*ct))
+        r2 = (alt*alt)+2.0*q1+(self.a4-self.c4*srlat2)/(q*q)
+        r = np.sqrt(r2)
+        d = np.sqrt(self.a2*crlat2+self.b2*srlat2)
+        ca = (alt+d)/r
+        sa = self.c2*crlat*srlat/(r*d)
+
+        sp = np.zeros((self.maxord+1, size))
+        cp = np.ones((self.maxord+1, size))
+        sp[1] = np.sin(rlon)
+        cp[1] = np.cos(rlon)
+        for m in range(2,self.maxord+1):
+            sp[m] = sp[1]*cp[m-1]+cp[1]*sp[m-1]
+            cp[m] = cp[1]*cp[m-1]-sp[1]*sp[m-1]
+
+        c = np.array(self.c)
+        cd = np.array(self.cd)
+        p = np.zeros((self.maxord+1, self.maxord+1, size))
+        dp = np.zeros((self.maxord+1, self.maxord+1, size))
+        pp = np.zeros((self.maxord+1, size))
+        p[0][0] = 1.0
+        pp[0] = 1.0
+
+        aor = self.re/r
+        ar = aor*aor
+        br = np.zeros(size)
+        bt = np.zeros(size)
+        bp = np.zeros(size)
+        bpp = np.zeros(size)
+        for n in range(1,self.maxord+1):
+            ar = ar*aor
+            for m in range(n+1):
+                # COMPUTE UNNORMALIZED ASSOCIATED LEGENDRE POLYNOMIALS AND DERIVATIVES VIA RECURSION RELATIONS
+                if (n == m):
+                    p[m][n] = st*p[m-1][n-1]
+                    dp[m][n] = st*dp[m-1][n-1]+ct*p[m-1][n-1]
+                elif (n == 1 and m == 0):
+                    p[m][n] = ct*p[m][n-1]
+                    dp[m][n] = ct*dp[m][n-1]-st*p[m][n-1]
+                else:
+                    p[m][n] = ct*p[m][n-1]-self.k[m][n]*p[m][n-2]
+                    dp[m][n] = ct*dp[m][n-1]-st*p[m][n-1]-self.k[m][n]*dp[m][n-2]
+
+                # TIME ADJUST THE GAUSS COEFFICIENTS AND ACCUMULATE THE TERMS
+                tcmn = c[m][n]+dt*cd[m][n]
+                par = ar*p[m][n]
+                if (m == 0):
+                    temp1 = tcmn*cp[m]
+                    temp2 = tcmn*sp[m]
+                else:
+                    tcnm = c[n][m-1]+dt*cd[n][m-1]
+                    temp1 = tcmn*cp[m]+tcnm*sp[m]
+                    temp2 = tcmn*sp[m]-tcnm*cp[m]
+                bt = bt-ar*temp1*dp[m][n]
+                bp = bp + (self.fm[m] * temp2 * par)
+                br = br + (self.fn[n] * temp1 * par)
+
+                # SPECIAL CASE:  NORTH/SOUTH GEOGRAPHIC POLES (evaluated everywhere, used where st == 0)
+                if (m == 1):
+                    if (n == 1):
+                        pp[n] = pp[n-1]
+                    else:
+                        pp[n] = ct*pp[n-1]-self.k[m][n]*pp[n-2]
+                    bpp = bpp + (self.fm[m]*temp2*ar*pp[n])
+
+        pole = st == 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bp = np.where(pole, bpp, bp/np.where(pole, 1.0, st))
+
+        # ROTATE MAGNETIC VECTOR COMPONENTS FROM SPHERICAL TO GEODETIC COORDINATES
+        result = np.empty(size, dtype=self.BATCH_DTYPE)
+        result['bx'] = -bt*ca-br*sa
+        result['by'] = bp
+        result['bz'] = bt*sa-br*ca
+        # COMPUTE DECLINATION (DEC), INCLINATION (DIP) AND TOTAL INTENSITY (TI)
+        result['bh'] = np.hypot(result['bx'], result['by'])
+        result['ti'] = np.hypot(result['bh'], result['bz'])
+        result['dec'] = np.degrees(np.arctan2(result['by'], result['bx']))
+        result['dip'] = np.degrees(np.arctan2(result['bz'], result['bh']))
+        return result.reshape(shape)
+
+    COMPILED_MAGIC = b'ARBOWMM2'
+    COMPILED_HEADER = struct.Struct('<8s20sdII')
+    # A compiled file holds the header (magic, SHA-1 of the coefficient file, epoch and the lengths of the model and the
+    # model date), the model and the model date (ASCII), followed by the float64 tables c, cd (14x14), snorm and k
+    # (13x13), all in row order. It is only used for the coefficient file with the same SHA-1.
+
+    def __init__(self, wmm_filename=None, compiled=True):
+        # With compiled=True the normalized coefficient tables are loaded from a binary file next to the coefficient
+        # file when one exists for its current content, and written there otherwise.
         if not wmm_filename:
             wmm_filename = os.path.join(os.path.dirname(__file__), 'WMM.COF')
-        wmm=[]
-        with open(wmm_filename) as wmm_file:
-            for line in wmm_file:
-                linevals = line.strip().split()
-                if len(linevals) == 3:
-                    self.epoch = float(linevals[0])
-                    self.model = linevals[1]
-                    self.modeldate = linevals[2]
-                elif len(linevals) == 6:
-                    linedict = {'n': int(float(linevals[0])),
-                    'm': int(float(linevals[1])),
-                    'gnm': float(linevals[2]),
-                    'hnm': float(linevals[3]),
-                    'dgnm': float(linevals[4]),
-                    'dhnm': float(linevals[5])}
-                    wmm.append(linedict)
-
-        z = [0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0]
         self.maxord = self.maxdeg = 12
-        self.tc = [z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13]]
-        self.sp = z[0:14]
-        self.cp = z[0:14]
-        self.cp[0] = 1.0
-        self.pp = z[0:13]
-        self.pp[0] = 1.0
-        self.p = [z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14]]
-        self.p[0][0] = 1.0
-        self.dp = [z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13]]
+        self._local = threading.local()
         self.a = 6378.137
         self.b = 6356.7523142
         self.re = 6371.2
@@ -234,6 +384,96 @@ class GeoMag:
         self.b4 = self.b2*self.b2
         self.c4 = self.a4 - self.b4
 
+        self.fn = [0.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0,9.0,10.0,11.0,12.0,13.0]
+        self.fm = [0.0,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0,9.0,10.0,11.0,12.0]
+
+        with open(wmm_filename, 'rb') as wmm_file:
+            source = wmm_file.read()
+        digest = hashlib.sha1(source).digest()
+        compiled_filename = '{0}.{1}.bin'.format(wmm_filename, digest.hex()[:16])
+        tables = self._load_compiled(compiled_filename, digest) if compiled else None
+        if tables is None:
+            self._read_cof(source.decode('ascii').splitlines())
+            if compiled:
+                self._write_compiled(compiled_filename, digest)
+        else:
+            (self.epoch, self.model, self.modeldate, self.c, self.cd, self.snorm, self.k) = tables
+
+        # The normalized coefficients are shared by all evaluators and never change after construction.
+        self.c = tuple(tuple(row) for row in self.c)
+        self.cd = tuple(tuple(row) for row in self.cd)
+        self.snorm = tuple(tuple(row) for row in self.snorm)
+        self.k = tuple(tuple(row) for row in self.k)
+        self.fn = tuple(self.fn)
+        self.fm = tuple(self.fm)
+
+    def _load_compiled(self, compiled_filename, digest):
+        # Return the tables of a compiled file through a memory map, or None if there is no usable file for the
+        # coefficient file with the given SHA-1.
+        try:
+            with open(compiled_filename, 'rb') as compiled_file, \
+                    mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if len(buffer) < self.COMPILED_HEADER.size:
+                    return None
+                magic, source_digest, epoch, model_length, modeldate_length = self.COMPILED_HEADER.unpack_from(buffer)
+                start = self.COMPILED_HEADER.size+model_length+modeldate_length
+                if (magic != self.COMPILED_MAGIC or source_digest != digest or
+                        len(buffer) != start+8*(2*14*14+2*13*13)):
+                    return None
+                model = buffer[self.COMPILED_HEADER.size:self.COMPILED_HEADER.size+model_length]
+                modeldate = buffer[self.COMPILED_HEADER.size+model_length:start]
+                values = array('d')
+                with memoryview(buffer)[start:] as view:
+                    values.frombytes(view)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                values = values.tolist()
+        except (OSError, ValueError):
+            return None
+        rows = [values[i:i+14] for i in range(0, 2*14*14, 14)]
+        rows += [values[i:i+13] for i in range(2*14*14, len(values), 13)]
+        return (epoch, model.decode('ascii'), modeldate.decode('ascii'),
+                rows[0:14], rows[14:28], rows[28:41], rows[41:54])
+
+    def _write_compiled(self, compiled_filename, digest):
+        # Store the normalized tables for the coefficient file with the given SHA-1, failing silently when the
+        # directory is not writable.
+        values = array('d', [value for table in (self.c, self.cd, self.snorm, self.k) for row in table for value in row])
+        model, modeldate = self.model.encode('ascii'), self.modeldate.encode('ascii')
+        temporary_filename = '{0}.{1}.tmp'.format(compiled_filename, os.getpid())
+        try:
+            with open(temporary_filename, 'wb') as compiled_file:
+                compiled_file.write(self.COMPILED_HEADER.pack(self.COMPILED_MAGIC, digest, self.epoch, len(model),
+                                                              len(modeldate))+model+modeldate)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                values.tofile(compiled_file)
+            os.replace(temporary_filename, compiled_filename)
+        except OSError:
+            try:
+                os.remove(temporary_filename)
+            except OSError:
+                pass
+
+    def _read_cof(self, lines):
+        # Parse the lines of a coefficient file and convert the Schmidt normalized coefficients.
+        wmm=[]
+        for line in lines:
+            linevals = line.strip().split()
+            if len(linevals) == 3:
+                self.epoch = float(linevals[0])
+                self.model = linevals[1]
+                self.modeldate = linevals[2]
+            elif len(linevals) == 6:
+                linedict = {'n': int(float(linevals[0])),
+                'm': int(float(linevals[1])),
+                'gnm': float(linevals[2]),
+                'hnm': float(linevals[3]),
+                'dgnm': float(linevals[4]),
+                'dhnm': float(linevals[5])}
+                wmm.append(linedict)
+
+        z = [0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0]
         self.c = [z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14]]
         self.cd = [z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14],z[0:14]]
 
@@ -256,8 +496,6 @@ class GeoMag:
         self.snorm[0][0] = 1.0
         self.k = [z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13],z[0:13]]
         self.k[1][1] = 0.0
-        self.fn = [0.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0,9.0,10.0,11.0,12.0,13.0]
-        self.fm = [0.0,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0,9.0,10.0,11.0,12.0]
         for n in range(1,self.maxord+1):
             self.snorm[0][n] = self.snorm[0][n-1]*(2.0*n-1)/n
             j=2.0
@@ -305,5 +543,73 @@ class GeoMagTest(unittest.TestCase):
             calcval=gm.GeoMag(values[2], values[3], values[1], values[0])
             self.assertAlmostEqual(values[4], calcval.dec, 2, 'Expected %s, result %s' % (values[4], calcval.dec))
 
+    def test_threads(self):
+        gm = GeoMag()
+        points = [(lat, lon, alt, date(2015+i % 3, 1+i % 12, 1))
+                  for i, (lat, lon, alt) in enumerate((lat, lon, alt) for lat in range(-85, 90, 10)
+                                                      for lon in range(-180, 180, 30) for alt in (0, 30000))]
+        expected = [gm.evaluator().GeoMag(*point).dec for point in points]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for _ in range(3):
+                results = list(executor.map(lambda point: gm.GeoMag(*point).dec, points))
+                self.assertEqual(expected, results)
+
+    def test_incremental(self):
+        gm = GeoMag()
+        evaluator = gm.evaluator()
+        sweep = tuple((d, 1000, 45, lon, None) for d in (self.d1, self.d2) for lon in range(-180, 180, 45))
+        for values in self.test_values + sweep:
+            calcval = evaluator.GeoMag(values[2], values[3], values[1], values[0])
+            fresh = gm.evaluator().GeoMag(values[2], values[3], values[1], values[0])
+            self.assertEqual(fresh.dec, calcval.dec)
+            self.assertEqual(fresh.ti, calcval.ti)
+
+    def test_compiled(self):
+        source = os.path.join(os.path.dirname(__file__), 'WMM.COF')
+        reference = GeoMag(compiled=False)
+        with tempfile.TemporaryDirectory() as directory:
+            wmm_filename = os.path.join(directory, 'WMM.COF')
+            with open(source, 'rb') as source_file, open(wmm_filename, 'wb') as wmm_file:
+                wmm_file.write(source_file.read())
+            written = GeoMag(wmm_filename)
+            self.assertEqual(1, len([name for name in os.listdir(directory) if name.endswith('.bin')]))
+            loaded = GeoMag(wmm_filename)
+            for gm in (written, loaded):
+                self.assertEqual((reference.epoch, reference.model, reference.modeldate),
+                                 (gm.epoch, gm.model, gm.modeldate))
+                self.assertEqual((reference.c, reference.cd, reference.snorm, reference.k), (gm.c, gm.cd, gm.snorm, gm.k))
+            # Long model names are kept whole, and a compiled file only serves the coefficient file it was made from.
+            with open(source, 'rb') as source_file:
+                content = source_file.read()
+            names = ['WMM-2015-'+'extended'*5+suffix for suffix in 'AB']
+            sources = [content.replace(b'WMM-2015', name.encode('ascii'), 1) for name in names]
+            compiled = [os.path.join(directory, 'WMM.COF.{0}.bin'.format(hashlib.sha1(data).hexdigest()[:16]))
+                        for data in sources]
+            with open(wmm_filename, 'wb') as wmm_file:
+                wmm_file.write(sources[0])
+            GeoMag(wmm_filename)
+            self.assertEqual(names[0], GeoMag(wmm_filename).model)
+            with open(wmm_filename, 'wb') as wmm_file:
+                wmm_file.write(sources[1])
+            os.replace(compiled[0], compiled[1])
+            self.assertEqual(names[1], GeoMag(wmm_filename).model)
+
+    def test_declination_batch(self):
+        gm = GeoMag()
+        times, alts, lats, lons, decs = zip(*self.test_values)
+        calcvals = gm.GeoMagBatch(lats, lons, alts, times)
+        for values, calcval in zip(self.test_values, calcvals):
+            self.assertAlmostEqual(values[4], calcval['dec'], 2, 'Expected %s, result %s' % (values[4], calcval['dec']))
+            scalar = gm.GeoMag(values[2], values[3], values[1], values[0])
+            for field in ('dec', 'dip', 'ti', 'bh', 'bx', 'by', 'bz'):
+                self.assertAlmostEqual(getattr(scalar, field), calcval[field], 6)
+
+    def test_declination_batch_poles(self):
+        gm = GeoMag()
+        calcvals = gm.GeoMagBatch([90, -90, 45], 10, 0, np.array(['2016-03-01'], dtype='datetime64[D]'))
+        for lat, calcval in zip((90, -90, 45), calcvals):
+            scalar = gm.GeoMag(lat, 10, 0, date(2016, 3, 1))
+            self.assertAlmostEqual(scalar.dec, calcval['dec'], 6)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,163 @@
+""" ArboTopo - data: loop report
+
+The LoopReport of this module lists the independent loops of a survey and their closure errors.
+
+The loops form the fundamental cycle basis of the spanning tree of a PropagationAlgorithm: every shot which is not in
+the tree closes exactly one loop, the shot itself and the tree paths from its stations up to their lowest common
+ancestor. The positions propagated over the tree already contain the tree paths, so the misclosure of a loop is the
+difference of the propagated positions of the ends of its closing shot minus the (dx, dy, dz) of that shot.
+
+The depth and the distance along the tree of every station are accumulated by pointer jumping, the same pass keeps the
+2^k-th ancestors of the stations, with which the lowest common ancestors of all loops are found at once by binary
+lifting. All loops are thus reported in O((stations + shots) log(depth)) vectorized steps.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+
+
+class LoopReport:
+    """The misclosures of the fundamental loops of the spanning tree of a PropagationAlgorithm.
+
+    The loops are indexed by the order of their closing shots. For every loop the report has:
+    -shots:         the index in the survey graph of the closing shot
+    -misclosures:   the N x 3 (dx, dy, dz) by which the loop does not close, the propagated minus the measured shot
+    -errors:        the length of the misclosures
+    -lengths:       the length of the loops, the sum of the lengths of their shots
+    -shot_counts:   the number of shots of the loops
+    -ratios:        the errors relative to the lengths of the loops
+    """
+
+    def __init__(self, algorithm):
+        """Create the report of the loops of the spanning tree of the given PropagationAlgorithm."""
+        self.algorithm = algorithm
+        graph = algorithm.graph
+        in_tree = np.zeros(graph.shot_count, dtype=bool)
+        in_tree[algorithm.parent_shots[algorithm.parent_shots >= 0]] = True
+        self.shots = np.flatnonzero(~in_tree)
+        first, last = graph.shot_from[self.shots], graph.shot_to[self.shots]
+        differences = graph.differences[self.shots]
+        self.misclosures = algorithm.positions[last]-algorithm.positions[first]-differences
+        self.errors = np.sqrt(np.einsum('ij,ij->i', self.misclosures, self.misclosures))
+        self._depths, distances = self._accumulate()
+        depths = self._depths
+        ancestors = self._common_ancestors(first, last)
+        self.lengths = distances[first]+distances[last]-2*distances[ancestors] + \
+            np.sqrt(np.einsum('ij,ij->i', differences, differences))
+        self.shot_counts = depths[first]+depths[last]-2*depths[ancestors]+1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.ratios = np.where(self.lengths > 0, self.errors/self.lengths, 0.0)
+
+    def __len__(self):
+        """Return the number of loops."""
+        return len(self.shots)
+
+    def _accumulate(self):
+        """Return the depth and the distance along the tree of every station and keep the 2^k-th ancestors."""
+        algorithm = self.algorithm
+        graph = algorithm.graph
+        offsets = np.zeros((graph.station_count, 2))
+        children = np.flatnonzero(algorithm.parent_shots >= 0)
+        shot_differences = graph.differences[algorithm.parent_shots[children]]
+        offsets[children, 0] = 1
+        offsets[children, 1] = np.sqrt(np.einsum('ij,ij->i', shot_differences, shot_differences))
+        ancestors = algorithm.parents
+        self._ancestors = [ancestors]
+        while True:
+            next_ancestors = ancestors[ancestors]
+            if np.array_equal(next_ancestors, ancestors):
+                break
+            offsets += offsets[ancestors]
+            ancestors = next_ancestors
+            self._ancestors.append(ancestors)
+        return offsets[:, 0].astype(np.int64), offsets[:, 1]
+
+    def _common_ancestors(self, first, last):
+        """Return the lowest common ancestors of the given pairs of stations (of the same component)."""
+        depths = self._depths
+        first, last = first.copy(), last.copy()
+        swap = depths[first] < depths[last]
+        first[swap], last[swap] = last[swap], first[swap]
+        # Lift the deeper stations to the depth of the others, then lift both below their common ancestor.
+        lift = depths[first]-depths[last]
+        for level, ancestors in enumerate(self._ancestors):
+            selection = (lift >> level) & 1 == 1
+            first[selection] = ancestors[first[selection]]
+        for ancestors in reversed(self._ancestors):
+            selection = ancestors[first] != ancestors[last]
+            first[selection] = ancestors[first[selection]]
+            last[selection] = ancestors[last[selection]]
+        return np.where(first == last, first, self.algorithm.parents[first])
+
+    def order(self, key='ratios', descending=True):
+        """Return the indices of the loops sorted by ratios, errors, lengths or shot_counts."""
+        order = np.argsort(getattr(self, key), kind='stable')
+        return order[::-1] if descending else order
+
+    def loop(self, index):
+        """Return the shot indices of a loop, from its closing shot along the tree back to its reference point."""
+        algorithm = self.algorithm
+        graph = algorithm.graph
+        shot = self.shots[index]
+        first, last = graph.shot_from[shot], graph.shot_to[shot]
+        ancestor = self._common_ancestors(np.array([first]), np.array([last]))[0]
+        up, down = [], []
+        while last != ancestor:
+            up.append(int(algorithm.parent_shots[last]))
+            last = algorithm.parents[last]
+        while first != ancestor:
+            down.append(int(algorithm.parent_shots[first]))
+            first = algorithm.parents[first]
+        return [int(shot)]+up+down[::-1]
+
+    def rows(self, order=None):
+        """Return a list of (closing measurement, error, length, shot count, ratio) for the loops in the given order."""
+        if order is None:
+            order = self.order()
+        measurements = self.algorithm.graph.measurements
+        return [(measurements[shot], error, length, count, ratio) for shot, error, length, count, ratio in
+                zip(self.shots[order].tolist(), self.errors[order].tolist(), self.lengths[order].tolist(),
+                    self.shot_counts[order].tolist(), self.ratios[order].tolist())]
+
+
+class LoopReportTest(unittest.TestCase):
+
+    def test_report(self):
+        from data.dataset import Dataset
+        from data.propagation_algorithm import PropagationAlgorithm
+        dataset = Dataset({}, 'loops', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        # A square of 10 meter with 0.2 meter misclosure, a separate closed triangle and a shot from a station to
+        # itself.
+        shots = ((0, 1, 0.0, 10.2), (1, 2, 90.0, 10.0), (2, 3, 180.0, 10.0), (3, 0, 270.0, 10.0), (10, 11, 0.0, 3.0),
+                 (11, 12, 90.0, 4.0), (12, 10, 233.13010235415598, 5.0), (3, 3, 0.0, 1.0))
+        for index, (refpoint, point, compass, distance) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=distance,
+                                    compass=compass, inclination=0.0)
+        algorithm = PropagationAlgorithm(dataset)
+        report = LoopReport(algorithm)
+        graph = algorithm.graph
+        self.assertEqual(graph.shot_count-graph.station_count+graph.connected_components()[0], len(report))
+        by_shot = dict(zip(report.shots.tolist(), range(len(report))))
+        loops = {frozenset(report.loop(index)): index for index in range(len(report))}
+        self.assertEqual(3, len(loops))
+        for index in range(len(report)):
+            self.assertEqual(len(report.loop(index)), report.shot_counts[index])
+        square = [index for index in range(len(report)) if report.shot_counts[index] == 4]
+        self.assertEqual(1, len(square))
+        self.assertAlmostEqual(0.2, report.errors[square[0]], 9)
+        self.assertAlmostEqual(40.2, report.lengths[square[0]], 9)
+        self.assertAlmostEqual(0.2/40.2, report.ratios[square[0]], 9)
+        self.assertEqual([by_shot[7], square[0]], report.order()[:2].tolist())
+        self.assertEqual(1, report.shot_counts[by_shot[7]])
+        self.assertAlmostEqual(1.0, report.errors[by_shot[7]], 9)
+        for index in range(len(report)):
+            if index != square[0] and index != by_shot[7]:
+                self.assertAlmostEqual(0.0, report.errors[index], 9)
+        self.assertIs(graph.measurements[report.shots[square[0]]], report.rows()[1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+""" ArboTopo - data: map exporter
+
+The MapExporter of this module writes the map of a View (its walls, centerlines and station labels) as a single SVG or
+PDF document at a given scale.
+
+The document is produced by a generator of chunks of bytes which are written to a buffered stream as they come, so it
+is never held in memory as a whole. The segments of the View are taken and formatted in blocks of BLOCK_SIZE stations
+(the walls of all blocks first, then the centerlines), the labels in blocks of BLOCK_SIZE stations as well, every
+block in one string operation. The PDF is a single page with one content stream. Its length and the offsets of its objects are
+counted while the chunks are written, the length of the stream is an indirect object after it.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+from xml.sax.saxutils import escape
+import numpy as np
+from data.view import CENTERLINE, STYLES, WALL
+
+
+class MapExporter:
+    """An exporter of the map of a View to SVG or PDF."""
+
+    BLOCK_SIZE = 4096
+    """The number of stations of which the segments or labels are formatted per chunk."""
+
+    BUFFER_SIZE = 2**16
+    """The size in bytes of the buffer of the output file."""
+
+    POINTS_PER_METER = 72/0.0254
+    """The number of points (the unit of the documents) in a meter."""
+
+    TOLERANCE = 0.25
+    """The distance in points over which centerlines are simplified."""
+
+    def __init__(self, view, scale=500, margin=36.0, labels=True, font_size=6.0):
+        """Create an exporter of the map of a View.
+
+        -scale:     the denominator of the scale of the map (1:scale)
+        -margin:    the margin around the map in points
+        -labels:    whether the stations are labeled with their names
+        -font_size: the size of the labels in points
+        """
+        self.view = view
+        self.scale = scale
+        self.margin = margin
+        self.labels = labels
+        self.font_size = font_size
+        self.factor = self.POINTS_PER_METER/scale
+        points = np.concatenate((view.stations, view.sections.reshape(-1, 2)))
+        points = points[np.all(np.isfinite(points), axis=1)]
+        self.minimum = points.min(axis=0) if len(points) else np.zeros(2)
+        self.maximum = points.max(axis=0) if len(points) else np.zeros(2)
+        self.width, self.height = ((self.maximum-self.minimum)*self.factor+2*margin).tolist()
+
+    def page_coordinates(self, points, flip):
+        """Return the N x 2 page coordinates (points) of N x 2 map coordinates, with y down if flip."""
+        if flip:
+            return (points-(self.minimum[0], self.maximum[1]))*(self.factor, -self.factor)+self.margin
+        return (points-self.minimum)*self.factor+self.margin
+
+    def _blocks(self, flip):
+        """Yield the kind and the N x 4 page coordinates of blocks of segments, the walls first."""
+        for kind in (WALL, CENTERLINE):
+            for segments, kinds in self.view.segment_blocks(tolerance=self.TOLERANCE/self.factor,
+                                                            block_size=self.BLOCK_SIZE):
+                block = segments[kinds == kind]
+                if len(block):
+                    yield kind, self.page_coordinates(block.reshape(-1, 2), flip).reshape(-1, 4)
+
+    def _label_blocks(self, flip):
+        """Yield blocks of the names and the N x 2 page coordinates of the stations."""
+        if not self.labels:
+            return
+        names = self.view.algorithm.graph.stations
+        for start in range(0, len(names), self.BLOCK_SIZE):
+            yield (names[start:start+self.BLOCK_SIZE],
+                   self.page_coordinates(self.view.stations[start:start+self.BLOCK_SIZE], flip)+(1.0, 0.0))
+
+    def svg_chunks(self):
+        """Yield the chunks of bytes of the SVG document."""
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n<svg xmlns="http://www.w3.org/2000/svg" width="{width:.2f}pt" '
+               'height="{height:.2f}pt" viewBox="0 0 {width:.2f} {height:.2f}">\n').format(
+            width=self.width, height=self.height).encode('utf-8')
+        for kind, block in self._blocks(True):
+            yield ('<path stroke="{color}" stroke-width="0.5" fill="none" d="'.format(color=STYLES[kind][0]) +
+                   'M%.2f %.2fL%.2f %.2f'*len(block) % tuple(block.ravel().tolist())+'"/>\n').encode('utf-8')
+        for names, positions in self._label_blocks(True):
+            yield '<g font-family="Helvetica" font-size="{size}">\n{labels}</g>\n'.format(
+                size=self.font_size, labels=''.join('<text x="{0:.2f}" y="{1:.2f}">{2}</text>\n'.format(
+                    x, y, escape(str(name))) for name, (x, y) in zip(names, positions.tolist()))).encode('utf-8')
+        yield b'</svg>\n'
+
+    @staticmethod
+    def _pdf_string(text):
+        """Return a PDF string of the text."""
+        text = str(text).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        return b'(' + text.encode('latin-1', 'replace') + b')'
+
+    def _pdf_content(self):
+        """Yield the chunks of bytes of the content stream of the page."""
+        yield b'1 J 1 j 0.5 w\n'
+        for kind, block in self._blocks(False):
+            color = ' '.join('{0:.3f}'.format(channel/255) for channel in STYLES[kind][1])
+            yield ('{color} RG\n'.format(color=color) + '%.2f %.2f m %.2f %.2f l\n'*len(block) %
+                   tuple(block.ravel().tolist())+'S\n').encode('ascii')
+        for names, positions in self._label_blocks(False):
+            yield b''.join([b'BT /F1 %.1f Tf\n' % self.font_size] +
+                           [b'1 0 0 1 %.2f %.2f Tm %s Tj\n' % (x, y, self._pdf_string(name))
+                            for name, (x, y) in zip(names, positions.tolist())]+[b'ET\n'])
+
+    def pdf_chunks(self):
+        """Yield the chunks of bytes of the PDF document."""
+        offsets = []
+        position = 0
+        objects = (b'<< /Type /Catalog /Pages 2 0 R >>',
+                   b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+                   b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Contents 5 0 R '
+                   b'/Resources << /Font << /F1 4 0 R >> >> >>' % (self.width, self.height),
+                   b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+        chunk = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        for number, content in enumerate(objects, 1):
+            offsets.append(position+len(chunk))
+            chunk += b'%d 0 obj\n%s\nendobj\n' % (number, content)
+        offsets.append(position+len(chunk))
+        chunk += b'5 0 obj\n<< /Length 6 0 R >>\nstream\n'
+        yield chunk
+        position += len(chunk)
+        length = 0
+        for chunk in self._pdf_content():
+            yield chunk
+            length += len(chunk)
+        position += length
+        chunk = b'\nendstream\nendobj\n'
+        offsets.append(position+len(chunk))
+        chunk += b'6 0 obj\n%d\nendobj\n' % length
+        xref = position+len(chunk)
+        chunk += b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets)+1)
+        chunk += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        chunk += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets)+1, xref)
+        yield chunk
+
+    def chunks(self, format):
+        """Yield the chunks of bytes of the document in the given format ('svg' or 'pdf')."""
+        if format == 'svg':
+            return self.svg_chunks()
+        if format == 'pdf':
+            return self.pdf_chunks()
+        raise ValueError("Unknown format '{format}'.".format(format=format))
+
+    def write(self, output, format=None):
+        """Write the document to a filename or a binary stream, in the format of the extension of the filename if None.
+        """
+        if isinstance(output, str):
+            if format is None:
+                format = output.rsplit('.', 1)[-1].lower()
+            with open(output, 'wb', buffering=self.BUFFER_SIZE) as output_file:
+                self.write(output_file, format)
+            return
+        for chunk in self.chunks(format):
+            output.write(chunk)
+
+
+class MapExporterTest(unittest.TestCase):
+
+    def create_view(self):
+        from data.dataset import Dataset
+        from data.point import Point
+        from data.propagation_algorithm import PropagationAlgorithm
+        from data.topo_point import TopoPoint
+        from data.view import View
+        dataset = Dataset({}, 'cave', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        for index in range(10):
+            dataset.add_measurement(None, str(index), 'compass', point=index+1, refpoint=index, distance=10.0,
+                                    compass=90.0 if index % 2 else 0.0, inclination=0.0)
+        dataset.add_measurement(None, 'side', 'compass', point='<side (1)>', refpoint=4, distance=5.0, compass=270.0,
+                                inclination=0.0)
+        algorithm = PropagationAlgorithm(dataset, origin=0)
+        topo_points = dict(algorithm.get_topo_points())
+        x, y, z = topo_points[0].p.xyz()
+        topo_points[0] = TopoPoint(0, Point(x, y, z), l=Point(x-1, y, z), r=Point(x+1, y, z))
+        x, y, z = topo_points[1].p.xyz()
+        topo_points[1] = TopoPoint(1, Point(x, y, z), l=Point(x-1, y, z), r=Point(x+1, y, z))
+        return View(algorithm, topo_points=topo_points)
+
+    def test_svg(self):
+        import io
+        import xml.etree.ElementTree as ElementTree
+        exporter = MapExporter(self.create_view())
+        exporter.BLOCK_SIZE = 2
+        output = io.BytesIO()
+        exporter.write(output, 'svg')
+        root = ElementTree.fromstring(output.getvalue())
+        namespace = '{http://www.w3.org/2000/svg}'
+        texts = [text.text for text in root.iter(namespace+'text')]
+        self.assertEqual(12, len(texts))
+        self.assertIn('<side (1)>', texts)
+        # Two walls and the 11 legs of the centerline, in blocks of at most two segments.
+        segments = [path.get('d').count('M') for path in root.iter(namespace+'path')]
+        self.assertEqual(13, sum(segments))
+        self.assertLessEqual(max(segments), 2)
+        # The walls at 0 extend the map to x = -1, 1:500 is 5.67 points per meter.
+        self.assertAlmostEqual(51*exporter.factor+2*exporter.margin, exporter.width, 9)
+
+    def test_pdf(self):
+        import io
+        import re
+        exporter = MapExporter(self.create_view(), scale=1000)
+        exporter.BLOCK_SIZE = 3
+        self.assertTrue(all(len(chunk) < 1000 for chunk in exporter.chunks('pdf')))
+        output = io.BytesIO()
+        exporter.write(output, 'pdf')
+        data = output.getvalue()
+        self.assertTrue(data.startswith(b'%PDF-1.4') and data.endswith(b'%%EOF\n'))
+        xref = int(re.search(rb'startxref\n(\d+)', data).group(1))
+        self.assertTrue(data[xref:].startswith(b'xref\n0 7\n'))
+        offsets = [int(line[:10]) for line in data[xref:].split(b'\n')[3:9]]
+        for number, offset in enumerate(offsets, 1):
+            self.assertTrue(data[offset:].startswith(b'%d 0 obj' % number))
+        start = data.index(b'stream\n')+len(b'stream\n')
+        length = int(re.search(rb'6 0 obj\n(\d+)', data).group(1))
+        self.assertEqual(b'\nendstream', data[start+length:start+length+10])
+        self.assertIn(b'(<side \\(1\\)>) Tj', data)
+        self.assertRaises(ValueError, exporter.chunks, 'png')
+
+
+if __name__ == '__main__':
+    unittest.main()
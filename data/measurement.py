@@ -9,11 +9,13 @@ copyright (C) 2016 Bram Rooseleer
 class Measurement:
     """An abstract measurement."""
 
+    __slots__ = ('dataset', 'name', 'point', 'group', 'device', 'remarks', 'data')
+
     @staticmethod
     def create_measurement(device, **kwargs):
         """A factory function to create a measurement of the correct device with the given arguments."""
         cls = device.get_measurement_cls()
-        return cls(**kwargs)
+        return cls(device=device, **kwargs)
 
     def __init__(self, dataset, name, point, group=None, device=None, remarks=None, **kwargs):
         """Create a measurement for a dataset."""
@@ -29,6 +31,8 @@ class Measurement:
 class AbsoluteMeasurement(Measurement):
     """A measurement of an absolute position."""
 
+    __slots__ = ('_x', '_y', '_z')
+
     @property
     def x(self):
         """Return the x-coordinate of the measured point."""
@@ -58,12 +62,14 @@ class AbsoluteMeasurement(Measurement):
 
     def _calculate_position(self):
         """Calculate the position of the measured point."""
-        (self._x, self_y, self_z) = self.device.calculate_position(self.data)
+        (self._x, self._y, self._z) = self.device.calculate_position(self.data)
 
 
 class RelativeMeasurement(Measurement):
     """A measurement of the difference between two positions."""
 
+    __slots__ = ('refpoint', '_dx', '_dy', '_dz')
+
     def __init__(self, refpoint, **kwargs):
         """Create a relative measurement for a dataset."""
         Measurement.__init__(self, **kwargs)
@@ -98,4 +104,4 @@ class RelativeMeasurement(Measurement):
 
     def _calculate_position(self):
         """Calculate the different between the two points."""
-        (self._dx, self_dy, self_dz) = self.device.calculate_difference(self.data)
\ No newline at end of file
+        (self._dx, self._dy, self._dz) = self.device.calculate_difference(self.data)
\ No newline at end of file
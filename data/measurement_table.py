@@ -0,0 +1,294 @@
+""" ArboTopo - data: measurement table
+
+This class stores the measurements of a dataset in columns instead of one object per measurement.
+
+Station names and devices are interned to integer ids, the distance, compass and inclination readings are stored in
+typed float arrays (NaN when missing). Other fields are only stored for the rows that have them. The table behaves like
+the dict of measurements of a Dataset: it maps the measurement names on lightweight views which offer the Measurement
+API and read their fields from the table.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from data.measurement import AbsoluteMeasurement, RelativeMeasurement
+
+
+class MeasurementTable:
+    """A columnar store of measurements, used as the measurements of a Dataset."""
+
+    READINGS = ('distance', 'compass', 'inclination')
+    """The readings which are stored in float columns."""
+
+    def __init__(self, dataset, capacity=64):
+        """Create an empty table for the given dataset."""
+        self.dataset = dataset
+        self.names = []
+        self.stations = []
+        self.devices = []
+        self._index = {}
+        self._station_ids = {}
+        self._device_ids = {}
+        self._extra = {}
+        self._size = 0
+        self._point = np.empty(capacity, dtype=np.int32)
+        self._refpoint = np.empty(capacity, dtype=np.int32)
+        self._device = np.empty(capacity, dtype=np.int32)
+        self._relative = np.empty(capacity, dtype=bool)
+        self._readings = np.empty((len(self.READINGS), capacity))
+
+    def _grow(self):
+        """Double the capacity of the columns."""
+        capacity = 2*len(self._point)
+        for column in ('_point', '_refpoint', '_device', '_relative'):
+            old = getattr(self, column)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, column, new)
+        readings = np.empty((len(self.READINGS), capacity))
+        readings[:, :self._size] = self._readings[:, :self._size]
+        self._readings = readings
+
+    def station_id(self, name):
+        """Return the integer id of the station with the given name, intern it if needed."""
+        try:
+            return self._station_ids[name]
+        except KeyError:
+            self._station_ids[name] = len(self.stations)
+            self.stations.append(name)
+            return self._station_ids[name]
+
+    def device_id(self, device):
+        """Return the integer id of the given device, intern it if needed."""
+        try:
+            return self._device_ids[device]
+        except KeyError:
+            self._device_ids[device] = len(self.devices)
+            self.devices.append(device)
+            return self._device_ids[device]
+
+    def add(self, device, name, point, refpoint=None, **kwargs):
+        """Add a measurement made with the given device and return its row."""
+        if self._size == len(self._point):
+            self._grow()
+        row = self._size
+        self._write(row, device, point, refpoint, kwargs)
+        self.names.append(name)
+        self._index[name] = row
+        self._size += 1
+        return row
+
+    def set(self, device, name, point, refpoint=None, **kwargs):
+        """Replace the measurement with the given name and return its row."""
+        row = self._index[name]
+        self._write(row, device, point, refpoint, kwargs)
+        return row
+
+    def _write(self, row, device, point, refpoint, kwargs):
+        """Write the fields of a measurement in the given row."""
+        relative = issubclass(device.get_measurement_cls(), RelativeMeasurement)
+        self._point[row] = self.station_id(point)
+        self._refpoint[row] = self.station_id(refpoint) if relative else -1
+        self._device[row] = self.device_id(device)
+        self._relative[row] = relative
+        for index, reading in enumerate(self.READINGS):
+            self._readings[index, row] = kwargs.pop(reading, np.nan)
+        if kwargs:
+            self._extra[row] = kwargs
+        else:
+            self._extra.pop(row, None)
+
+    @property
+    def point(self):
+        """Return the station ids of the measured points."""
+        return self._point[:self._size]
+
+    @property
+    def refpoint(self):
+        """Return the station ids of the reference points (-1 for absolute measurements)."""
+        return self._refpoint[:self._size]
+
+    @property
+    def device(self):
+        """Return the device ids."""
+        return self._device[:self._size]
+
+    @property
+    def relative(self):
+        """Return a mask of the relative measurements."""
+        return self._relative[:self._size]
+
+    @property
+    def distance(self):
+        """Return the distance readings."""
+        return self._readings[0, :self._size]
+
+    @property
+    def compass(self):
+        """Return the compass readings."""
+        return self._readings[1, :self._size]
+
+    @property
+    def inclination(self):
+        """Return the inclination readings."""
+        return self._readings[2, :self._size]
+
+    def row_data(self, row):
+        """Return the data dict of the measurement in the given row, as Measurement.data."""
+        data = {reading: float(self._readings[index, row]) for index, reading in enumerate(self.READINGS)
+                if not np.isnan(self._readings[index, row])}
+        for key, value in self._extra.get(row, {}).items():
+            if key not in ('group', 'remarks'):
+                data[key] = value
+        return data
+
+    def row_field(self, row, name):
+        """Return the group or remarks field of the measurement in the given row."""
+        return self._extra.get(row, {}).get(name)
+
+    def view(self, row):
+        """Return a view with the Measurement API on the given row."""
+        if self._relative[row]:
+            return RelativeMeasurementView(self, row)
+        return AbsoluteMeasurementView(self, row)
+
+    def calculate_differences(self):
+        """Reduce all relative measurements at once.
+
+        Return a list of views on the relative measurements and a contiguous N x 3 array with their (dx, dy, dz).
+        """
+        rows = np.flatnonzero(self.relative)
+        result = np.empty((len(rows), 3))
+        devices = self.device[rows]
+        for device_id, device in enumerate(self.devices):
+            selection = np.flatnonzero(devices == device_id)
+            if len(selection):
+                selected = rows[selection]
+                result[selection] = device.reduce(self.distance[selected], self.compass[selected],
+                                                  self.inclination[selected])
+        return [RelativeMeasurementView(self, row) for row in rows.tolist()], result
+
+    def __len__(self):
+        """Return the number of measurements."""
+        return self._size
+
+    def __contains__(self, name):
+        """Return whether a measurement with the given name exists."""
+        return name in self._index
+
+    def __getitem__(self, name):
+        """Return a view on the measurement with the given name."""
+        return self.view(self._index[name])
+
+    def __iter__(self):
+        """Iterate over the measurement names."""
+        return iter(self.names)
+
+    def keys(self):
+        """Return the measurement names."""
+        return list(self.names)
+
+    def values(self):
+        """Return views on all measurements."""
+        return [self.view(row) for row in range(self._size)]
+
+    def items(self):
+        """Return (name, view) pairs for all measurements."""
+        return [(name, self.view(row)) for row, name in enumerate(self.names)]
+
+
+class MeasurementView:
+    """A mixin offering the fields of a Measurement from a row of a MeasurementTable."""
+
+    __slots__ = ()
+
+    def __init__(self, table, row):
+        """Create a view on a row of the table."""
+        self.table = table
+        self.row = row
+
+    @property
+    def dataset(self):
+        """Return the dataset of the measurement."""
+        return self.table.dataset
+
+    @property
+    def name(self):
+        """Return the name of the measurement."""
+        return self.table.names[self.row]
+
+    @property
+    def point(self):
+        """Return the name of the measured point."""
+        return self.table.stations[self.table._point[self.row]]
+
+    @property
+    def device(self):
+        """Return the device of the measurement."""
+        return self.table.devices[self.table._device[self.row]]
+
+    @property
+    def group(self):
+        """Return the group of the measurement."""
+        return self.table.row_field(self.row, 'group')
+
+    @property
+    def remarks(self):
+        """Return the remarks on the measurement."""
+        return self.table.row_field(self.row, 'remarks')
+
+    @property
+    def data(self):
+        """Return the measured data as a dict."""
+        return self.table.row_data(self.row)
+
+
+class AbsoluteMeasurementView(MeasurementView, AbsoluteMeasurement):
+    """A view on an absolute measurement in a MeasurementTable."""
+
+    __slots__ = ('table', 'row')
+
+
+class RelativeMeasurementView(MeasurementView, RelativeMeasurement):
+    """A view on a relative measurement in a MeasurementTable."""
+
+    __slots__ = ('table', 'row')
+
+    @property
+    def refpoint(self):
+        """Return the name of the reference point."""
+        return self.table.stations[self.table._refpoint[self.row]]
+
+
+class MeasurementTableTest(unittest.TestCase):
+
+    def test_table(self):
+        from data.dataset import Dataset
+        datasets = {}
+        dataset = Dataset(datasets, 'table', columnar=True)
+        reference = Dataset(datasets, 'objects')
+        for target in (dataset, reference):
+            target.add_device('DCIDevice', 'compass', declination=1.0)
+            target.add_device('DistoX', 'disto', angleref='ver')
+            for index in range(100):
+                target.add_measurement(None, 'm{0}'.format(index), ('compass', 'disto')[index % 3 == 0],
+                                       point=str(index+1), refpoint=str(index), distance=1.0+index/10.0,
+                                       compass=index*3.6, inclination=index-50.0, remarks='shot {0}'.format(index))
+        self.assertIsInstance(dataset.measurements, MeasurementTable)
+        self.assertEqual(100, len(dataset.measurements))
+        self.assertEqual(101, len(dataset.measurements.stations))
+        view = dataset.get_measurement('m42')
+        original = reference.get_measurement('m42')
+        for field in ('name', 'point', 'refpoint', 'group', 'remarks', 'data', 'dx', 'dy', 'dz'):
+            self.assertEqual(getattr(original, field), getattr(view, field))
+        self.assertIs(dataset, view.dataset)
+        self.assertIsInstance(view, RelativeMeasurement)
+        views, differences = dataset.calculate_differences()
+        expected = reference.calculate_differences()[1]
+        self.assertEqual([measurement.name for measurement in views], dataset.measurements.keys())
+        self.assertTrue(np.allclose(expected, differences, rtol=0, atol=1e-12))
+
+
+if __name__ == '__main__':
+    unittest.main()
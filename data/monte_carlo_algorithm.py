@@ -0,0 +1,219 @@
+""" ArboTopo - data: monte carlo algorithm
+
+The MonteCarloAlgorithm of this module calculates the full covariance of the propagated positions by sampling.
+
+The positions are those of the PropagationAlgorithm. The readings of the shots of the spanning tree (only those
+influence the positions) are perturbed with normally distributed errors: the distance, compass and inclination of shots
+of DCIDevices by the errors of their devices, the (dx, dy, dz) of other shots relative to their length. The positions of
+fixes with errors are perturbed as well. Every sample is reduced and propagated over the tree like the positions
+themselves, and the covariance of every station is estimated from the deviations of its sampled positions. Unlike the
+analytic errors of the Points, these include the nonlinearity of the reduction.
+
+The samples are processed in chunks: an S x N array of readings is reduced at once and the positions of all stations of
+all samples in the chunk are accumulated in a single prefix sum over the stations in preorder of the tree, in which
+every shot is added at the first station of its subtree and subtracted after the last one. The chunks are sized to stay
+within the given memory, and the random numbers are drawn such that the result does not depend on the size of the
+chunks.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import depth_first_order
+from data.algorithm import Algorithm
+from data.device import DCIDevice
+from data.point import Point
+from data.propagation_algorithm import PropagationAlgorithm
+from data.topo_point import TopoPoint
+
+
+class MonteCarloAlgorithm(PropagationAlgorithm):
+    """An algorithm which propagates coordinates over a spanning tree and samples their covariance."""
+
+    DEFAULT_ERRORS = (0.025, 1.0, 1.0)
+    """The std of the distance (meter), compass and inclination (degrees) readings of devices which have no errors."""
+
+    CACHE_PARAMETERS = PropagationAlgorithm.CACHE_PARAMETERS+('samples', 'relative_error', 'seed')
+    """The names of the attributes the results depend on besides the dataset (not the memory used by a chunk)."""
+
+    def __init__(self, dataset, origin=None, origin_position=(0.0, 0.0, 0.0), samples=1000, relative_error=0.01,
+                 seed=None, memory=2**28, incremental=False, cache=None):
+        """Create the algorithm and calculate the TopoPoints.
+
+        -origin:            the name of the station used as root of its component if that component has no fix
+        -origin_position:   the (x, y, z) of the roots without a fix
+        -samples:           the number of samples
+        -relative_error:    the std per coordinate of shots of devices other than DCIDevices, relative to their length
+        -seed:              the seed of the random numbers, None for a random seed
+        -memory:            the approximate number of bytes used by a chunk of samples
+        -incremental:       recalculate the TopoPoints when measurements are added or edited
+        -cache:             a ResultCache to restore the positions and TopoPoints from if the dataset did not change,
+                            only used with a seed (the means and covariances are then not available)
+        """
+        self.samples = samples
+        self.relative_error = relative_error
+        self.seed = seed
+        self.memory = memory
+        # Without a seed every run gives other samples, so there is nothing to restore.
+        PropagationAlgorithm.__init__(self, dataset, origin, origin_position, incremental,
+                                      None if seed is None else cache)
+
+    def _recalculate(self):
+        """Recalculate the TopoPoints."""
+        PropagationAlgorithm._recalculate(self)
+        self.means, self.covariances = self._sample()
+
+    def measurement_changed(self, event, measurement, old=None):
+        """Recalculate the TopoPoints after a measurement is added or edited, every change affects all samples."""
+        Algorithm.measurement_changed(self, event, measurement, old)
+
+    def _sample(self):
+        """Return the N x 3 means and the N x 3 x 3 covariances of the sampled positions."""
+        graph = self.graph
+        size = graph.station_count
+        children = np.flatnonzero(self.parent_shots >= 0)
+        shots = self.parent_shots[children]
+        signs = self.parent_signs[children].astype(float)
+        differences = graph.differences[shots]
+        # The readings and their std per device, the (dx, dy, dz) and their std for other devices, both as 3 x M.
+        devices = {}
+        for index, shot in enumerate(shots.tolist()):
+            devices.setdefault(graph.measurements[shot].device, []).append(index)
+        readings = []
+        for device, indices in devices.items():
+            indices = np.asarray(indices, dtype=np.int64)
+            if isinstance(device, DCIDevice):
+                errors = [default if error is None else error for error, default in
+                          zip((device.distance_error, device.compass_error, device.inclination_error),
+                              self.DEFAULT_ERRORS)]
+                readings.append((device, indices, np.stack(device.readings(differences[indices])),
+                                 np.asarray(errors, dtype=float)[:, np.newaxis]))
+            else:
+                length = np.sqrt(np.einsum('ij,ij->i', differences[indices], differences[indices]))
+                readings.append((None, indices, None, (self.relative_error*length)[np.newaxis]))
+        fixes = {}
+        for station, fix in zip(graph.fix_stations.tolist(), graph.fixes):
+            fixes.setdefault(station, fix)
+        root_errors = np.zeros((3, len(self.roots)))
+        for component, root in enumerate(self.roots.tolist()):
+            if root in fixes and fixes[root].device.position_error() is not None:
+                root_errors[:, component] = fixes[root].device.position_error()
+        preorder, ends = self._preorder()
+        # The shots are added at the preorder index of their child and subtracted at the end of its subtree.
+        scatter = csr_matrix((np.concatenate((signs, -signs)),
+                              (np.concatenate((preorder[children], ends[children])),
+                               np.tile(np.arange(len(shots)), 2))), shape=(size+1, len(shots)))
+        # Per sample, a chunk holds the random numbers (twice), the readings, the reduced shots and the deviations
+        # of the positions, all 3 x M or 3 x N.
+        chunk = max(1, int(self.memory // (8*3*(2*(len(shots)+len(self.roots))+3*len(shots)+2*size))))
+        generator = np.random.default_rng(self.seed)
+        sums = np.zeros((3, size))
+        products = np.zeros((size, 3, 3))
+        for start in range(0, self.samples, chunk):
+            count = min(chunk, self.samples-start)
+            # The samples are the last axis, the random numbers are drawn per sample.
+            noise = np.ascontiguousarray(generator.standard_normal((count, len(shots)+len(self.roots), 3)).T)
+            # The deviations of the sampled shots from the shots.
+            sampled = np.empty((3, len(shots), count))
+            for device, indices, values, errors in readings:
+                perturbed = noise[:, indices]*errors[:, :, np.newaxis]
+                if device is None:
+                    sampled[:, indices] = perturbed
+                    continue
+                perturbed += values[:, :, np.newaxis]
+                reduced = np.empty((3, len(indices)*count))
+                device.reduce(perturbed[0].ravel(), perturbed[1].ravel(), perturbed[2].ravel(), out=reduced.T)
+                sampled[:, indices] = reduced.reshape(3, len(indices), count)-differences[indices].T[:, :, np.newaxis]
+            deviations = np.empty((3, size, count))
+            root_deviations = noise[:, len(shots):]*root_errors[:, :, np.newaxis]
+            for axis in range(3):
+                offsets = scatter.dot(sampled[axis])
+                np.cumsum(offsets, axis=0, out=offsets)
+                np.add(offsets[preorder], root_deviations[axis, self.labels], out=deviations[axis])
+            sums += deviations.sum(axis=2)
+            for i in range(3):
+                for j in range(i, 3):
+                    products[:, i, j] += np.einsum('ij,ij->i', deviations[i], deviations[j])
+        means = sums.T/self.samples
+        products[:, 1, 0], products[:, 2, 0], products[:, 2, 1] = products[:, 0, 1], products[:, 0, 2], products[:, 1, 2]
+        covariances = (products-self.samples*means[:, :, np.newaxis]*means[:, np.newaxis])/max(self.samples-1, 1)
+        return self.positions+means, covariances
+
+    def _preorder(self):
+        """Return the index of every station in preorder of the spanning tree and the index after its subtree.
+
+        The preorder is a depth first search (scipy), the sizes of the subtrees are summed by pointer jumping.
+        """
+        size = self.graph.station_count
+        children = np.flatnonzero(self.parent_shots >= 0)
+        # A virtual station is the parent of all roots.
+        rows = np.concatenate((self.parents[children], np.full(len(self.roots), size)))
+        columns = np.concatenate((children, self.roots))
+        tree = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(size+1, size+1))
+        order = depth_first_order(tree, size, directed=True, return_predecessors=False)[1:]
+        preorder = np.empty(size, dtype=np.int64)
+        preorder[order] = np.arange(size)
+        # After k steps the sizes count the descendants up to 2^k - 1 levels below, the ancestors beyond the roots are
+        # a sentinel.
+        sizes = np.append(np.ones(size, dtype=np.int64), 0)
+        ancestors = np.full(size+1, size, dtype=np.int64)
+        ancestors[children] = self.parents[children]
+        while np.any(ancestors[:size] != size):
+            sizes += np.bincount(ancestors, sizes, size+1).astype(np.int64)
+            sizes[size] = 0
+            ancestors = ancestors[ancestors]
+        return preorder, preorder+sizes[:size]
+
+    def get_topo_points(self):
+        """Return a dict mapping the station names on the calculated topo points, with their sampled covariance."""
+        if self._topo_points is None:
+            self._topo_points = {name: TopoPoint(name, Point(x, y, z, covariance=covariance)) for name, (x, y, z),
+                                 covariance in zip(self.graph.stations, self.positions.tolist(),
+                                                   self.covariances.tolist())}
+        return self._topo_points
+
+
+class MonteCarloAlgorithmTest(unittest.TestCase):
+
+    def create_traverse(self):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'traverse', columnar=True)
+        dataset.add_device('DCIDevice', 'compass', distance_error=0.05, compass_error=2.0, inclination_error=1.0)
+        dataset.add_device('GPS', 'gps', error=0.3, vertical_error=1.0)
+        dataset.add_measurement(None, 'entrance', 'gps', point=0, x=10.0, y=20.0, z=30.0)
+        for index, (compass, inclination) in enumerate(((30.0, -10.0), (120.0, 20.0), (200.0, 5.0))):
+            dataset.add_measurement(None, str(index), 'compass', point=index+1, refpoint=index, distance=20.0,
+                                    compass=compass, inclination=inclination)
+        # A loop which is not in the spanning tree and a separate component without fix.
+        dataset.add_measurement(None, 'loop', 'compass', point=3, refpoint=0, distance=5.0, compass=0.0,
+                                inclination=0.0)
+        dataset.add_measurement(None, 'other', 'compass', point='y', refpoint='x', distance=5.0, compass=0.0,
+                                inclination=0.0)
+        return dataset
+
+    def test_covariance(self):
+        dataset = self.create_traverse()
+        algorithm = MonteCarloAlgorithm(dataset, samples=20000, seed=1)
+        graph = algorithm.graph
+        device = dataset.get_device('compass')
+        # The analytic covariance (linearized) of station 2: the fix plus the two shots to it in the spanning tree.
+        shots = [graph.shot_index(dataset.get_measurement(str(index))) for index in range(2)]
+        expected = np.diag((0.09, 0.09, 1.0))+device.reduce_covariance(*device.readings(graph.differences[shots])).sum(
+            axis=0)
+        station = graph.station_ids[2]
+        self.assertTrue(np.allclose(expected, algorithm.covariances[station], rtol=0, atol=0.05*expected.max()))
+        self.assertTrue(np.allclose(algorithm.positions[station], algorithm.means[station], rtol=0, atol=0.05))
+        # The root without a fix is exact, up to the rounding of the prefix sum.
+        self.assertTrue(np.allclose(np.zeros((3, 3)), algorithm.covariances[graph.station_ids['y']], rtol=0,
+                                    atol=1e-24))
+        self.assertAlmostEqual(np.sqrt(algorithm.covariances[station, 2, 2]),
+                               algorithm.get_topo_points()[2].p.error_z, 12)
+        # The result does not depend on the size of the chunks.
+        chunked = MonteCarloAlgorithm(dataset, samples=20000, seed=1, memory=10000)
+        self.assertTrue(np.allclose(algorithm.covariances, chunked.covariances, rtol=1e-9, atol=1e-12))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+""" ArboTopo - data: passage mesh
+
+The PassageMesh of this module is a triangulated model of the walls of the passages of a cave.
+
+Every TopoPoint with a section (its left, top, right and bottom points) contributes a ring of four vertices, missing
+points of a section are taken at the station itself. Every leg between two stations is lofted into a tube of eight
+triangles between their rings. The rings are matched by their left to right directions, so the tube of a leg surveyed
+against the direction of the section of its last station does not twist. Stations with a single leg (dead ends) are
+closed by two triangles over their ring. At junctions the tubes of all legs share the ring of the station, so they meet
+without gaps (and overlap inside the passage). The triangles are oriented with their normals pointing out of the
+passage, triangles without area (of stations without sections) are left out.
+
+All legs are lofted at once with arrays, the mesh is stored as an indexed V x 3 array of vertices and an F x 3 array of
+faces and can be written as binary STL or PLY.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+
+
+class PassageMesh:
+    """An indexed triangle mesh of the walls of the passages."""
+
+    RING = np.array((0, 1, 2, 3))
+    """The order of the section points (left, top, right, bottom) in the rings."""
+
+    MIRRORED_RING = np.array((2, 1, 0, 3))
+    """The order of the section points in the rings of the last station of legs against its section."""
+
+    STL_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+    """The record of a triangle in a binary STL file."""
+
+    PLY_FACE_DTYPE = np.dtype([('count', 'u1'), ('indices', '<i4', (3,))])
+    """The record of a face in a binary PLY file."""
+
+    def __init__(self, vertices, faces):
+        """Create a mesh from a V x 3 array of vertices and an F x 3 array of vertex indices of the faces."""
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+
+    @classmethod
+    def from_topo_points(cls, topo_points, legs):
+        """Create the mesh of the passages of a dict of TopoPoints (by name) and the legs between them.
+
+        The legs are pairs of station names, legs to stations which are not in the TopoPoints are left out.
+        """
+        names = list(topo_points)
+        station_ids = {name: index for index, name in enumerate(names)}
+        positions = np.array([topo_points[name].p.xyz() for name in names], dtype=float).reshape(-1, 3)
+        sections = np.array([[position if point is None else point.xyz() for point in
+                              (topo_points[name].l, topo_points[name].t, topo_points[name].r, topo_points[name].b)]
+                             for name, position in zip(names, positions.tolist())], dtype=float).reshape(-1, 4, 3)
+        legs = np.array([(station_ids[first], station_ids[last]) for first, last in legs
+                         if first in station_ids and last in station_ids], dtype=np.int64).reshape(-1, 2)
+        return cls.from_arrays(positions, sections, legs)
+
+    @classmethod
+    def from_algorithm(cls, algorithm):
+        """Create the mesh of the passages of the TopoPoints of an Algorithm, with its shots as legs."""
+        graph = algorithm.graph
+        stations = graph.stations
+        legs = ((stations[first], stations[last]) for first, last in zip(graph.shot_from.tolist(),
+                                                                         graph.shot_to.tolist()))
+        return cls.from_topo_points(algorithm.get_topo_points(), legs)
+
+    @classmethod
+    def from_arrays(cls, positions, sections, legs):
+        """Create the mesh of N x 3 station positions, N x 4 x 3 sections and L x 2 legs (station indices)."""
+        legs = legs[legs[:, 0] != legs[:, 1]]
+        # Legs surveyed more than once are lofted once.
+        legs = np.unique(np.sort(legs, axis=1), axis=0)
+        first, last = legs[:, 0], legs[:, 1]
+        widths = sections[:, 2]-sections[:, 0]
+        mirrored = np.einsum('ij,ij->i', widths[first], widths[last]) < 0
+        first_rings = 4*first[:, np.newaxis]+cls.RING
+        last_rings = 4*last[:, np.newaxis]+np.where(mirrored[:, np.newaxis], cls.MIRRORED_RING, cls.RING)
+        following = np.roll(np.arange(4), -1)
+        # Every side of the tube is a quad of two triangles.
+        tubes = np.stack((np.stack((first_rings, first_rings[:, following], last_rings[:, following]), axis=2),
+                          np.stack((first_rings, last_rings[:, following], last_rings), axis=2)), axis=2).reshape(-1, 3)
+        # The outside of a tube is away from the leg, the outside of an end away from its only leg.
+        vertices = sections.reshape(-1, 3)
+        centroids = vertices[tubes].mean(axis=1)
+        start, end = np.repeat(positions[first], 8, axis=0), np.repeat(positions[last], 8, axis=0)
+        direction = end-start
+        lengths = np.einsum('ij,ij->i', direction, direction)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions = np.clip(np.where(lengths > 0, np.einsum('ij,ij->i', centroids-start, direction)/lengths, 0.5),
+                                0.0, 1.0)
+        tube_outside = centroids-(start+fractions[:, np.newaxis]*direction)
+        degree = np.bincount(legs.ravel(), minlength=len(positions))
+        ends = np.flatnonzero(degree == 1)
+        neighbours = np.empty(len(positions), dtype=np.int64)
+        neighbours[first], neighbours[last] = last, first
+        caps = (4*ends[:, np.newaxis, np.newaxis]+np.array(((0, 1, 2), (0, 2, 3)))).reshape(-1, 3)
+        cap_outside = np.repeat(positions[ends]-positions[neighbours[ends]], 2, axis=0)
+        faces = np.concatenate((tubes, caps))
+        outside = np.concatenate((tube_outside, cap_outside))
+        normals = np.cross(vertices[faces[:, 1]]-vertices[faces[:, 0]], vertices[faces[:, 2]]-vertices[faces[:, 0]])
+        inward = np.einsum('ij,ij->i', normals, outside) < 0
+        faces[inward] = faces[inward][:, ::-1]
+        faces = faces[np.einsum('ij,ij->i', normals, normals) > 0]
+        # Only the vertices of the faces are kept.
+        used, faces = np.unique(faces, return_inverse=True)
+        return cls(vertices[used], faces.reshape(-1, 3))
+
+    def normals(self):
+        """Return the F x 3 unit normals of the faces."""
+        corners = self.vertices[self.faces]
+        normals = np.cross(corners[:, 1]-corners[:, 0], corners[:, 2]-corners[:, 0])
+        return normals/np.sqrt(np.einsum('ij,ij->i', normals, normals))[:, np.newaxis]
+
+    def volume(self):
+        """Return the volume enclosed by the mesh (only meaningful if it is closed)."""
+        corners = self.vertices[self.faces]
+        return np.einsum('ij,ij->', corners[:, 0], np.cross(corners[:, 1], corners[:, 2]))/6.0
+
+    def write_stl(self, filename):
+        """Write the mesh to a binary STL file."""
+        triangles = np.zeros(len(self.faces), dtype=self.STL_DTYPE)
+        triangles['normal'] = self.normals()
+        triangles['vertices'] = self.vertices[self.faces]
+        with open(filename, 'wb') as stl_file:
+            stl_file.write(b'ArboTopo passage mesh'.ljust(80, b' '))
+            stl_file.write(np.uint32(len(self.faces)).tobytes())
+            stl_file.write(triangles.tobytes())
+
+    def write_ply(self, filename):
+        """Write the mesh to a binary (little endian) PLY file."""
+        faces = np.empty(len(self.faces), dtype=self.PLY_FACE_DTYPE)
+        faces['count'] = 3
+        faces['indices'] = self.faces
+        header = ('ply\nformat binary_little_endian 1.0\ncomment ArboTopo passage mesh\nelement vertex {vertices}\n'
+                  'property float x\nproperty float y\nproperty float z\nelement face {faces}\n'
+                  'property list uchar int vertex_indices\nend_header\n').format(vertices=len(self.vertices),
+                                                                                faces=len(self.faces))
+        with open(filename, 'wb') as ply_file:
+            ply_file.write(header.encode('ascii'))
+            ply_file.write(self.vertices.astype('<f4').tobytes())
+            ply_file.write(faces.tobytes())
+
+
+class PassageMeshTest(unittest.TestCase):
+
+    def create_topo_points(self, stations):
+        from data.point import Point
+        from data.topo_point import TopoPoint
+        # Sections with 1 meter to the left and right of the direction of the y axis, 1 meter up and down.
+        return {name: TopoPoint(name, Point(x, y, z), l=Point(x-sign, y, z), r=Point(x+sign, y, z), t=Point(x, y, z+1),
+                                b=Point(x, y, z-1)) for name, (x, y, z, sign) in stations.items()}
+
+    def assert_closed(self, mesh):
+        # Every edge is used once in both directions.
+        edges = np.concatenate((mesh.faces[:, [0, 1]], mesh.faces[:, [1, 2]], mesh.faces[:, [2, 0]]))
+        self.assertEqual(len(edges), len(np.unique(edges, axis=0)))
+        self.assertEqual(len(edges), 2*len(np.unique(np.sort(edges, axis=1), axis=0)))
+
+    def test_leg(self):
+        # The section of b is surveyed in the other direction, the tube should not twist.
+        topo_points = self.create_topo_points({'a': (0.0, 0.0, 0.0, 1), 'b': (0.0, 10.0, 0.0, -1)})
+        mesh = PassageMesh.from_topo_points(topo_points, [('a', 'b'), ('b', 'a'), ('a', 'x')])
+        self.assertEqual((8, 3), mesh.vertices.shape)
+        self.assertEqual(8+2*2, len(mesh.faces))
+        self.assert_closed(mesh)
+        # The section is a diamond of 2 square meter.
+        self.assertAlmostEqual(20.0, mesh.volume(), 9)
+
+    def test_junction(self):
+        import os
+        import tempfile
+        from data.point import Point
+        from data.topo_point import TopoPoint
+        topo_points = self.create_topo_points({'a': (0.0, 0.0, 0.0, 1), 'b': (0.0, 10.0, 0.0, 1),
+                                               'c': (0.0, 20.0, 0.0, 1), 'd': (10.0, 10.0, 0.0, 1)})
+        topo_points['e'] = TopoPoint('e', Point(20.0, 10.0, 0.0))
+        mesh = PassageMesh.from_topo_points(topo_points, [('a', 'b'), ('b', 'c'), ('b', 'd'), ('d', 'e')])
+        # Three tubes, a cone to e (which has no section) and two dead ends (e has no area).
+        self.assertEqual(3*8+4+2*2, len(mesh.faces))
+        centroids = mesh.vertices[mesh.faces].mean(axis=1)
+        # The faces of the main passage (along x = 0) point away from its axis.
+        main = np.abs(centroids[:, 0]) < 1
+        outside = centroids[main]*[1, 0, 1]
+        self.assertTrue(np.all(np.einsum('ij,ij->i', mesh.normals()[main], outside) >= 0))
+        with tempfile.TemporaryDirectory() as directory:
+            stl_filename, ply_filename = os.path.join(directory, 'cave.stl'), os.path.join(directory, 'cave.ply')
+            mesh.write_stl(stl_filename)
+            mesh.write_ply(ply_filename)
+            with open(stl_filename, 'rb') as stl_file:
+                data = stl_file.read()
+            self.assertEqual(84+50*len(mesh.faces), len(data))
+            triangles = np.frombuffer(data[84:], dtype=PassageMesh.STL_DTYPE)
+            self.assertTrue(np.allclose(mesh.vertices[mesh.faces], triangles['vertices'], rtol=0, atol=1e-5))
+            with open(ply_filename, 'rb') as ply_file:
+                data = ply_file.read()
+            body = data[data.index(b'end_header\n')+len(b'end_header\n'):]
+            vertices = np.frombuffer(body[:12*len(mesh.vertices)], dtype='<f4').reshape(-1, 3)
+            faces = np.frombuffer(body[12*len(mesh.vertices):], dtype=PassageMesh.PLY_FACE_DTYPE)
+            self.assertTrue(np.allclose(mesh.vertices, vertices, rtol=0, atol=1e-5))
+            self.assertTrue(np.array_equal(mesh.faces, faces['indices']))
+
+
+if __name__ == '__main__':
+    unittest.main()
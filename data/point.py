@@ -2,7 +2,9 @@
 
 This class represents a point in 3D space with some information about the error on it.
 
-Errors are always considered to be uncorrelated and gaussian.
+Errors are gaussian. By default they are considered to be uncorrelated and given by their std per axis. Optionally a
+point carries a full 3 x 3 covariance matrix, which is then propagated through the arithmetic. The std per axis of such
+a point are the square roots of the diagonal of its covariance.
 
 copyright (C) 2016 Bram Rooseleer
 """
@@ -10,17 +12,39 @@ copyright (C) 2016 Bram Rooseleer
 from math import sqrt
 
 
+def _add_covariances(first, second):
+    """Return the sum of two 3 x 3 covariance matrices, None if one of them is None."""
+    if first is None or second is None:
+        return None
+    return tuple(tuple(a+b for a, b in zip(row_first, row_second)) for row_first, row_second in zip(first, second))
+
+
 class Point:
     """A inmutable point in 3D space."""
 
-    def __init__(self, x, y, z, error_x=None, error_y=None, error_z=None):
-        """Create a point."""
+    __slots__ = ('_x', '_y', '_z', '_error_x', '_error_y', '_error_z', '_covariance')
+
+    def __init__(self, x, y, z, error_x=None, error_y=None, error_z=None, covariance=None):
+        """Create a point.
+
+        The covariance is an optional 3 x 3 matrix (nested sequences). If it is given, missing errors are taken from
+        its diagonal.
+        """
         self._x = x
         self._y = y
         self._z = z
+        if covariance is not None:
+            covariance = tuple(tuple(float(value) for value in row) for row in covariance)
+            if error_x is None:
+                error_x = sqrt(covariance[0][0])
+            if error_y is None:
+                error_y = sqrt(covariance[1][1])
+            if error_z is None:
+                error_z = sqrt(covariance[2][2])
         self._error_x = error_x
         self._error_y = error_y
         self._error_z = error_z
+        self._covariance = covariance
 
     @property
     def x(self):
@@ -52,6 +76,19 @@ class Point:
         """Return the (std of the) error on the z-coordinate."""
         return self._error_z
 
+    @property
+    def covariance(self):
+        """Return the 3 x 3 covariance matrix (tuples), diagonal if the point has no full covariance.
+
+        Return None if the point has no covariance and an error is missing.
+        """
+        if self._covariance is not None:
+            return self._covariance
+        try:
+            return ((self._error_x**2, 0.0, 0.0), (0.0, self._error_y**2, 0.0), (0.0, 0.0, self._error_z**2))
+        except TypeError:
+            return None
+
     @property
     def d(self):
         """Return the (euclidian) size of this 3D vector."""
@@ -61,7 +98,7 @@ class Point:
     def error_d(self):
         """Return the size of the total error on the on this 3D vector."""
         try:
-            return sqrt(self._x**2+self._y**2+self._z**2)
+            return sqrt(self._error_x**2+self._error_y**2+self._error_z**2)
         except TypeError:
             return None
 
@@ -74,22 +111,27 @@ class Point:
         if not isinstance(other, (int, float)):
             raise TypeError("Point can only be multiplied by numerical.")
         try:
-            error_x = other*self._error_x
+            error_x = abs(other*self._error_x)
         except TypeError:
             error_x = None
         try:
-            error_y = other*self._error_y
+            error_y = abs(other*self._error_y)
         except TypeError:
             error_y = None
         try:
-            error_z = other*self._error_z
+            error_z = abs(other*self._error_z)
         except TypeError:
             error_z = None
-        return Point(x=self._x*other, y=self._y*other, z=self._z*other, error_x=error_x, error_y=error_y, error_z=error_z)
+        if self._covariance is None:
+            covariance = None
+        else:
+            covariance = tuple(tuple(other*other*value for value in row) for row in self._covariance)
+        return Point(x=self._x*other, y=self._y*other, z=self._z*other, error_x=error_x, error_y=error_y, error_z=error_z,
+                     covariance=covariance)
 
     def __rmul__(self, other):
         """Return the multiplication of this Point with the given numerical."""
-        return other*self
+        return self*other
 
     def __add__(self, other):
         """Return the addition of this Point with the given Point."""
@@ -107,7 +149,12 @@ class Point:
             error_z = sqrt(other._error_z**2+self._error_z**2)
         except TypeError:
             error_z = None
-        return Point(x=self._x+other._x, y=self._y+other._y, z=self._z+other._z, error_x=error_x, error_y=error_y, error_z=error_z)
+        if self._covariance is None and other._covariance is None:
+            covariance = None
+        else:
+            covariance = _add_covariances(self.covariance, other.covariance)
+        return Point(x=self._x+other._x, y=self._y+other._y, z=self._z+other._z, error_x=error_x, error_y=error_y, error_z=error_z,
+                     covariance=covariance)
 
     def __sub__(self, other):
         """Return the subtraction of this Point by the given Point."""
@@ -117,7 +164,8 @@ class Point:
 
     def __neg__(self):
         """Return the negated version of this Point."""
-        return Point(x=-self._x, y=-self._y, z=-self._z, error_x=self._error_x, error_y=self._error_y, error_z=self._error_z)
+        return Point(x=-self._x, y=-self._y, z=-self._z, error_x=self._error_x, error_y=self._error_y, error_z=self._error_z,
+                     covariance=self._covariance)
 
     def __pos__(self):
         """Return self."""
@@ -0,0 +1,281 @@
+""" ArboTopo - data: point array
+
+This class represents an array of points in 3D space with some information about the errors on them.
+
+The coordinates and the (std of the) errors are stored as N x 3 arrays. Missing errors are tracked with a mask, an error
+component that is missing on any operand is missing on the result, like for Point. Errors are gaussian, like for Point
+they are uncorrelated unless the array carries an N x 3 x 3 array of covariance matrices.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from data.point import Point
+
+
+class PointArray:
+    """An inmutable array of points in 3D space."""
+
+    __slots__ = ('_xyz', '_error', '_mask', '_covariance')
+
+    def __init__(self, xyz, error=None, mask=None, covariance=None):
+        """Create a point array from an N x 3 array of coordinates.
+
+        -error:         an N x 3 array with the (std of the) errors, None if there are no errors
+        -mask:          an N x 3 boolean array, True where the error is missing (NaN errors are considered missing too)
+        -covariance:    an N x 3 x 3 array of covariance matrices, the errors are then taken from their diagonals
+        """
+        self._xyz = np.array(xyz, dtype=float).reshape(-1, 3)
+        self._covariance = None
+        if covariance is not None:
+            self._covariance = np.array(covariance, dtype=float).reshape(-1, 3, 3)
+            self._error = np.sqrt(np.diagonal(self._covariance, axis1=1, axis2=2))
+            self._mask = np.zeros(self._xyz.shape, dtype=bool)
+        elif error is None:
+            self._error = np.zeros_like(self._xyz)
+            self._mask = np.ones(self._xyz.shape, dtype=bool)
+        else:
+            self._error = np.array(error, dtype=float).reshape(self._xyz.shape)
+            self._mask = np.isnan(self._error)
+            if mask is not None:
+                self._mask |= np.asarray(mask, dtype=bool)
+            self._error[self._mask] = 0.0
+
+    @classmethod
+    def from_points(cls, points):
+        """Create a point array from a sequence of Points."""
+        points = list(points)
+        values = [(point._x, point._y, point._z, point._error_x, point._error_y, point._error_z) for point in points]
+        values = np.array(values, dtype=float).reshape(-1, 6)
+        if any(point._covariance is not None for point in points):
+            covariances = [point.covariance for point in points]
+            if all(covariance is not None for covariance in covariances):
+                return cls(values[:, :3], covariance=covariances)
+        return cls(values[:, :3], values[:, 3:])
+
+    def to_points(self):
+        """Return a list of Points."""
+        if self._covariance is not None:
+            return [Point(x, y, z, covariance=covariance)
+                    for (x, y, z), covariance in zip(self._xyz.tolist(), self._covariance.tolist())]
+        errors = np.where(self._mask, None, self._error).tolist()
+        return [Point(x, y, z, *error) for (x, y, z), error in zip(self._xyz.tolist(), errors)]
+
+    @property
+    def xyz(self):
+        """Return the N x 3 array of coordinates."""
+        return self._xyz
+
+    @property
+    def x(self):
+        """Return the x-coordinates."""
+        return self._xyz[:, 0]
+
+    @property
+    def y(self):
+        """Return the y-coordinates."""
+        return self._xyz[:, 1]
+
+    @property
+    def z(self):
+        """Return the z-coordinates."""
+        return self._xyz[:, 2]
+
+    @property
+    def error(self):
+        """Return the N x 3 array of the (std of the) errors, NaN where the error is missing."""
+        return np.where(self._mask, np.nan, self._error)
+
+    @property
+    def mask(self):
+        """Return the N x 3 boolean array which is True where the error is missing."""
+        return self._mask
+
+    @property
+    def covariance(self):
+        """Return the N x 3 x 3 array of covariance matrices, diagonal if the array has no full covariances.
+
+        Return None if the array has no covariances and an error is missing.
+        """
+        if self._covariance is not None:
+            return self._covariance
+        if self._mask.any():
+            return None
+        covariance = np.zeros((len(self), 3, 3))
+        covariance[:, [0, 1, 2], [0, 1, 2]] = self._error**2
+        return covariance
+
+    @property
+    def d(self):
+        """Return the (euclidian) sizes of the 3D vectors."""
+        return np.sqrt(np.einsum('ij,ij->i', self._xyz, self._xyz))
+
+    @property
+    def error_d(self):
+        """Return the sizes of the total errors on the 3D vectors, NaN if an error component is missing."""
+        result = np.sqrt(np.einsum('ij,ij->i', self._error, self._error))
+        result[self._mask.any(axis=1)] = np.nan
+        return result
+
+    def cumsum(self, origin=None):
+        """Return the cumulative sums of the vectors of a leg chain.
+
+        Element i of the result is the origin (a Point, by default without error) plus the first i+1 vectors. The
+        variances of the errors accumulate, an error component stays missing from the first leg where it is missing.
+        """
+        xyz = np.cumsum(self._xyz, axis=0)
+        variance = np.cumsum(self._error**2, axis=0)
+        mask = np.logical_or.accumulate(self._mask, axis=0)
+        if origin is not None:
+            origin = PointArray.from_points([origin])
+            xyz += origin._xyz
+            variance += origin._error**2
+            mask |= origin._mask
+        covariance = None
+        if self._covariance is not None or (origin is not None and origin._covariance is not None):
+            covariance = self.covariance
+            if covariance is not None:
+                covariance = np.cumsum(covariance, axis=0)
+                if origin is not None:
+                    origin_covariance = origin.covariance
+                    covariance = None if origin_covariance is None else covariance+origin_covariance
+        return PointArray._create(xyz, np.sqrt(variance), mask, covariance)
+
+    @staticmethod
+    def _create(xyz, error, mask, covariance=None):
+        """Create a point array from arrays which are not copied or checked."""
+        result = PointArray.__new__(PointArray)
+        result._xyz = xyz
+        result._error = error
+        result._mask = mask
+        result._covariance = covariance
+        return result
+
+    def _combined_covariance(self, other):
+        """Return the sum of the covariances of self and other, None if neither carries full covariances."""
+        if self._covariance is None and other._covariance is None:
+            return None
+        first = self.covariance
+        second = other.covariance
+        if first is None or second is None:
+            return None
+        return first+second
+
+    @staticmethod
+    def _as_point_array(other):
+        """Return other as a PointArray, a Point is converted to an array of one element."""
+        if isinstance(other, PointArray):
+            return other
+        if isinstance(other, Point):
+            return PointArray.from_points([other])
+        raise TypeError("PointArray can only be combined with a PointArray or a Point.")
+
+    def __len__(self):
+        """Return the number of points."""
+        return len(self._xyz)
+
+    def __getitem__(self, index):
+        """Return the Point for an integer index, a PointArray for a slice, index array or boolean mask."""
+        if isinstance(index, (int, np.integer)):
+            if self._covariance is not None:
+                return Point(*self._xyz[index].tolist(), covariance=self._covariance[index].tolist())
+            error = [None if missing else value for value, missing in zip(self._error[index].tolist(),
+                                                                             self._mask[index].tolist())]
+            return Point(*self._xyz[index].tolist(), *error)
+        covariance = None if self._covariance is None else self._covariance[index].reshape(-1, 3, 3)
+        return PointArray._create(self._xyz[index].reshape(-1, 3), self._error[index].reshape(-1, 3),
+                                  self._mask[index].reshape(-1, 3), covariance)
+
+    def __mul__(self, other):
+        """Return the multiplication with a numerical or an array of N numericals (element-wise)."""
+        factor = np.asarray(other, dtype=float)
+        if factor.ndim == 1:
+            factor = factor[:, np.newaxis]
+        elif factor.ndim > 1:
+            raise TypeError("PointArray can only be multiplied by a numerical or a 1D array.")
+        covariance = None
+        if self._covariance is not None:
+            covariance = self._covariance*(factor*factor).reshape(-1, 1, 1)
+        return PointArray._create(self._xyz*factor, np.abs(self._error*factor), self._mask.copy(), covariance)
+
+    def __rmul__(self, other):
+        """Return the multiplication with a numerical or an array of N numericals (element-wise)."""
+        return self*other
+
+    def __add__(self, other):
+        """Return the element-wise addition with a PointArray (or a Point, which is added to every element)."""
+        other = self._as_point_array(other)
+        return PointArray._create(self._xyz+other._xyz, np.hypot(self._error, other._error), self._mask | other._mask,
+                                  self._combined_covariance(other))
+
+    def __radd__(self, other):
+        """Return the element-wise addition with a Point."""
+        return self+other
+
+    def __sub__(self, other):
+        """Return the element-wise subtraction by a PointArray (or a Point, which is subtracted from every element)."""
+        return self+(-self._as_point_array(other))
+
+    def __rsub__(self, other):
+        """Return the element-wise subtraction of this array from a Point."""
+        return self._as_point_array(other)+(-self)
+
+    def __neg__(self):
+        """Return the negated version of this PointArray."""
+        return PointArray._create(-self._xyz, self._error, self._mask, self._covariance)
+
+    def __pos__(self):
+        """Return self."""
+        return self
+
+
+class PointArrayTest(unittest.TestCase):
+
+    points = [Point(1.0, 2.0, 3.0, 0.1, 0.2, 0.3), Point(-1.0, 0.5, 2.0, 0.3, None, 0.1),
+              Point(4.0, -2.0, 0.0, None, None, None)]
+
+    def assertPointEqual(self, expected, point):
+        for field in ('x', 'y', 'z', 'error_x', 'error_y', 'error_z'):
+            if getattr(expected, field) is None:
+                self.assertIsNone(getattr(point, field))
+            else:
+                self.assertAlmostEqual(getattr(expected, field), getattr(point, field), 12)
+
+    def test_arithmetic(self):
+        array = PointArray.from_points(self.points)
+        other = PointArray.from_points(self.points[::-1])
+        for index, (point, reverse) in enumerate(zip(self.points, self.points[::-1])):
+            self.assertPointEqual(point, array[index])
+            self.assertPointEqual(point+reverse, (array+other)[index])
+            self.assertPointEqual(point-reverse, (array-other)[index])
+            self.assertPointEqual(point*2.5, (2.5*array)[index])
+            self.assertPointEqual(point+self.points[0], (array+self.points[0])[index])
+            self.assertPointEqual(-point, (-array)[index])
+        for point, converted in zip(self.points, array.to_points()):
+            self.assertPointEqual(point, converted)
+
+    def test_cumsum(self):
+        origin = Point(10.0, 20.0, 30.0, 0.0, 0.0, 0.0)
+        array = PointArray.from_points(self.points)
+        expected = origin
+        for point, summed in zip(self.points, array.cumsum(origin).to_points()):
+            expected = expected+point
+            self.assertPointEqual(expected, summed)
+        self.assertTrue(np.isnan(array.cumsum().error_d[1]))
+        self.assertAlmostEqual(np.sqrt(0.1**2+0.2**2+0.3**2), array.cumsum().error_d[0], 12)
+
+    def test_covariance(self):
+        covariances = [[[0.04, 0.01, 0.0], [0.01, 0.09, -0.02], [0.0, -0.02, 0.01]],
+                       [[0.01, 0.0, 0.005], [0.0, 0.01, 0.0], [0.005, 0.0, 0.04]]]
+        points = [Point(1.0, 2.0, 3.0, covariance=covariances[0]), Point(-1.0, 0.5, 2.0, covariance=covariances[1])]
+        array = PointArray.from_points(points)
+        expected = points[0]-2.0*points[1]+Point(0.0, 0.0, 0.0, 0.1, 0.1, 0.1)
+        result = (array[:1]-2.0*array[1:]+Point(0.0, 0.0, 0.0, 0.1, 0.1, 0.1))[0]
+        self.assertPointEqual(expected, result)
+        self.assertTrue(np.allclose(expected.covariance, result.covariance, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(np.add(*covariances), array.cumsum().covariance[1], rtol=0, atol=1e-12))
+
+
+if __name__ == '__main__':
+    unittest.main()
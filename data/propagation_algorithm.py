@@ -0,0 +1,230 @@
+""" ArboTopo - data: propagation algorithm
+
+The PropagationAlgorithm of this module calculates the TopoPoints by propagating coordinates over the shots.
+
+Every connected component of the survey graph gets one root: its first fixed station (an AbsoluteMeasurement), the
+origin station if it is in the component, or else its first station. Roots without a fix are placed at the origin
+position. The coordinates are then propagated breadth first over a spanning tree of the shots. Other fixes and the
+shots which are not in the spanning tree do not influence the result, so loop closure errors remain (see the network
+adjustment for that).
+
+The breadth first search (scipy) runs in O(stations + shots). In breadth first order every station comes after its
+parent, so the incidence matrix of the tree (+1 at the station, -1 at its parent) is lower triangular and a single
+sparse triangular solve (scipy) of the shots accumulates all positions in O(stations), without recursion or a Python
+step per level of the tree.
+
+In incremental mode the spanning tree is kept and extended, so when loops do not close the positions can differ from
+those of a recalculation, which may choose another spanning tree.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
+from scipy.sparse.linalg import spsolve_triangular
+from data.algorithm import Algorithm
+from data.device import calculate_differences
+from data.measurement import RelativeMeasurement
+from data.point import Point
+from data.survey_graph import SurveyGraph
+from data.topo_point import TopoPoint
+
+
+class PropagationAlgorithm(Algorithm):
+    """An algorithm which propagates coordinates from the fixes over a spanning tree of the shots."""
+
+    CACHE_PARAMETERS = ('origin', 'origin_position')
+    """The names of the attributes the results depend on besides the dataset, part of the keys of a ResultCache."""
+
+    def __init__(self, dataset, origin=None, origin_position=(0.0, 0.0, 0.0), incremental=False, cache=None):
+        """Create the algorithm and calculate the TopoPoints.
+
+        -origin:            the name of the station used as root of its component if that component has no fix
+        -origin_position:   the (x, y, z) of the roots without a fix
+        -incremental:       update the TopoPoints when measurements are added or edited
+        -cache:             a ResultCache to restore the TopoPoints from if the dataset did not change
+        """
+        self.origin = origin
+        self.origin_position = origin_position
+        Algorithm.__init__(self, dataset, incremental, cache=cache)
+
+    def _recalculate(self):
+        """Recalculate the TopoPoints."""
+        self._graph = SurveyGraph.from_dataset(self.dataset)
+        self.roots, self.root_positions = self._find_roots()
+        self.order, self.parents, self.parent_shots, self.parent_signs = self._spanning_tree()
+        self.positions = self._accumulate()
+        self._topo_points = None
+
+    def _find_roots(self):
+        """Return the root station of every component and the positions of those roots."""
+        graph = self.graph
+        count, labels = graph.connected_components()
+        self.labels = labels
+        roots = np.unique(labels, return_index=True)[1]
+        positions = np.tile(np.asarray(self.origin_position, dtype=float), (count, 1))
+        if self.origin is not None and self.origin in graph.station_ids:
+            roots[labels[graph.station_ids[self.origin]]] = graph.station_ids[self.origin]
+        for station, fix in reversed(list(zip(graph.fix_stations.tolist(), graph.fixes))):
+            roots[labels[station]] = station
+            positions[labels[station]] = (fix.x, fix.y, fix.z)
+        return roots, positions
+
+    def _spanning_tree(self):
+        """Return the stations in breadth first order and the parent station, the shot to the parent and the sign of
+        that shot for every station.
+
+        Roots are their own parent and have shot -1. The sign is +1 if the shot goes from the parent to the station.
+        """
+        graph = self.graph
+        size = graph.station_count
+        # A virtual station connected to all roots makes a single breadth first search cover all components.
+        matrix = graph.matrix().tocoo()
+        rows = np.concatenate((matrix.row, np.full(len(self.roots), size), self.roots))
+        columns = np.concatenate((matrix.col, self.roots, np.full(len(self.roots), size)))
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(size+1, size+1))
+        stations, predecessors = breadth_first_order(matrix, size, directed=False, return_predecessors=True)
+        stations, predecessors = stations[1:], predecessors[:size]
+        parents = np.arange(size)
+        shots = np.full(size, -1, dtype=np.int64)
+        signs = np.zeros(size, dtype=np.int8)
+        children = np.flatnonzero(predecessors != size)
+        parents[children] = predecessors[children]
+        # Look up the adjacency entry (parent, child) of every child through the sorted (station, neighbour) keys.
+        keys = np.repeat(np.arange(size, dtype=np.int64), graph.degree())*size+graph.adjacency
+        order = np.argsort(keys, kind='stable')
+        entries = order[np.searchsorted(keys[order], parents[children].astype(np.int64)*size+children)]
+        shots[children] = graph.adjacency_shots[entries]
+        signs[children] = graph.adjacency_signs[entries]
+        return stations, parents, shots, signs
+
+    def _accumulate(self):
+        """Return the N x 3 positions, solving the lower triangular incidence matrix of the tree in breadth first
+        order for the shots (and the roots for their positions)."""
+        graph = self.graph
+        size = graph.station_count
+        ranks = np.empty(size, dtype=np.int64)
+        ranks[self.order] = np.arange(size)
+        children = np.flatnonzero(self.parent_shots >= 0)
+        values = np.empty((size, 3))
+        values[ranks[self.roots]] = self.root_positions
+        values[ranks[children]] = graph.differences[self.parent_shots[children]]*self.parent_signs[children, np.newaxis]
+        rows = np.concatenate((np.arange(size), ranks[children]))
+        columns = np.concatenate((np.arange(size), ranks[self.parents[children]]))
+        matrix = csr_matrix((np.concatenate((np.ones(size), -np.ones(len(children)))), (rows, columns)),
+                            shape=(size, size))
+        return spsolve_triangular(matrix, values, lower=True)[ranks]
+
+    def measurement_changed(self, event, measurement, old=None):
+        """Update the TopoPoints after a measurement is added or edited.
+
+        A shot to a new station extends the spanning tree, a shot between stations of the same component closes a loop
+        and changes nothing. An edited shot keeps the spanning tree, the positions are accumulated again if it is in
+        the tree. Fixes and other changes are recalculated.
+        """
+        graph = self.graph
+        if not isinstance(measurement, RelativeMeasurement):
+            self._recalculate()
+            return
+        ends = [graph.station_ids.get(name) for name in (measurement.refpoint, measurement.point)]
+        difference = calculate_differences([measurement])[0]
+        if event == 'add' and None not in ends and self.labels[ends[0]] == self.labels[ends[1]]:
+            graph.add_shot(measurement, difference)
+        elif event == 'add' and ends.count(None) == 1:
+            parent = ends[1] if ends[0] is None else ends[0]
+            sign = 1 if ends[0] == parent else -1
+            shot = graph.add_shot(measurement, difference)
+            # The new station follows its parent in breadth first order.
+            self.order = np.append(self.order, len(self.parents))
+            self.parents = np.append(self.parents, parent)
+            self.parent_shots = np.append(self.parent_shots, shot)
+            self.parent_signs = np.append(self.parent_signs, np.int8(sign))
+            self.labels = np.append(self.labels, self.labels[parent])
+            self.positions = np.concatenate((self.positions, [self.positions[parent]+sign*difference]))
+            self._topo_points = None
+        elif event == 'edit' and ends == [graph.station_ids.get(old.refpoint), graph.station_ids.get(old.point)]:
+            shot = graph.shot_index(measurement)
+            graph.set_shot(shot, measurement, difference)
+            if np.any(self.parent_shots == shot):
+                self.positions = self._accumulate()
+                self._topo_points = None
+        else:
+            self._recalculate()
+
+    def get_topo_points(self):
+        """Return a dict mapping the station names on the calculated topo points."""
+        if self._topo_points is None:
+            self._topo_points = {name: TopoPoint(name, Point(x, y, z))
+                                 for name, (x, y, z) in zip(self.graph.stations, self.positions.tolist())}
+        return self._topo_points
+
+
+class PropagationAlgorithmTest(unittest.TestCase):
+
+    def test_propagation(self):
+        from data.dataset import Dataset
+        datasets = {}
+        cave = Dataset(datasets, 'cave')
+        cave.add_device('DCIDevice', 'compass')
+        cave.add_device('GPS', 'gps')
+        cave.add_measurement(None, 'entrance', 'gps', point='b', x=100.0, y=200.0, z=50.0)
+        branch = Dataset(datasets, 'branch', parent='cave', columnar=True)
+        shots = ((cave, 'a', 'b', 90.0, 0.0), (cave, 'b', 'c', 0.0, 0.0), (branch, 'c', 'd', 0.0, 90.0),
+                 (branch, 'd', 'e', 180.0, 0.0), (branch, 'x', 'y', 270.0, 0.0))
+        for index, (dataset, refpoint, point, compass, inclination) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=10.0,
+                                    compass=compass, inclination=inclination)
+        algorithm = PropagationAlgorithm(cave, origin='y', origin_position=(1.0, 2.0, 3.0))
+        topo_points = algorithm.get_topo_points()
+        expected = {'a': (90.0, 200.0, 50.0), 'b': (100.0, 200.0, 50.0), 'c': (100.0, 210.0, 50.0),
+                    'd': (100.0, 210.0, 60.0), 'e': (100.0, 200.0, 60.0), 'x': (11.0, 2.0, 3.0), 'y': (1.0, 2.0, 3.0)}
+        self.assertEqual(sorted(expected), sorted(topo_points))
+        for name, position in expected.items():
+            self.assertTrue(np.allclose(position, topo_points[name].p.xyz(), rtol=0, atol=1e-9), name)
+
+    def test_incremental(self):
+        from data.dataset import Dataset
+        datasets = {}
+        cave = Dataset(datasets, 'cave')
+        cave.add_device('DCIDevice', 'compass')
+        branch = Dataset(datasets, 'branch', parent='cave', columnar=True)
+        for index, (dataset, refpoint, point) in enumerate(((cave, 'a', 'b'), (branch, 'b', 'c'), (cave, 'c', 'd'))):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=10.0,
+                                    compass=90.0*index, inclination=0.0)
+        algorithm = PropagationAlgorithm(cave, origin='a', incremental=True)
+        graph = algorithm.graph
+        branch.add_measurement(None, 'new', 'compass', point='c', refpoint='e', distance=5.0, compass=0.0,
+                               inclination=0.0)
+        # The loop closes after the edits, so the result does not depend on the spanning tree.
+        cave.add_measurement(None, 'loop', 'compass', point='a', refpoint='d', distance=20.0, compass=180.0,
+                             inclination=0.0)
+        branch.edit_measurement('1', compass=0.0)
+        cave.edit_measurement('0', distance=20.0)
+        self.assertIs(graph, algorithm.graph)
+        expected = PropagationAlgorithm(cave, origin='a')
+        topo_points = algorithm.get_topo_points()
+        for name, topo_point in expected.get_topo_points().items():
+            self.assertTrue(np.allclose(topo_point.p.xyz(), topo_points[name].p.xyz(), rtol=0, atol=1e-9), name)
+        cave.add_measurement(None, 'other', 'compass', point='y', refpoint='x', distance=1.0, compass=0.0,
+                             inclination=0.0)
+        self.assertIsNot(graph, algorithm.graph)
+        self.assertIn('y', algorithm.get_topo_points())
+        algorithm.detach()
+        self.assertEqual([], cave.listeners)
+
+    def test_long_traverse(self):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'traverse', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        for index in range(5000):
+            dataset.add_measurement(None, str(index), 'compass', point=index+1, refpoint=index, distance=1.0,
+                                    compass=90.0, inclination=0.0)
+        algorithm = PropagationAlgorithm(dataset, origin=0)
+        x = algorithm.positions[[algorithm.graph.station_ids[index] for index in range(5001)], 0]
+        self.assertTrue(np.allclose(np.arange(5001), x, rtol=0, atol=1e-9))
+
+
+if __name__ == '__main__':
+    unittest.main()
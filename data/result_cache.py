@@ -0,0 +1,302 @@
+""" ArboTopo - data: result cache
+
+The ResultCache of this module stores the TopoPoints calculated by Algorithms on disk, so an Algorithm of a dataset
+which did not change since an earlier run is restored instead of recalculated.
+
+The entries are addressed by a hash (SHA-256) of everything the result depends on: the class of the algorithm, the
+parameters it declares in CACHE_PARAMETERS and the content of the dataset and its descendants (their names, the state
+of their devices and, in order, the stations, devices and readings of their measurements, leaving out groups and
+remarks). Measurements in a MeasurementTable are hashed per column. An entry is a NumPy archive of the names of the
+stations (JSON as bytes, tuples as lists), their N x 3 positions and the upper triangle of their covariances (NaN for
+points without errors) as float64 arrays, read without unpickling anything. Diagonal covariances are restored as the
+errors of the points. Algorithms with station names which JSON cannot hold are not stored.
+
+Entries are written atomically, so concurrent builds sharing a directory at worst calculate the same result twice.
+When the entries exceed the maximum size the least recently used ones (by modification time, which is renewed on every
+hit) are removed. The cache counts its hits, misses, stores and evictions.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+import numpy as np
+from data.measurement import RelativeMeasurement
+from data.measurement_table import MeasurementTable
+from data.point import Point
+from data.topo_point import TopoPoint
+
+
+class ResultCache:
+    """A size bounded, content addressed cache of the TopoPoints of Algorithms in a directory."""
+
+    EXTENSION = '.topo'
+    """The extension of the files of the entries."""
+
+    VERSION = 2
+    """The version of the format of the entries, part of the keys."""
+
+    UPPER = np.triu_indices(3)
+    """The indices of the upper triangle of a covariance matrix."""
+
+    def __init__(self, directory, max_size=2**30):
+        """Create a cache in the given directory (created if needed), holding at most max_size bytes of entries."""
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def dataset_digest(dataset):
+        """Return the hash (hexadecimal) of the content of the dataset and its descendants."""
+        digest = hashlib.sha256()
+        for child in dataset.iter_datasets():
+            digest.update(repr(('dataset', child.name)).encode('utf-8'))
+            for name, device in sorted(child.devices.items(), key=lambda item: repr(item[0])):
+                state = sorted((key, repr(sorted(value.items()) if isinstance(value, dict) else value))
+                               for key, value in vars(device).items() if key != 'remarks')
+                digest.update(repr(('device', name, state)).encode('utf-8'))
+            measurements = child.measurements
+            if isinstance(measurements, MeasurementTable):
+                digest.update(repr(('table', measurements.names, measurements.stations,
+                                    [device.name for device in measurements.devices])).encode('utf-8'))
+                for column in (measurements.point, measurements.refpoint, measurements.device, measurements.relative,
+                               measurements._readings[:, :len(measurements)]):
+                    digest.update(np.ascontiguousarray(column).tobytes())
+                for row, extra in sorted(measurements._extra.items()):
+                    fields = sorted((key, repr(value)) for key, value in extra.items()
+                                    if key not in ('group', 'remarks'))
+                    if fields:
+                        digest.update(repr((row, fields)).encode('utf-8'))
+            else:
+                for name, measurement in measurements.items():
+                    refpoint = measurement.refpoint if isinstance(measurement, RelativeMeasurement) else None
+                    digest.update(repr((name, type(measurement).__name__, measurement.device.name, measurement.point,
+                                        refpoint, sorted((key, repr(value)) for key, value in
+                                                         measurement.data.items()))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def key(self, algorithm, dataset):
+        """Return the key of the result of an algorithm of the dataset, given the parameters it declares."""
+        cls = type(algorithm)
+        parameters = [(name, repr(getattr(algorithm, name))) for name in cls.CACHE_PARAMETERS]
+        content = repr((self.VERSION, cls.__module__, cls.__qualname__, parameters, self.dataset_digest(dataset)))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        """Return the filename of the entry with the given key."""
+        return os.path.join(self.directory, key+self.EXTENSION)
+
+    @staticmethod
+    def _name(value):
+        """Return the station name of a decoded JSON value, with the lists turned back into tuples."""
+        if isinstance(value, list):
+            return tuple(ResultCache._name(item) for item in value)
+        return value
+
+    def load(self, key, algorithm):
+        """Restore the positions and TopoPoints of an algorithm from the entry with the given key, if any.
+
+        Return whether the entry was found.
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename, allow_pickle=False) as entry:
+                names = [self._name(name) for name in json.loads(entry['names'].tobytes().decode('utf-8'))]
+                positions, covariances = entry['positions'], entry['covariances']
+            os.utime(filename)
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            return False
+        self.hits += 1
+        algorithm.positions = positions
+        # Diagonal covariances are restored as errors, like points of which only the errors are known.
+        diagonal = self.UPPER[0] == self.UPPER[1]
+        missing = np.isnan(covariances[:, 0])
+        full = np.flatnonzero(np.any(covariances[:, ~diagonal] != 0, axis=1) & ~missing)
+        errors = np.sqrt(covariances[:, diagonal]).astype(object)
+        errors[missing] = None
+        topo_points = {name: TopoPoint(name, Point(x, y, z, *error)) for name, (x, y, z), error in
+                       zip(names, positions.tolist(), errors.tolist())}
+        if len(full):
+            matrices = np.empty((len(full), 3, 3))
+            matrices[:, self.UPPER[0], self.UPPER[1]] = matrices[:, self.UPPER[1], self.UPPER[0]] = covariances[full]
+            for index, matrix in zip(full.tolist(), matrices.tolist()):
+                topo_points[names[index]] = TopoPoint(names[index], Point(*positions[index].tolist(), covariance=matrix))
+        algorithm._topo_points = topo_points
+        return True
+
+    def store(self, key, algorithm):
+        """Store the TopoPoints of an algorithm as the entry with the given key and evict entries if needed."""
+        topo_points = algorithm.get_topo_points()
+        try:
+            names = np.frombuffer(json.dumps(list(topo_points)).encode('utf-8'), dtype=np.uint8)
+        except (TypeError, ValueError):
+            return
+        positions = np.array([topo_point.p.xyz() for topo_point in topo_points.values()], dtype=float).reshape(-1, 3)
+        covariances = np.full((len(topo_points), 6), np.nan)
+        for index, topo_point in enumerate(topo_points.values()):
+            covariance = topo_point.p.covariance
+            if covariance is not None:
+                covariances[index] = np.asarray(covariance)[self.UPPER]
+        # Written to a temporary file first, so readers never see a partial entry.
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache_file:
+            np.savez(cache_file, names=names, positions=positions, covariances=covariances)
+        os.replace(temporary, self._filename(key))
+        self.stores += 1
+        self.evict(keep=key)
+
+    def entries(self):
+        """Return a list of (modification time, size, filename) of the entries, the least recently used first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.EXTENSION):
+                try:
+                    status = entry.stat()
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self):
+        """Return the total size in bytes of the entries."""
+        return sum(size for time, size, filename in self.entries())
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries (but not the one with the given key) until they fit in max_size."""
+        entries = self.entries()
+        total = sum(size for time, size, filename in entries)
+        kept = None if keep is None else self._filename(keep)
+        for time, size, filename in entries:
+            if total <= self.max_size:
+                break
+            if filename == kept:
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all entries."""
+        for time, size, filename in self.entries():
+            os.remove(filename)
+
+    def statistics(self):
+        """Return a dict with the hits, misses, stores, evictions, hit rate, number of entries and size of the cache."""
+        entries = self.entries()
+        lookups = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions,
+                'hit_rate': self.hits/lookups if lookups else 0.0, 'entries': len(entries),
+                'size': sum(size for time, size, filename in entries)}
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def create_dataset(self, datasets, name, compass=90.0, columnar=True):
+        from data.dataset import Dataset
+        dataset = Dataset(datasets, name, columnar=columnar)
+        dataset.add_device('DCIDevice', 'compass', distance_error=0.02, compass_error=1.0, inclination_error=1.0)
+        dataset.add_device('GPS', 'gps')
+        dataset.add_measurement(None, 'fix', 'gps', point=(name, 0), x=0.0, y=0.0, z=0.0)
+        # A loop of four shots, so the adjustment has something to do.
+        for index, (refpoint, point, angle) in enumerate(((0, 1, 0.0), (1, 2, 90.0), (2, 3, 180.0), (3, 0, 270.0))):
+            dataset.add_measurement(None, str(index), 'compass', point=(name, point), refpoint=(name, refpoint),
+                                    distance=10.0, compass=angle+(compass-90.0 if index == 1 else 0.0),
+                                    inclination=0.0)
+        return dataset
+
+    def test_cache(self):
+        from data.adjustment_algorithm import AdjustmentAlgorithm
+        from data.monte_carlo_algorithm import MonteCarloAlgorithm
+        from data.propagation_algorithm import PropagationAlgorithm
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            first = self.create_dataset({}, 'cave')
+            calculated = AdjustmentAlgorithm(first, cache=cache)
+            self.assertEqual((0, 1, 1), (cache.hits, cache.misses, cache.stores))
+            # The same content in another dataset object (and another run) is a hit, without recalculation.
+            restored = AdjustmentAlgorithm(self.create_dataset({}, 'cave'), cache=cache)
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            self.assertFalse(hasattr(restored, 'residuals'))
+            self.assertTrue(np.array_equal(calculated.positions, restored.positions))
+            for name, topo_point in calculated.get_topo_points().items():
+                point = restored.get_topo_points()[name].p
+                self.assertEqual(topo_point.p.xyz(), point.xyz())
+                self.assertEqual(topo_point.p.covariance, point.covariance)
+                self.assertAlmostEqual(topo_point.p.error_x, point.error_x, 15)
+            # Other readings, algorithms or parameters are misses, remarks are not part of the key.
+            AdjustmentAlgorithm(self.create_dataset({}, 'cave', compass=91.0), cache=cache)
+            PropagationAlgorithm(first, cache=cache)
+            AdjustmentAlgorithm(first, relative_error=0.02, cache=cache)
+            self.assertEqual((1, 4), (cache.hits, cache.misses))
+            first.edit_measurement('1', remarks='checked')
+            self.assertEqual(cache.key(calculated, first), cache.key(calculated, self.create_dataset({}, 'cave')))
+            # Only the declared parameters are part of the key.
+            key = cache.key(calculated, first)
+            calculated.unrelated = object()
+            self.assertEqual(key, cache.key(calculated, first))
+            self.assertEqual(ResultCache.dataset_digest(self.create_dataset({}, 'x', columnar=False)),
+                             ResultCache.dataset_digest(self.create_dataset({}, 'x', columnar=False)))
+            self.assertNotEqual(ResultCache.dataset_digest(self.create_dataset({}, 'x', columnar=False)),
+                                ResultCache.dataset_digest(self.create_dataset({}, 'x', 91.0, columnar=False)))
+            # Points without errors are restored without them.
+            propagated = PropagationAlgorithm(first, cache=cache)
+            self.assertIsNone(propagated.get_topo_points()[('cave', 2)].p.covariance)
+            # Full covariances are restored as they were.
+            sampled = MonteCarloAlgorithm(first, samples=100, seed=1, cache=cache)
+            restored = MonteCarloAlgorithm(first, samples=100, seed=1, cache=cache)
+            self.assertEqual(sampled.get_topo_points()[('cave', 2)].p.covariance,
+                             restored.get_topo_points()[('cave', 2)].p.covariance)
+            self.assertFalse(hasattr(restored, 'covariances'))
+            # Without a seed the samples differ on every run, they are neither restored nor stored.
+            MonteCarloAlgorithm(first, samples=100, cache=cache)
+            self.assertEqual((3, 5, 5), (cache.hits, cache.misses, cache.stores))
+            statistics = cache.statistics()
+            self.assertEqual(5, statistics['entries'])
+            self.assertAlmostEqual(3/8, statistics['hit_rate'])
+
+    def test_eviction(self):
+        import time
+        from data.propagation_algorithm import PropagationAlgorithm
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            datasets = [self.create_dataset({}, 'cave', compass=90.0+index) for index in range(4)]
+            for dataset in datasets:
+                PropagationAlgorithm(dataset, cache=cache)
+                time.sleep(0.01)
+            size = cache.size()//4
+            # Using the first entry makes the second the least recently used.
+            PropagationAlgorithm(datasets[0], cache=cache)
+            cache.max_size = 3*size
+            cache.evict()
+            self.assertEqual(1, cache.evictions)
+            PropagationAlgorithm(datasets[0], cache=cache)
+            PropagationAlgorithm(datasets[1], cache=cache)
+            self.assertEqual((2, 5), (cache.hits, cache.misses))
+            # A new entry is kept even if it does not fit.
+            cache.max_size = 0
+            PropagationAlgorithm(self.create_dataset({}, 'other'), cache=cache)
+            self.assertEqual(1, cache.statistics()['entries'])
+            # Incremental algorithms need their full state and are not cached.
+            PropagationAlgorithm(datasets[2], incremental=True, cache=cache)
+            self.assertEqual((2, 6, 6), (cache.hits, cache.misses, cache.stores))
+            # Entries which are not archives of arrays (a pickle) are misses.
+            with open(cache.entries()[0][2], 'wb') as entry:
+                entry.write(b'\x80\x04\x95\x00\x00\x00\x00\x00\x00\x00\x00N.')
+            PropagationAlgorithm(self.create_dataset({}, 'other'), cache=cache)
+            self.assertEqual((2, 7), (cache.hits, cache.misses))
+
+
+if __name__ == '__main__':
+    unittest.main()
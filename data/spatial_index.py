@@ -0,0 +1,267 @@
+""" ArboTopo - data: spatial index
+
+The SpatialIndex of this module answers nearest, radius and bounding box queries over the positions of stations.
+
+The positions are bulk loaded in a KD-tree (scipy) in O(N log N). Stations inserted afterwards are collected in a small
+buffer which is scanned linearly. A full buffer becomes a KD-tree of its own, and trees of about the same size are
+merged into one (the logarithmic method), so there are O(log N) trees and every station is reloaded O(log N) times.
+Stations which are inserted again (moved) are updated in place in the buffer, or else marked as removed in their old
+tree and dropped when it is merged. The index is rebuilt once more than half of its entries are removed.
+Queries combine the results of all trees and the buffer.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.spatial import cKDTree
+from data.point import Point
+
+
+class SpatialIndex:
+    """An index of the positions of named stations."""
+
+    BUFFER_SIZE = 256
+    """The number of inserted stations which are scanned linearly before they are loaded in a tree."""
+
+    def __init__(self, names=(), positions=None):
+        """Create an index of the stations with the given names and N x 3 positions, bulk loaded in one tree."""
+        self.names = list(names)
+        self.station_ids = {name: index for index, name in enumerate(self.names)}
+        count = len(self.names)
+        if count and positions is None:
+            raise ValueError("The positions of the {count} stations are required.".format(count=count))
+        self._positions = np.empty((max(count, 16), 3))
+        if count:
+            self._positions[:count] = np.asarray(positions, dtype=float)
+        self._alive = np.zeros(len(self._positions), dtype=bool)
+        self._alive[:count] = True
+        # The trees and the entries they contain, the entries of the buffer follow those of all trees.
+        self._trees = []
+        self._buffer_start = 0
+        if count:
+            self._trees.append(self._load(np.arange(count)))
+            self._buffer_start = count
+
+    @classmethod
+    def from_topo_points(cls, topo_points):
+        """Create the index of a dict of TopoPoints by name."""
+        return cls(topo_points, [topo_point.p.xyz() for topo_point in topo_points.values()])
+
+    @classmethod
+    def from_algorithm(cls, algorithm):
+        """Create the index of the stations of an Algorithm."""
+        return cls(algorithm.graph.stations, algorithm.positions)
+
+    def __len__(self):
+        """Return the number of stations."""
+        return len(self.station_ids)
+
+    def __contains__(self, name):
+        """Return whether the station with the given name is in the index."""
+        return name in self.station_ids
+
+    def position(self, name):
+        """Return the (x, y, z) of the station with the given name."""
+        return tuple(self._positions[self.station_ids[name]].tolist())
+
+    def _load(self, entries):
+        """Return a tree of the given entries and those entries."""
+        return cKDTree(self._positions[entries]), entries
+
+    def insert(self, name, position):
+        """Insert the station with the given name at the given (x, y, z) or Point, or move it there."""
+        self.insert_all([name], [position.xyz() if isinstance(position, Point) else position])
+
+    def insert_all(self, names, positions):
+        """Insert (or move) the stations with the given names at the given N x 3 positions."""
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        for name, position in zip(names, positions):
+            entry = self.station_ids.get(name)
+            if entry is not None and entry >= self._buffer_start:
+                self._positions[entry] = position
+                continue
+            if entry is not None:
+                self._alive[entry] = False
+                if 2*len(self.station_ids) < len(self.names):
+                    self._compact()
+            entry = len(self.names)
+            if entry == len(self._positions):
+                self._positions = np.concatenate((self._positions, np.empty_like(self._positions)))
+                self._alive = np.concatenate((self._alive, np.zeros(len(self._alive), dtype=bool)))
+            self.names.append(name)
+            self.station_ids[name] = entry
+            self._positions[entry] = position
+            self._alive[entry] = True
+            if len(self.names)-self._buffer_start >= self.BUFFER_SIZE:
+                self._flush()
+
+    def _compact(self):
+        """Rebuild the index from the entries which are alive."""
+        entries = np.flatnonzero(self._alive[:len(self.names)])
+        self.__init__([self.names[entry] for entry in entries.tolist()], self._positions[entries])
+
+    def _flush(self):
+        """Load the buffer in a tree and merge the trees which are not at least twice as large as the next one."""
+        entries = np.arange(self._buffer_start, len(self.names))
+        entries = entries[self._alive[entries]]
+        self._buffer_start = len(self.names)
+        while self._trees and 2*len(entries) >= len(self._trees[-1][1]):
+            previous = self._trees.pop()[1]
+            entries = np.concatenate((previous[self._alive[previous]], entries))
+        if len(entries):
+            self._trees.append(self._load(entries))
+
+    def update(self, algorithm):
+        """Insert the stations of an Algorithm which are new or moved since the index was created or updated."""
+        names, positions = algorithm.graph.stations, algorithm.positions
+        known = np.fromiter((self.station_ids.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+        changed = known < 0
+        changed[~changed] = np.any(self._positions[known[~changed]] != positions[~changed], axis=1)
+        indices = np.flatnonzero(changed)
+        if len(indices) > len(self)//2:
+            self.__init__(names, positions)
+        else:
+            self.insert_all([names[index] for index in indices.tolist()], positions[indices])
+
+    @staticmethod
+    def _xyz(point):
+        """Return the array of the (x, y, z) or Point."""
+        return np.asarray(point.xyz() if isinstance(point, Point) else point, dtype=float)
+
+    def _buffer(self):
+        """Return the entries of the buffer which are alive."""
+        entries = np.arange(self._buffer_start, len(self.names))
+        return entries[self._alive[entries]]
+
+    def _result(self, entries, distances):
+        """Return a list of (name, distance) of the given entries, sorted by distance."""
+        order = np.lexsort((entries, distances))
+        return [(self.names[entry], distance) for entry, distance in zip(entries[order].tolist(),
+                                                                          distances[order].tolist())]
+
+    def nearest(self, point, k=1):
+        """Return a list of (name, distance) of the k nearest stations to the given (x, y, z) or Point."""
+        point = self._xyz(point)
+        entries, distances = [], []
+        for tree, tree_entries in self._trees:
+            # Stations which are removed from the tree are skipped, query more until there are k others.
+            count = min(k, tree.n)
+            while True:
+                found_distances, found = tree.query(point, count)
+                found_distances, found = np.atleast_1d(found_distances), tree_entries[np.atleast_1d(found)]
+                alive = self._alive[found]
+                if np.count_nonzero(alive) >= k or count == tree.n:
+                    break
+                count = min(2*count, tree.n)
+            entries.append(found[alive])
+            distances.append(found_distances[alive])
+        buffer = self._buffer()
+        entries.append(buffer)
+        distances.append(np.sqrt(np.sum((self._positions[buffer]-point)**2, axis=1)))
+        entries, distances = np.concatenate(entries), np.concatenate(distances)
+        order = np.lexsort((entries, distances))[:k]
+        return self._result(entries[order], distances[order])
+
+    def within(self, point, radius):
+        """Return a list of (name, distance) of the stations within the radius of the given (x, y, z) or Point."""
+        point = self._xyz(point)
+        entries = [tree_entries[np.asarray(tree.query_ball_point(point, radius), dtype=np.int64)]
+                   for tree, tree_entries in self._trees]
+        buffer = self._buffer()
+        entries = np.concatenate(entries+[buffer])
+        entries = entries[self._alive[entries]]
+        distances = np.sqrt(np.sum((self._positions[entries]-point)**2, axis=1))
+        selection = distances <= radius
+        return self._result(entries[selection], distances[selection])
+
+    def in_box(self, minimum, maximum):
+        """Return the names of the stations within the box of the given minimum and maximum (x, y, z)."""
+        minimum, maximum = self._xyz(minimum), self._xyz(maximum)
+        center, extent = (minimum+maximum)/2, (maximum-minimum)/2
+        # The box is within the cube around its center with its largest extent (the ball of the maximum norm).
+        entries = [tree_entries[np.asarray(tree.query_ball_point(center, extent.max(), p=np.inf), dtype=np.int64)]
+                   for tree, tree_entries in self._trees]
+        entries = np.sort(np.concatenate(entries+[self._buffer()]))
+        entries = entries[self._alive[entries]]
+        positions = self._positions[entries]
+        selection = np.all((positions >= minimum) & (positions <= maximum), axis=1)
+        return [self.names[entry] for entry in entries[selection].tolist()]
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def brute_force(self, positions, point, radius):
+        distances = np.sqrt(np.sum((positions-point)**2, axis=1))
+        return sorted((distance, index) for index, distance in enumerate(distances.tolist()) if distance <= radius)
+
+    def test_queries(self):
+        generator = np.random.RandomState(1)
+        positions = generator.uniform(-100.0, 100.0, (1000, 3))
+        index = SpatialIndex(range(500), positions[:500])
+        # Insert the others one by one, and move some of the first ones.
+        for station in range(500, 1000):
+            index.insert(station, positions[station])
+        moved = generator.choice(500, 50, replace=False)
+        positions[moved] = generator.uniform(-100.0, 100.0, (50, 3))
+        for station in moved.tolist():
+            index.insert(station, Point(*positions[station]))
+        self.assertEqual(1000, len(index))
+        self.assertLess(len(index._trees), 8)
+        for point in generator.uniform(-100.0, 100.0, (20, 3)):
+            expected = self.brute_force(positions, point, 30.0)
+            result = index.within(point, 30.0)
+            self.assertEqual([station for distance, station in expected], [name for name, distance in result])
+            self.assertTrue(np.allclose([distance for distance, station in expected],
+                                        [distance for name, distance in result]))
+            expected = self.brute_force(positions, point, np.inf)[:5]
+            self.assertEqual([station for distance, station in expected],
+                             [name for name, distance in index.nearest(point, 5)])
+            minimum, maximum = point-(10.0, 30.0, 50.0), point+(10.0, 30.0, 50.0)
+            expected = np.flatnonzero(np.all((positions >= minimum) & (positions <= maximum), axis=1))
+            self.assertEqual(sorted(expected.tolist()), sorted(index.in_box(minimum, maximum)))
+
+    def test_algorithm(self):
+        from data.dataset import Dataset
+        from data.propagation_algorithm import PropagationAlgorithm
+        dataset = Dataset({}, 'cave', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        for station in range(10):
+            dataset.add_measurement(None, str(station), 'compass', point=station+1, refpoint=station, distance=10.0,
+                                    compass=90.0, inclination=0.0)
+        algorithm = PropagationAlgorithm(dataset, origin=0, incremental=True)
+        index = SpatialIndex.from_algorithm(algorithm)
+        self.assertEqual([3, 2], [name for name, distance in index.nearest((30.0, 0.0, 0.0), 2)])
+        self.assertAlmostEqual(10.0, index.nearest((30.0, 0.0, 0.0), 2)[1][1], 9)
+        self.assertEqual([0, 1], sorted(index.in_box((-1.0, -1.0, -1.0), (11.0, 1.0, 1.0))))
+        dataset.add_measurement(None, 'side', 'compass', point='side', refpoint=5, distance=5.0, compass=0.0,
+                                inclination=0.0)
+        index.update(algorithm)
+        self.assertEqual(12, len(index))
+        self.assertEqual(['side'], [name for name, distance in index.within((50.0, 5.0, 0.0), 1.0)])
+        self.assertTrue(np.allclose((50.0, 5.0, 0.0), index.position('side'), rtol=0, atol=1e-9))
+
+    def test_moves(self):
+        with self.assertRaises(ValueError):
+            SpatialIndex(['a', 'b'])
+        index = SpatialIndex()
+        for step in range(2000):
+            index.insert('a', (step, 0.0, 0.0))
+        self.assertEqual((1, 16), (len(index.names), len(index._positions)))
+        self.assertEqual([('a', 1.0)], index.nearest((2000.0, 0.0, 0.0)))
+        generator = np.random.RandomState(2)
+        index = SpatialIndex(range(100), generator.uniform(-100.0, 100.0, (100, 3)))
+        for step in range(20):
+            positions = generator.uniform(-100.0, 100.0, (100, 3))
+            for station in range(100):
+                index.insert(station, positions[station])
+            self.assertLessEqual(len(index.names), 200)
+        self.assertEqual(100, len(index))
+        for point in generator.uniform(-100.0, 100.0, (5, 3)):
+            expected = self.brute_force(positions, point, 40.0)
+            self.assertEqual([station for distance, station in expected],
+                             [name for name, distance in index.within(point, 40.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
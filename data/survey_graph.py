@@ -0,0 +1,274 @@
+""" ArboTopo - data: survey graph
+
+This class indexes which shots connect which stations of a Dataset tree.
+
+Station names are interned to integer ids (names are shared by all datasets of the tree). Every relative measurement is
+a shot between its reference point and its point, every absolute measurement is a fix of its point. The adjacency is
+stored in CSR form: the neighbours of station i are adjacency[indptr[i]:indptr[i+1]], with the shots connecting them
+in adjacency_shots and the direction of those shots in adjacency_signs (+1 if the shot goes from station i to the
+neighbour, -1 if it goes from the neighbour to station i). Shots and fixes can be added and replaced afterwards, the
+adjacency is then rebuilt when it is next used.
+
+copyright (C) 2016 Bram Rooseleer
+"""
+
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from data.device import calculate_differences
+from data.measurement import AbsoluteMeasurement, RelativeMeasurement
+from data.measurement_table import MeasurementTable
+
+
+class SurveyGraph:
+    """A compact graph of stations (nodes) and shots (edges)."""
+
+    def __init__(self, stations, shot_from, shot_to, measurements=None, differences=None, fix_stations=None,
+                 fixes=None):
+        """Create a survey graph.
+
+        -stations:      the list of station names, their index is the station id
+        -shot_from:     the station ids of the reference points of the shots
+        -shot_to:       the station ids of the measured points of the shots
+        -measurements:  the RelativeMeasurements of the shots
+        -differences:   the N x 3 array with the (dx, dy, dz) of the shots
+        -fix_stations:  the station ids of the absolute measurements
+        -fixes:         the AbsoluteMeasurements
+        """
+        self.stations = list(stations)
+        self.station_ids = {name: index for index, name in enumerate(self.stations)}
+        self.shot_from = np.asarray(shot_from, dtype=np.int64)
+        self.shot_to = np.asarray(shot_to, dtype=np.int64)
+        self.measurements = measurements
+        self.differences = differences
+        self.fix_stations = np.asarray([] if fix_stations is None else fix_stations, dtype=np.int64)
+        self.fixes = [] if fixes is None else fixes
+        self._adjacency = None
+        self._shot_keys = None
+
+    @classmethod
+    def from_dataset(cls, dataset, recursive=True):
+        """Create the survey graph of the dataset (and its descendants), reducing all shots in the same pass."""
+        stations = []
+        station_ids = {}
+
+        def intern(name):
+            try:
+                return station_ids[name]
+            except KeyError:
+                station_ids[name] = len(stations)
+                stations.append(name)
+                return station_ids[name]
+
+        shot_from, shot_to, measurements, differences, fix_stations, fixes = [], [], [], [], [], []
+        for child in (dataset.iter_datasets() if recursive else [dataset]):
+            if isinstance(child.measurements, MeasurementTable):
+                table = child.measurements
+                remap = np.fromiter((intern(name) for name in table.stations), dtype=np.int64,
+                                    count=len(table.stations))
+                views, child_differences = table.calculate_differences()
+                rows = np.flatnonzero(table.relative)
+                shot_from.append(remap[table.refpoint[rows]])
+                shot_to.append(remap[table.point[rows]])
+                absolute = np.flatnonzero(~table.relative)
+                fix_stations.append(remap[table.point[absolute]])
+                fixes.extend(table.view(row) for row in absolute.tolist())
+            else:
+                views = [measurement for measurement in child.measurements.values()
+                         if isinstance(measurement, RelativeMeasurement)]
+                child_differences = calculate_differences(views)
+                shot_from.append(np.fromiter((intern(view.refpoint) for view in views), dtype=np.int64,
+                                             count=len(views)))
+                shot_to.append(np.fromiter((intern(view.point) for view in views), dtype=np.int64, count=len(views)))
+                child_fixes = [measurement for measurement in child.measurements.values()
+                               if isinstance(measurement, AbsoluteMeasurement)]
+                fix_stations.append(np.fromiter((intern(fix.point) for fix in child_fixes), dtype=np.int64,
+                                                count=len(child_fixes)))
+                fixes.extend(child_fixes)
+            measurements.extend(views)
+            differences.append(child_differences)
+        return cls(stations, np.concatenate(shot_from), np.concatenate(shot_to), measurements,
+                   np.concatenate(differences), np.concatenate(fix_stations), fixes)
+
+    def _build_adjacency(self):
+        """Return the CSR adjacency arrays, build them if needed. Every shot is stored in both directions."""
+        if self._adjacency is None:
+            shots = np.arange(len(self.shot_from))
+            source = np.concatenate((self.shot_from, self.shot_to))
+            order = np.argsort(source, kind='stable')
+            indptr = np.zeros(len(self.stations)+1, dtype=np.int64)
+            np.cumsum(np.bincount(source, minlength=len(self.stations)), out=indptr[1:])
+            self._adjacency = (indptr, np.concatenate((self.shot_to, self.shot_from))[order],
+                               np.concatenate((shots, shots))[order],
+                               np.concatenate((np.ones(len(shots), dtype=np.int8),
+                                               -np.ones(len(shots), dtype=np.int8)))[order])
+        return self._adjacency
+
+    @property
+    def indptr(self):
+        """Return the CSR index pointers: the neighbours of station i are adjacency[indptr[i]:indptr[i+1]]."""
+        return self._build_adjacency()[0]
+
+    @property
+    def adjacency(self):
+        """Return the neighbouring stations of all stations."""
+        return self._build_adjacency()[1]
+
+    @property
+    def adjacency_shots(self):
+        """Return the shots connecting the stations to their neighbours."""
+        return self._build_adjacency()[2]
+
+    @property
+    def adjacency_signs(self):
+        """Return the directions of the shots connecting the stations to their neighbours."""
+        return self._build_adjacency()[3]
+
+    def intern(self, name):
+        """Return the id of the station with the given name, add the station if needed."""
+        try:
+            return self.station_ids[name]
+        except KeyError:
+            self.station_ids[name] = len(self.stations)
+            self.stations.append(name)
+            self._adjacency = None
+            return self.station_ids[name]
+
+    def add_shot(self, measurement, difference):
+        """Add a shot for the RelativeMeasurement with the given (dx, dy, dz) and return its index."""
+        index = self.shot_count
+        self.shot_from = np.append(self.shot_from, self.intern(measurement.refpoint))
+        self.shot_to = np.append(self.shot_to, self.intern(measurement.point))
+        self.measurements.append(measurement)
+        self.differences = np.concatenate((self.differences, np.reshape(difference, (1, 3))))
+        if self._shot_keys is not None:
+            self._shot_keys[(measurement.dataset, measurement.name)] = index
+        self._adjacency = None
+        return index
+
+    def set_shot(self, index, measurement, difference):
+        """Replace the shot with the given index by one for the RelativeMeasurement with the given (dx, dy, dz)."""
+        self.shot_from[index] = self.intern(measurement.refpoint)
+        self.shot_to[index] = self.intern(measurement.point)
+        self.measurements[index] = measurement
+        self.differences[index] = difference
+        self._adjacency = None
+
+    def add_fix(self, measurement):
+        """Add a fix for the AbsoluteMeasurement."""
+        self.fix_stations = np.append(self.fix_stations, self.intern(measurement.point))
+        self.fixes.append(measurement)
+
+    def shot_index(self, measurement):
+        """Return the index of the shot of the given measurement (looked up by dataset and name)."""
+        if self._shot_keys is None:
+            self._shot_keys = {(shot.dataset, shot.name): index for index, shot in enumerate(self.measurements)}
+        return self._shot_keys[(measurement.dataset, measurement.name)]
+
+    @property
+    def station_count(self):
+        """Return the number of stations."""
+        return len(self.stations)
+
+    @property
+    def shot_count(self):
+        """Return the number of shots."""
+        return len(self.shot_from)
+
+    def neighbours(self, station):
+        """Return the ids of the neighbours of the station with the given name (once per connecting shot)."""
+        return self.neighbours_of_id(self.station_ids[station])
+
+    def neighbours_of_id(self, station):
+        """Return the ids of the neighbours of the station with the given id (once per connecting shot)."""
+        return self.adjacency[self.indptr[station]:self.indptr[station+1]]
+
+    def shots(self, station):
+        """Return the indices of the shots from or to the station with the given name."""
+        return self.shots_of_id(self.station_ids[station])
+
+    def shots_of_id(self, station):
+        """Return the indices of the shots from or to the station with the given id."""
+        return self.adjacency_shots[self.indptr[station]:self.indptr[station+1]]
+
+    def degree(self, station=None):
+        """Return the number of shots of the named station, or an array with the degrees of all stations."""
+        if station is None:
+            return np.diff(self.indptr)
+        station = self.station_ids[station]
+        return int(self.indptr[station+1]-self.indptr[station])
+
+    def matrix(self):
+        """Return the (symmetric) adjacency matrix as a scipy CSR matrix with the shot counts as values."""
+        return csr_matrix((np.ones(len(self.adjacency), dtype=np.int32), self.adjacency, self.indptr),
+                          shape=(self.station_count, self.station_count))
+
+    def connected_components(self):
+        """Return the number of connected components and an array with the component label of every station."""
+        return connected_components(self.matrix(), directed=False)
+
+    def component(self, station):
+        """Return the ids of the stations in the same connected component as the station with the given name."""
+        labels = self.connected_components()[1]
+        return np.flatnonzero(labels == labels[self.station_ids[station]])
+
+
+class SurveyGraphTest(unittest.TestCase):
+
+    def test_graph(self):
+        from data.dataset import Dataset
+        datasets = {}
+        cave = Dataset(datasets, 'cave')
+        cave.add_device('DCIDevice', 'compass')
+        branch = Dataset(datasets, 'branch', parent='cave', columnar=True)
+        shots = ((cave, 'a', 'b'), (cave, 'b', 'c'), (cave, 'c', 'a'), (branch, 'c', 'd'), (branch, 'x', 'y'),
+                 (branch, 'd', 'b'))
+        for index, (dataset, refpoint, point) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=index+1.0,
+                                    compass=10.0*index, inclination=0.0)
+        graph = SurveyGraph.from_dataset(cave)
+        self.assertEqual(['a', 'b', 'c', 'd', 'y', 'x'], graph.stations)
+        self.assertEqual(6, graph.shot_count)
+        self.assertEqual([2, 3, 3, 2, 1, 1], graph.degree().tolist())
+        self.assertEqual(['a', 'b', 'd'], sorted(graph.stations[neighbour] for neighbour in graph.neighbours('c')))
+        self.assertEqual(3, graph.degree('b'))
+        count, labels = graph.connected_components()
+        self.assertEqual(2, count)
+        self.assertEqual([0, 1, 2, 3], graph.component('d').tolist())
+        for station in range(graph.station_count):
+            for neighbour, shot, sign in zip(graph.neighbours_of_id(station), graph.shots_of_id(station),
+                                             graph.adjacency_signs[graph.indptr[station]:graph.indptr[station+1]]):
+                measurement = graph.measurements[shot]
+                ends = (measurement.refpoint, measurement.point)[::sign]
+                self.assertEqual((graph.stations[station], graph.stations[neighbour]), ends)
+                self.assertAlmostEqual(measurement.dx, graph.differences[shot][0], 12)
+        branch.add_measurement(None, 'new', 'compass', point='z', refpoint='y', distance=1.0, compass=0.0,
+                               inclination=0.0)
+        index = graph.add_shot(branch.get_measurement('new'), (0.0, 1.0, 0.0))
+        self.assertEqual(index, graph.shot_index(branch.get_measurement('new')))
+        self.assertEqual(7, graph.station_count)
+        self.assertEqual(['y'], [graph.stations[neighbour] for neighbour in graph.neighbours('z')])
+        self.assertEqual(2, graph.degree('y'))
+
+    def test_integer_names(self):
+        from data.dataset import Dataset
+        dataset = Dataset({}, 'traverse', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        for index, (refpoint, point) in enumerate(((5, 7), (7, 9), (9, 1))):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=1.0,
+                                    compass=0.0, inclination=0.0)
+        graph = SurveyGraph.from_dataset(dataset)
+        self.assertEqual([7, 5, 9, 1], graph.stations)
+        self.assertEqual([9], [graph.stations[neighbour] for neighbour in graph.neighbours(1)])
+        self.assertEqual([7], [graph.stations[neighbour] for neighbour in graph.neighbours_of_id(1)])
+        self.assertEqual([2], graph.shots(1).tolist())
+        self.assertEqual(1, graph.degree(5))
+        self.assertEqual(2, graph.degree(7))
+        self.assertEqual([0, 1, 2, 3], graph.component(1).tolist())
+        with self.assertRaises(KeyError):
+            graph.neighbours(4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ copyright (C) 2016 Bram Rooseleer
 class TopoPoint:
     """A class containing information about a topo point."""
 
+    __slots__ = ('name', 'p', 'l', 'r', 't', 'b', 'remarks', 'properties')
+
     def __init__(self, name, p, l=None, r=None, t=None, b=None, remarks=None, **kwargs):
         """Create a topo point with the following parameters.
 
@@ -2,9 +2,486 @@
 
 This class represents the way measured data is processed and visualized.
 
+A View renders the stations and passage walls calculated by an Algorithm as a pyramid of map tiles, in plan, in
+profile (projected on the vertical plane facing the given azimuth) or in extended elevation (see ExtendedElevation,
+the passages of its spanning tree unfolded with the sections at the unfolded positions of their stations). All
+stations and the points of their sections are projected in one matrix product. The survey graph (or the spanning tree
+in extended elevation) is split in centerline chains between its junctions and ends, and
+every station of a chain is ranked by the tolerance at which Douglas-Peucker simplification would drop it, for all
+chains at once: every round splits all pending segments of all chains at their farthest point. A zoom level then keeps
+the stations ranked above its pixel size.
+
+Zoom level z has 2^z x 2^z tiles of TILE_SIZE pixels, numbered from the top left, covering a square around the
+projected survey: the smallest with a size of a power of two meters and its corner at a multiple of half that size. The
+grid of tiles therefore does not follow the bounds of the survey, tiles keep their place and content when the survey
+changes elsewhere within the square. Every segment is assigned to all tiles its bounding box touches. Tiles are
+written as SVG and/or PNG files (directory/format/z/x/y.format), rendered by a pool of processes if requested. A
+manifest records a hash of the content of every tile, so only tiles of which the content changed are rendered again.
+
 copyright (C) 2016 Bram Rooseleer
 """
 
+import hashlib
+import json
+import os
+import struct
+import unittest
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from data.extended_elevation import ExtendedElevation
+
+
+CENTERLINE, WALL = 0, 1
+
+STYLES = {CENTERLINE: ('#d00000', (208, 0, 0)), WALL: ('#000000', (0, 0, 0))}
+"""The SVG and RGB colors of the kinds of segments."""
+
+
+def _render_tile(task):
+    """Write a tile, given as (filename, format, size, N x 4 pixel coordinates of segments, kinds of the segments)."""
+    filename, format, size, segments, kinds = task
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if format == 'svg':
+        paths = []
+        for kind in (WALL, CENTERLINE):
+            selected = segments[kinds == kind]
+            if len(selected):
+                data = ' '.join('M{0:.2f} {1:.2f}L{2:.2f} {3:.2f}'.format(*segment) for segment in selected.tolist())
+                paths.append('<path d="{data}" stroke="{color}" stroke-width="1" fill="none"/>'.format(
+                    data=data, color=STYLES[kind][0]))
+        with open(filename, 'w') as svg_file:
+            svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+                           'viewBox="0 0 {size} {size}">{paths}</svg>\n'.format(size=size, paths=''.join(paths)))
+    else:
+        image = np.full((size, size, 3), 255, dtype=np.uint8)
+        for kind in (WALL, CENTERLINE):
+            _rasterize(image, segments[kinds == kind], STYLES[kind][1])
+        with open(filename, 'wb') as png_file:
+            png_file.write(_encode_png(image))
+
+
+def _rasterize(image, segments, color):
+    """Draw the segments (N x 4 pixel coordinates) with the color in the image, sampled every half pixel."""
+    starts, ends = segments[:, :2], segments[:, 2:]
+    counts = np.ceil(2*np.sqrt(np.sum((ends-starts)**2, axis=1))).astype(np.int64)+1
+    owners = np.repeat(np.arange(len(segments)), counts)
+    fractions = (np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts))/np.maximum(counts-1, 1)[owners]
+    points = np.floor(starts[owners]+fractions[:, np.newaxis]*(ends-starts)[owners]).astype(np.int64)
+    inside = np.all((points >= 0) & (points < image.shape[0]), axis=1)
+    image[points[inside, 1], points[inside, 0]] = color
+
+
+def _encode_png(image):
+    """Return the bytes of a PNG file of an H x W x 3 image of bytes."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data))+kind+data+struct.pack('>I', zlib.crc32(kind+data) & 0xffffffff)
+    height, width = image.shape[:2]
+    # Every row starts with its filter type (none).
+    rows = np.concatenate((np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)), axis=1)
+    return (b'\x89PNG\r\n\x1a\n'+chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))+chunk(b'IEND', b''))
+
 
 class View:
     """A class containing all information to process and visualize data."""
+
+    TILE_SIZE = 256
+    """The width and height of the tiles in pixels."""
+
+    TOLERANCE = 0.5
+    """The distance in pixels over which centerlines are simplified."""
+
+    MANIFEST = 'tiles.json'
+    """The name of the file with the hashes of the rendered tiles."""
+
+    def __init__(self, algorithm, projection='plan', azimuth=0.0, max_zoom=4, topo_points=None, directions=None):
+        """Create a view of the TopoPoints calculated by an Algorithm.
+
+        -projection:    'plan', 'profile' or 'extended'
+        -azimuth:       the direction (degrees) in which a profile is seen
+        -max_zoom:      the highest zoom level of the tiles
+        -topo_points:   a dict of TopoPoints (by name) with the sections, those of the algorithm if None
+        -directions:    the directions of the legs of an extended elevation (see ExtendedElevation)
+        """
+        if projection not in ('plan', 'profile', 'extended'):
+            raise ValueError("Unknown projection '{projection}'.".format(projection=projection))
+        self.algorithm = algorithm
+        self.projection = projection
+        self.azimuth = azimuth
+        self.max_zoom = max_zoom
+        self.topo_points = algorithm.get_topo_points() if topo_points is None else topo_points
+        self.elevation = ExtendedElevation(algorithm, directions) if projection == 'extended' else None
+
+    def projection_matrix(self):
+        """Return the 3 x 2 matrix projecting (x, y, z) on the map (x to the right, y up).
+
+        In extended elevation it only projects the altitude, the unfolded horizontal positions of the stations are added.
+        """
+        if self.projection == 'plan':
+            return np.array(((1.0, 0.0), (0.0, 1.0), (0.0, 0.0)))
+        if self.projection == 'extended':
+            return np.array(((0.0, 0.0), (0.0, 0.0), (0.0, 1.0)))
+        azimuth = np.radians(self.azimuth)
+        return np.array(((np.cos(azimuth), 0.0), (-np.sin(azimuth), 0.0), (0.0, 1.0)))
+
+    def _project(self):
+        """Project the stations and the (left, top, right, bottom) points of their sections, NaN where missing."""
+        stations = self.algorithm.graph.stations
+        positions = self.algorithm.positions
+        sections = np.full((len(stations), 4, 3), np.nan)
+        for index, name in enumerate(stations):
+            topo_point = self.topo_points.get(name)
+            if topo_point is not None:
+                for side, point in enumerate((topo_point.l, topo_point.t, topo_point.r, topo_point.b)):
+                    if point is not None:
+                        sections[index, side] = point.xyz()
+        projected = np.concatenate((positions[:, np.newaxis], sections), axis=1).reshape(-1, 3).dot(
+            self.projection_matrix()).reshape(-1, 5, 2)
+        if self.elevation is not None:
+            projected[:, :, 0] += self.elevation.coordinates[:, :1]
+        self._stations, self._sections = projected[:, 0], projected[:, 1:]
+
+    @property
+    def stations(self):
+        """Return the N x 2 projected positions of the stations."""
+        try:
+            return self._stations
+        except AttributeError:
+            self._project()
+            return self._stations
+
+    @property
+    def sections(self):
+        """Return the N x 4 x 2 projected (left, top, right, bottom) points of the sections, NaN where missing."""
+        try:
+            return self._sections
+        except AttributeError:
+            self._project()
+            return self._sections
+
+    @property
+    def chains(self):
+        """Return the list of arrays of the stations of the centerline chains between junctions and ends."""
+        try:
+            return self._chains
+        except AttributeError:
+            self._chains = self._find_chains()
+            return self._chains
+
+    def _find_chains(self):
+        """Split the (undirected, simple) graph of the shots (or legs) in chains of stations with two neighbours."""
+        graph = self.algorithm.graph
+        size = graph.station_count
+        if self.elevation is None:
+            first, last = graph.shot_from, graph.shot_to
+        else:
+            first, last = self.elevation.legs.T
+        selection = first != last
+        keys = np.unique(np.minimum(first, last)[selection]*size+np.maximum(first, last)[selection])
+        edges = np.stack((keys // size, keys % size), axis=1)
+        source = np.concatenate((edges[:, 0], edges[:, 1]))
+        order = np.argsort(source, kind='stable')
+        indptr = np.zeros(size+1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=size), out=indptr[1:])
+        indptr = indptr.tolist()
+        neighbours = np.concatenate((edges[:, 1], edges[:, 0]))[order].tolist()
+        edge_ids = np.concatenate((np.arange(len(edges)), np.arange(len(edges))))[order].tolist()
+        degree = np.diff(indptr).tolist()
+        used = [False]*len(edges)
+        chains = []
+
+        def walk(start, index):
+            node, edge = neighbours[index], edge_ids[index]
+            used[edge] = True
+            chain = [start, node]
+            while degree[node] == 2 and node != start:
+                for next_index in range(indptr[node], indptr[node+1]):
+                    if edge_ids[next_index] != edge:
+                        break
+                node, edge = neighbours[next_index], edge_ids[next_index]
+                if used[edge]:
+                    break
+                used[edge] = True
+                chain.append(node)
+            chains.append(np.asarray(chain, dtype=np.int64))
+
+        # Chains start at junctions and ends, loops without those at any of their stations.
+        starts = [node for node in range(size) if degree[node] != 2]+list(range(size))
+        for start in starts:
+            for index in range(indptr[start], indptr[start+1]):
+                if not used[edge_ids[index]]:
+                    walk(start, index)
+        return chains
+
+    @property
+    def importance(self):
+        """Return the Douglas-Peucker tolerance above which every station of the chains is dropped.
+
+        The importance of every station is indexed like the concatenated chains, the ends of the chains are never
+        dropped. A station is never more important than the station which split its segment, so the simplification
+        for a larger tolerance is a subset of that for a smaller one.
+        """
+        try:
+            return self._importance
+        except AttributeError:
+            self._importance = self._rank()
+            return self._importance
+
+    def _rank(self):
+        """Rank the stations of all chains at once, splitting all segments at their farthest station every round."""
+        lengths = np.fromiter((len(chain) for chain in self.chains), dtype=np.int64, count=len(self.chains))
+        points = self.stations[np.concatenate(self.chains)] if self.chains else np.zeros((0, 2))
+        importance = np.zeros(len(points))
+        ends = np.cumsum(lengths)-1
+        importance[ends] = importance[ends-lengths+1] = np.inf
+        starts, ends, limits = ends-lengths+1, ends, np.full(len(lengths), np.inf)
+        while True:
+            pending = ends-starts > 1
+            starts, ends, limits = starts[pending], ends[pending], limits[pending]
+            if not len(starts):
+                return importance
+            counts = ends-starts-1
+            owners = np.repeat(np.arange(len(starts)), counts)
+            offsets = np.cumsum(counts)-counts
+            indices = np.repeat(starts+1, counts)+np.arange(counts.sum())-np.repeat(offsets, counts)
+            first, last = points[starts][owners], points[ends][owners]
+            direction = last-first
+            length = np.einsum('ij,ij->i', direction, direction)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.clip(np.where(length > 0, np.einsum('ij,ij->i', points[indices]-first, direction)/length,
+                                            0.0), 0.0, 1.0)
+            distances = np.sqrt(np.sum((points[indices]-first-fraction[:, np.newaxis]*direction)**2, axis=1))
+            maxima = np.maximum.reduceat(distances, offsets)
+            # The first farthest station of every segment.
+            farthest = np.flatnonzero(distances == maxima[owners])
+            farthest = farthest[np.unique(owners[farthest], return_index=True)[1]]
+            splits = indices[farthest]
+            limits = np.minimum(maxima, limits)
+            importance[splits] = limits
+            starts, ends, limits = (np.concatenate((starts, splits)), np.concatenate((splits, ends)),
+                                    np.concatenate((limits, limits)))
+
+    def extent(self):
+        """Return the (x, y) of the top left corner and the size of the square covered by the tiles of zoom 0."""
+        points = np.concatenate((self.stations, self.sections.reshape(-1, 2)))
+        points = points[np.all(np.isfinite(points), axis=1)]
+        if not len(points):
+            return (0.0, 1.0), 1.0
+        minimum, maximum = points.min(axis=0), points.max(axis=0)
+        # A square of twice the size of the survey always fits, a smaller one may.
+        size = 2.0**np.ceil(np.log2(max(float((maximum-minimum).max()), 1.0)))
+        while True:
+            corner = np.floor(minimum/(size/2))*(size/2)
+            if np.all(maximum <= corner+size):
+                return (float(corner[0]), float(corner[1]+size)), size
+            size *= 2
+
+    def _chain_stations(self):
+        """Return the concatenated stations of the chains and the index of the first station of every chain."""
+        try:
+            return self._concatenated
+        except AttributeError:
+            lengths = np.fromiter((len(chain) for chain in self.chains), dtype=np.int64, count=len(self.chains))
+            self._concatenated = (np.concatenate(self.chains) if self.chains else np.zeros(0, dtype=np.int64),
+                                  np.cumsum(lengths)-lengths)
+            return self._concatenated
+
+    def segment_blocks(self, zoom=None, tolerance=None, block_size=2**16):
+        """Yield the N x 4 (x, y, x, y) segments and their kinds drawn at the given zoom level in blocks.
+
+        The centerlines are simplified with a tolerance of TOLERANCE pixels of the zoom level (max_zoom if None), or
+        with the given tolerance (in meter). The walls connect the left and right (in plan) or the top and bottom (in
+        profile) points of the sections of consecutive stations of the chains. Every block holds the segments from
+        block_size stations of the concatenated chains, so the memory used does not grow with the number of stations.
+        """
+        if tolerance is None:
+            zoom = self.max_zoom if zoom is None else zoom
+            tolerance = self.TOLERANCE*self.extent()[1]/(self.TILE_SIZE*2**zoom)
+        stations, starts = self._chain_stations()
+        sides = (0, 2) if self.projection == 'plan' else (1, 3)
+        previous = np.zeros(0, dtype=np.int64)
+        for start in range(0, len(stations), block_size):
+            end = min(start+block_size, len(stations))
+            # The centerlines from the last station kept before the block, the walls to the first after it.
+            kept = np.concatenate((previous, start+np.flatnonzero(self.importance[start:end] > tolerance)))
+            previous = kept[-1:]
+            chain_ids = np.searchsorted(starts, kept, side='right')
+            same = chain_ids[:-1] == chain_ids[1:]
+            centerlines = np.concatenate((self.stations[stations[kept[:-1][same]]],
+                                          self.stations[stations[kept[1:][same]]]), axis=1)
+            indices = np.arange(start, min(end+1, len(stations)))
+            chain_ids = np.searchsorted(starts, indices, side='right')
+            consecutive = indices[:-1][chain_ids[:-1] == chain_ids[1:]]
+            walls = np.concatenate([np.concatenate((self.sections[stations[consecutive], side],
+                                                    self.sections[stations[consecutive+1], side]), axis=1)
+                                    for side in sides])
+            walls = walls[np.all(np.isfinite(walls), axis=1)]
+            yield (np.concatenate((centerlines, walls)),
+                   np.concatenate((np.full(len(centerlines), CENTERLINE), np.full(len(walls), WALL))).astype(np.int8))
+
+    def segments(self, zoom=None, tolerance=None):
+        """Return the N x 4 (x, y, x, y) segments and their kinds drawn at the given zoom level (see segment_blocks).
+        """
+        blocks = list(self.segment_blocks(zoom, tolerance))
+        if not blocks:
+            return np.zeros((0, 4)), np.zeros(0, dtype=np.int8)
+        return np.concatenate([block[0] for block in blocks]), np.concatenate([block[1] for block in blocks])
+
+    def tiles(self, zoom):
+        """Return a dict mapping the (x, y) of the tiles of the zoom level on their segments (in pixels) and kinds."""
+        (left, top), size = self.extent()
+        count = 2**zoom
+        scale = self.TILE_SIZE*count/size
+        segments, kinds = self.segments(zoom)
+        # The segments in pixels of the whole level, y down.
+        pixels = (segments-(left, top, left, top))*(scale, -scale, scale, -scale)
+        low = np.floor(np.minimum(pixels[:, :2], pixels[:, 2:])/self.TILE_SIZE).astype(np.int64).clip(0, count-1)
+        high = np.floor(np.maximum(pixels[:, :2], pixels[:, 2:])/self.TILE_SIZE).astype(np.int64).clip(0, count-1)
+        spans = high-low+1
+        counts = spans[:, 0]*spans[:, 1]
+        owners = np.repeat(np.arange(len(segments)), counts)
+        ranks = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+        tile_x = low[owners, 0]+ranks % spans[owners, 0]
+        tile_y = low[owners, 1]+ranks // spans[owners, 0]
+        keys = tile_x*count+tile_y
+        order = np.argsort(keys, kind='stable')
+        keys, owners = keys[order], owners[order]
+        boundaries = np.flatnonzero(np.diff(keys))+1
+        tiles = {}
+        for group in np.split(np.arange(len(keys)), boundaries):
+            if not len(group):
+                continue
+            key = int(keys[group[0]])
+            tile_x, tile_y = divmod(key, count)
+            offset = np.array((tile_x, tile_y, tile_x, tile_y))*self.TILE_SIZE
+            tiles[(tile_x, tile_y)] = (pixels[owners[group]]-offset, kinds[owners[group]])
+        return tiles
+
+    def render(self, directory, formats=('svg',), workers=None):
+        """Write the tiles of all zoom levels in the given formats ('svg' and/or 'png') and return the rendered files.
+
+        Tiles of which the content did not change since the last rendering in the directory are skipped, tiles which
+        are no longer needed are removed. With workers, the tiles are rendered by that number of processes.
+        """
+        manifest_filename = os.path.join(directory, self.MANIFEST)
+        try:
+            with open(manifest_filename) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+        hashes, tasks = {}, []
+        for zoom in range(self.max_zoom+1):
+            for (tile_x, tile_y), (segments, kinds) in self.tiles(zoom).items():
+                segments = np.round(segments, 2)
+                digest = hashlib.sha1(segments.tobytes()+kinds.tobytes()).hexdigest()
+                for format in formats:
+                    name = '/'.join((format, str(zoom), str(tile_x), '{0}.{1}'.format(tile_y, format)))
+                    filename = os.path.join(directory, *name.split('/'))
+                    hashes[name] = digest
+                    if manifest.get(name) != digest or not os.path.exists(filename):
+                        tasks.append((filename, format, self.TILE_SIZE, segments, kinds))
+        if workers and workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                list(executor.map(_render_tile, tasks, chunksize=max(1, len(tasks)//(4*workers))))
+        else:
+            for task in tasks:
+                _render_tile(task)
+        for name in set(manifest)-set(hashes):
+            filename = os.path.join(directory, *name.split('/'))
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.makedirs(directory, exist_ok=True)
+        with open(manifest_filename, 'w') as manifest_file:
+            json.dump(hashes, manifest_file, sort_keys=True)
+        return [task[0] for task in tasks]
+
+
+class ViewTest(unittest.TestCase):
+
+    def create_algorithm(self):
+        from data.dataset import Dataset
+        from data.propagation_algorithm import PropagationAlgorithm
+        dataset = Dataset({}, 'cave', columnar=True)
+        dataset.add_device('DCIDevice', 'compass')
+        # A straight passage of 20 stations with a kink at 10, a side passage at 5 and a small loop at 15.
+        shots = [(index, index+1, 90.0 if index < 10 else 0.0) for index in range(20)]
+        shots += [(5, 'a', 180.0), ('a', 'b', 180.0), (15, 'c', 90.0), ('c', 16, 0.0)]
+        for index, (refpoint, point, compass) in enumerate(shots):
+            dataset.add_measurement(None, str(index), 'compass', point=point, refpoint=refpoint, distance=10.0,
+                                    compass=compass, inclination=0.0 if refpoint != 'c' else 45.0)
+        return PropagationAlgorithm(dataset, origin=0)
+
+    def test_simplification(self):
+        view = View(self.create_algorithm())
+        graph = view.algorithm.graph
+        # The segments do not depend on the blocks.
+        for zoom in range(4):
+            blocks = list(view.segment_blocks(zoom, block_size=3))
+            self.assertTrue(np.array_equal(view.segments(zoom)[0][np.lexsort(view.segments(zoom)[0].T)],
+                                           np.concatenate([block[0] for block in blocks])[
+                                               np.lexsort(np.concatenate([block[0] for block in blocks]).T)]))
+        self.assertEqual(sorted(graph.station_ids[name] for name in range(21)),
+                         sorted(set(np.concatenate(view.chains).tolist())-{graph.station_ids[name] for name in 'abc'}))
+        # Every shot is in exactly one chain.
+        self.assertEqual(graph.shot_count, sum(len(chain)-1 for chain in view.chains))
+        coarse, kinds = view.segments(0)
+        self.assertTrue(np.all(kinds == CENTERLINE))
+        # At zoom 0 the straight parts are a single segment, the kink at 10 is kept.
+        stations = {tuple(np.round(point, 6)) for point in coarse.reshape(-1, 2).tolist()}
+        self.assertIn(tuple(np.round(view.stations[graph.station_ids[10]], 6)), stations)
+        self.assertNotIn(tuple(np.round(view.stations[graph.station_ids[3]], 6)), stations)
+        # Collinear stations are dropped at every zoom level, each chain has a segment less than it keeps stations.
+        self.assertEqual(np.count_nonzero(view.importance > 1e-9)-len(view.chains), len(view.segments(20)[0]))
+        profile = View(view.algorithm, projection='profile', azimuth=0.0)
+        self.assertTrue(np.allclose(profile.stations[:, 1], view.algorithm.positions[:, 2]))
+        # The extended elevation draws the legs of its tree only, the shot closing the loop at 15 is left out.
+        extended = View(view.algorithm, projection='extended', directions={'a': 'left'})
+        self.assertTrue(np.allclose(extended.elevation.coordinates, extended.stations))
+        self.assertEqual(graph.shot_count-1, sum(len(chain)-1 for chain in extended.chains))
+        # The side passage at 5 (at 50 meter) goes back to the left, b inherits that.
+        self.assertAlmostEqual(30.0, extended.stations[graph.station_ids['b'], 0], 9)
+
+    def test_render(self):
+        import tempfile
+        from data.point import Point
+        from data.topo_point import TopoPoint
+        algorithm = self.create_algorithm()
+        topo_points = dict(algorithm.get_topo_points())
+        for name in range(10):
+            x, y, z = topo_points[name].p.xyz()
+            topo_points[name] = TopoPoint(name, Point(x, y, z), l=Point(x, y+2, z), r=Point(x, y-2, z))
+        view = View(algorithm, max_zoom=2, topo_points=topo_points)
+        self.assertIn(WALL, view.segments(2)[1])
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            rendered = view.render(first, formats=('svg', 'png'))
+            self.assertEqual([os.path.relpath(name, first) for name in rendered],
+                             [os.path.relpath(name, second) for name in view.render(second, ('svg', 'png'), workers=2)])
+            self.assertEqual([], view.render(first, formats=('svg', 'png')))
+            for filename in rendered:
+                with open(filename, 'rb') as first_file, open(filename.replace(first, second), 'rb') as second_file:
+                    self.assertEqual(first_file.read(), second_file.read())
+            with open(os.path.join(first, 'png', '0', '0', '0.png'), 'rb') as png_file:
+                data = png_file.read()
+            self.assertTrue(data.startswith(b'\x89PNG'))
+            width, height = struct.unpack('>II', data[16:24])
+            self.assertEqual((View.TILE_SIZE, View.TILE_SIZE), (width, height))
+            # Only the tiles of the walls change when they are removed.
+            changed = View(algorithm, max_zoom=2).render(first, formats=('svg',))
+            self.assertLess(len(changed), len([name for name in rendered if name.endswith('.svg')]))
+            self.assertFalse(os.path.exists(os.path.join(first, 'png', '0', '0', '0.png')))
+            # A shot extending the survey moves its bounds, but the tiles stay in place and only those of the chain it
+            # extends (simplified to a single segment from 16 to 21) are rendered again.
+            from data.propagation_algorithm import PropagationAlgorithm
+            algorithm.dataset.add_measurement(None, 'extension', 'compass', point=21, refpoint=20, distance=10.0,
+                                              compass=0.0, inclination=0.0)
+            extended = View(PropagationAlgorithm(algorithm.dataset, origin=0), max_zoom=2)
+            self.assertEqual(view.extent(), extended.extent())
+            changed = extended.render(first, formats=('svg',))
+            self.assertEqual([os.path.join(first, 'svg', str(zoom), str(tile_x), '{0}.svg'.format(tile_y))
+                              for zoom, tile_x, tile_y in ((0, 0, 0), (1, 0, 0), (2, 1, 0), (2, 1, 1))], changed)
+            self.assertEqual(len(extended.segments(2)[0]), len(extended.segments()[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()